@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+Módulo de Herramientas de la IA para MeshBot.
+
+Cuando Gemini pide varias llamadas a función en una misma respuesta (por ejemplo, el
+tiempo en tres ciudades), se ejecutan a la vez en un pool de hilos acotado, cada una
+con su tiempo máximo, y los resultados se devuelven en el mismo orden en que se
+pidieron. Las herramientas se describen con una tabla de datos (AITool): qué función
+llamar, qué argumentos son obligatorios y cuáles tienen valor por defecto.
+"""
+
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+from logutil import log
+
+class AITool:
+    """
+    Una herramienta que la IA puede llamar.
+
+    required son los argumentos obligatorios (sin ellos no se llama a la función),
+    optional un diccionario {argumento: valor por defecto} y, con with_sender=True,
+    la función recibe además el ID del usuario como primer argumento.
+    """
+
+    def __init__(self, name, func, required=(), optional=None, with_sender=False, timeout=None):
+        self.name = name
+        self.func = func
+        self.required = tuple(required)
+        self.optional = dict(optional or {})
+        self.with_sender = with_sender
+        self.timeout = timeout
+
+    def call(self, args, sender_id):
+        missing = [arg for arg in self.required if not args.get(arg)]
+        if missing:
+            log('warning', f"Llamada a {self.name} sin {', '.join(repr(arg) for arg in missing)}.")
+            return f"Error: falta {', '.join(missing)}."
+        kwargs = {arg: args.get(arg) for arg in self.required}
+        for arg, default in self.optional.items():
+            kwargs[arg] = args.get(arg, default)
+        if self.with_sender:
+            return self.func(sender_id, **kwargs)
+        return self.func(**kwargs)
+
+class AIToolRunner:
+    """Ejecuta las llamadas a herramientas de un turno en paralelo, con un pool compartido por todos los usuarios."""
+
+    def __init__(self, tools, max_workers, default_timeout, latency_histogram=None):
+        self.tools = {tool.name: tool for tool in tools}
+        self.default_timeout = default_timeout
+        self.latency_histogram = latency_histogram
+        self._executor = ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix="ai-tool")
+        self.timeouts = 0
+
+    def _timed_call(self, tool, args, sender_id):
+        started = time.perf_counter()
+        try:
+            return tool.call(args, sender_id)
+        finally:
+            if self.latency_histogram is not None:
+                self.latency_histogram.observe(time.perf_counter() - started, tool=tool.name)
+
+    def run(self, calls, sender_id):
+        """
+        Ejecuta una lista de llamadas (nombre, argumentos) y devuelve sus resultados en el mismo
+        orden. Una herramienta que falla o no termina a tiempo devuelve un texto de error, que
+        se le pasa a la IA como su resultado; las demás no se ven afectadas.
+        """
+        started = time.monotonic()
+        futures = []
+        for name, args in calls:
+            tool = self.tools.get(name)
+            future = self._executor.submit(self._timed_call, tool, args, sender_id) if tool is not None else None
+            futures.append((name, tool, future))
+
+        results = []
+        for name, tool, future in futures:
+            if future is None:
+                log('warning', f"La IA pidió una función desconocida: {name}")
+                results.append(f"Error: función desconocida '{name}'.")
+                continue
+            timeout = tool.timeout if tool.timeout is not None else self.default_timeout
+            try:
+                result = future.result(timeout=max(0, started + timeout - time.monotonic()))
+                results.append(result or "Error ejecutando función.")
+            except FutureTimeoutError:
+                # El hilo no se puede interrumpir: termina por su cuenta y su resultado se descarta.
+                self.timeouts += 1
+                log('advertencia', f"La función {name} no respondió en {timeout:g} s.")
+                results.append(f"Error: la función '{name}' no respondió a tiempo.")
+            except Exception as e:
+                log('error', f"Error ejecutando la función {name}: {e}")
+                results.append("Error ejecutando función.")
+        return results
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Paquetes y bytes por respuesta, con y sin texto comprimido.
+
+Parte unas respuestas típicas de la IA como lo hace send_long_message: sin comprimir
+(como hasta ahora) y comprimidas con Unishox2 para un destino que lo admite. Cuenta
+los paquetes y los bytes de carga útil de cada una. También compara el tiempo de la
+segmentación anterior, que volvía a codificar la parte entera con cada palabra, con
+la de segmenter.py.
+
+La parte de compresión necesita unishox2-py3 (ver requirements.txt).
+
+Uso (desde la raíz del repositorio):
+    python3 benchmarks/bench_compression.py [iteraciones]
+"""
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from meshtastic import mesh_pb2
+import segmenter
+import textcodec
+
+MAX_PAYLOAD_LEN = mesh_pb2.Constants.DATA_PAYLOAD_LEN - 10
+DESTINATION = 0xDEADBEEF
+
+REPLIES = [
+    "Hola, soy MeshBot, un asistente de la red Meshtastic. Puedo darte el tiempo de cualquier ciudad, "
+    "la hora, datos de los nodos que conozco (batería, temperatura, humedad, posición) y los nodos más "
+    "cercanos a ti. Escríbeme por privado o usa !ayuda para ver todos los comandos.",
+    "En Madrid ahora mismo hay 18 grados con cielo parcialmente nublado y viento flojo del oeste de unos "
+    "12 kilómetros por hora. La humedad es del 45 por ciento y no se esperan lluvias durante la tarde. "
+    "Por la noche las temperaturas bajarán hasta los 9 grados, así que conviene llevar algo de abrigo si "
+    "vas a salir. Mañana el día será soleado, con máximas de 22 grados y mínimas de 8.",
+    "El nodo Repetidor Sierra (!a1b2c3d4) se vio por última vez hace 12 minutos. Su batería está al 87 por "
+    "ciento con 4,05 voltios y su sensor marca 14,2 grados, 61 por ciento de humedad y 1013 hectopascales. "
+    "Está a unos 23 kilómetros de tu última posición conocida, en dirección noroeste. En las últimas 24 "
+    "horas la batería ha bajado un 6 por ciento y la temperatura ha oscilado entre 9 y 19 grados, con la "
+    "mínima a las seis de la mañana. Los nodos más cercanos a él son Torre Norte, a 4 kilómetros, y "
+    "Base Valle, a 7 kilómetros; los tres comparten canal y se escuchan entre sí con buena señal.",
+    "Meshtastic es un proyecto de código abierto que usa radios LoRa para crear redes en malla sin "
+    "depender de internet ni de la cobertura móvil. Cada nodo retransmite los mensajes de los demás, de "
+    "modo que la red llega más lejos cuantos más nodos hay. Los mensajes se cifran con la clave del canal "
+    "y cada paquete puede dar unos pocos saltos antes de descartarse. Es muy útil en montaña, en "
+    "emergencias o en eventos donde la red móvil se satura, y el consumo es tan bajo que un nodo con un "
+    "panel solar pequeño puede funcionar durante meses sin mantenimiento. Para empezar basta con una placa "
+    "compatible, una antena adecuada a la banda de tu región y la aplicación del móvil para configurarla.",
+]
+
+# --- Segmentación anterior, reproducida como referencia ---
+
+def legacy_split(text, max_bytes):
+    parts = []
+    current_part = ""
+    for word in text.split():
+        if not current_part:
+            if len(word.encode('utf-8')) > max_bytes:
+                parts.append(word)
+                continue
+            current_part = word
+        elif len((current_part + " " + word).encode('utf-8')) > max_bytes:
+            parts.append(current_part)
+            current_part = word
+        else:
+            current_part += " " + word
+    if current_part:
+        parts.append(current_part)
+    return parts
+
+def payload_bytes(encoder, parts):
+    return sum(len(encoder.encode(part, DESTINATION)[1]) for part in parts)
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    max_payload = mesh_pb2.Constants.DATA_PAYLOAD_LEN
+
+    plain_encoder = textcodec.TextEncoder(MAX_PAYLOAD_LEN, max_payload, enabled=False)
+    print(f"{'respuesta':>9} {'bytes':>6} | {'paquetes':>8} {'carga':>6} | {'comprimido':>10} {'carga':>6}")
+    totals = [0, 0, 0, 0]
+    compressed_encoder = None
+    if textcodec.available():
+        compressed_encoder = textcodec.TextEncoder(MAX_PAYLOAD_LEN, max_payload, capable_nodes=[DESTINATION])
+    for i, reply in enumerate(REPLIES):
+        plain_parts = plain_encoder.split(reply, DESTINATION)
+        row = [len(plain_parts), payload_bytes(plain_encoder, plain_parts)]
+        if compressed_encoder is not None:
+            compressed_parts = compressed_encoder.split(reply, DESTINATION)
+            row += [len(compressed_parts), payload_bytes(compressed_encoder, compressed_parts)]
+            assert all(
+                textcodec.decode_text(*compressed_encoder.encode(part, DESTINATION)) == part for part in compressed_parts
+            )
+        else:
+            row += [0, 0]
+        totals = [total + value for total, value in zip(totals, row)]
+        print(f"{i + 1:>9} {len(reply.encode('utf-8')):>6} | {row[0]:>8} {row[1]:>6} | {row[2]:>10} {row[3]:>6}")
+    print(f"{'total':>9} {'':>6} | {totals[0]:>8} {totals[1]:>6} | {totals[2]:>10} {totals[3]:>6}")
+    if compressed_encoder is None:
+        print("(unishox2-py3 no está instalado: no se puede medir la compresión)")
+    else:
+        print(f"Paquetes: {totals[2]} en vez de {totals[0]} ({100 * (totals[0] - totals[2]) / totals[0]:.0f}% menos). "
+              f"Carga útil: {100 * (totals[1] - totals[3]) / totals[1]:.0f}% menos.")
+
+    long_text = " ".join(REPLIES) * 4
+    assert legacy_split(long_text, MAX_PAYLOAD_LEN) == segmenter.split_text(long_text, MAX_PAYLOAD_LEN)
+    legacy = timeit.timeit(lambda: legacy_split(long_text, MAX_PAYLOAD_LEN), number=iterations)
+    current = timeit.timeit(lambda: segmenter.split_text(long_text, MAX_PAYLOAD_LEN), number=iterations)
+    print(f"\nSegmentación de {len(long_text.encode('utf-8'))} bytes ({iterations} iteraciones):")
+    print(f"  anterior:    {legacy / iterations * 1e6:8.1f} µs")
+    print(f"  segmenter:   {current / iterations * 1e6:8.1f} µs")
+
+if __name__ == '__main__':
+    main()
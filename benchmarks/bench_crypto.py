@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Microbenchmark del coste criptográfico por paquete.
+
+Compara la implementación anterior (que decodificaba la PSK, recalculaba el hash
+del canal y creaba el Cipher con default_backend() en cada paquete) con el registro
+de canales de channels.py, que prepara todo eso una sola vez al arrancar.
+
+Uso (desde la raíz del repositorio):
+    python3 benchmarks/bench_crypto.py [iteraciones]
+"""
+
+import base64
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.backends import default_backend
+import channels
+
+CHANNEL_NAME = "LongFast"
+CHANNEL_KEY_B64 = "AQ=="
+
+# --- Implementación anterior, reproducida como referencia ---
+
+def legacy_generate_channel_hash(name, key_b64):
+    if key_b64 == "AQ==": key_b64 = "1PG7OiApB1nwvP+rz05pAQ=="
+    key_bytes = base64.b64decode(key_b64.encode('ascii'))
+    return channels.xor_hash(bytes(name, 'utf-8')) ^ channels.xor_hash(key_bytes)
+
+def legacy_crypt(key_b64, packet_id, from_node_id, payload_bytes):
+    if key_b64 == "AQ==": key_b64 = "1PG7OiApB1nwvP+rz05pAQ=="
+    key_bytes = base64.b64decode(key_b64.encode('ascii'))
+    nonce = packet_id.to_bytes(8, "little") + from_node_id.to_bytes(8, "little")
+    cipher = Cipher(algorithms.AES(key_bytes), modes.CTR(nonce), backend=default_backend())
+    encryptor = cipher.encryptor()
+    return encryptor.update(payload_bytes) + encryptor.finalize()
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    payload = os.urandom(120)
+    packet_id = random.randint(0, 0xFFFFFFFF)
+    node_id = 0xDEADBEEF
+    channel = channels.Channel(CHANNEL_NAME, CHANNEL_KEY_B64, "msh/EU_868", f"!{node_id:08x}")
+
+    assert legacy_crypt(CHANNEL_KEY_B64, packet_id, node_id, payload) == channel.encrypt(packet_id, node_id, payload)
+    assert legacy_generate_channel_hash(CHANNEL_NAME, CHANNEL_KEY_B64) == channel.hash
+
+    cases = [
+        ("envío (hash + cifrado)",
+         lambda: (legacy_generate_channel_hash(CHANNEL_NAME, CHANNEL_KEY_B64), legacy_crypt(CHANNEL_KEY_B64, packet_id, node_id, payload)),
+         lambda: (channel.hash, channel.encrypt(packet_id, node_id, payload))),
+        ("recepción (descifrado)",
+         lambda: legacy_crypt(CHANNEL_KEY_B64, packet_id, node_id, payload),
+         lambda: channel.decrypt(packet_id, node_id, payload)),
+    ]
+
+    print(f"{iterations} iteraciones, carga útil de {len(payload)} bytes")
+    for name, before, after in cases:
+        before_us = min(timeit.repeat(before, number=iterations, repeat=3)) / iterations * 1e6
+        after_us = min(timeit.repeat(after, number=iterations, repeat=3)) / iterations * 1e6
+        print(f"{name:<26} antes: {before_us:7.2f} µs/paquete   después: {after_us:7.2f} µs/paquete   ({before_us / after_us:.2f}x)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,356 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark de la ingesta de paquetes.
+
+Genera (o carga) un corpus de ServiceEnvelope cifrados con una mezcla realista de
+NODEINFO, POSITION, TELEMETRY y TEXT, con una parte de duplicados como los que
+republican varios gateways, y lo pasa por el manejador real
+(meshbot.process_incoming_meshtastic_packet) con un cliente MQTT falso y una base
+de datos temporal.
+
+Mide el rendimiento (paquetes/s) y la latencia por paquete (p50/p99), desglosada en:
+    parse    decodificación del sobre MQTT
+    dedup    comprobación de duplicados en memoria
+    decrypt  descifrado AES-CTR
+    decode   decodificación del Data y del payload, y lógica del manejador
+    db       llamadas a la base de datos (buffer de escritura diferida)
+    send     respuestas encoladas para enviar (comandos por DM)
+El volcado final del buffer a SQLite se mide aparte (db_flush).
+
+Los resultados se guardan en JSON para poder comparar entre commits.
+
+Uso (desde la raíz del repositorio, con un config.py válido):
+    python3 benchmarks/bench_ingest.py [--packets N] [--nodes N] [--output res.json]
+    python3 benchmarks/bench_ingest.py --save-corpus corpus.bin
+    python3 benchmarks/bench_ingest.py --corpus corpus.bin --compare base.json [--threshold 10]
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import random
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, REPO_DIR)
+
+# La base de datos temporal tiene que estar configurada antes de importar config.
+_TEMP_DIR = tempfile.TemporaryDirectory(prefix="meshbot-bench-")
+os.environ['DATABASE_FILE'] = os.path.join(_TEMP_DIR.name, 'bench.db')
+
+import config
+import database
+import meshbot
+from meshtastic import mesh_pb2, portnums_pb2, telemetry_pb2, BROADCAST_NUM
+
+STAGES = ('parse', 'dedup', 'decrypt', 'decode', 'db', 'send')
+
+# Proporción de cada tipo de paquete entre los paquetes únicos.
+PACKET_MIX = (
+    ('nodeinfo', 0.10),
+    ('position', 0.25),
+    ('telemetry', 0.45),
+    ('text', 0.195),
+    ('command', 0.005),
+)
+# Fracción del corpus que son copias de un paquete reciente llegadas por otro gateway.
+DUPLICATE_RATIO = 0.30
+
+class FakeClient:
+    """Cliente MQTT que solo cuenta las publicaciones."""
+
+    def __init__(self):
+        self.published = 0
+
+    def publish(self, topic, payload, *args, **kwargs):
+        self.published += 1
+
+# --- Corpus ---
+
+def build_payload(kind, node_id, rng):
+    if kind == 'nodeinfo':
+        user = mesh_pb2.User(id=f"!{node_id:08x}", long_name=f"Nodo {node_id & 0xFFFF:04x}", short_name=f"{node_id & 0xFFFF:04x}")
+        return portnums_pb2.NODEINFO_APP, user.SerializeToString(), BROADCAST_NUM
+    if kind == 'position':
+        position = mesh_pb2.Position(
+            latitude_i=int((36 + rng.random() * 7) * 1e7),
+            longitude_i=int((-9 + rng.random() * 12) * 1e7),
+            altitude=rng.randint(0, 2000)
+        )
+        return portnums_pb2.POSITION_APP, position.SerializeToString(), BROADCAST_NUM
+    if kind == 'telemetry':
+        telemetry = telemetry_pb2.Telemetry(time=int(time.time()))
+        if rng.random() < 0.7:
+            telemetry.device_metrics.battery_level = rng.randint(1, 100)
+            telemetry.device_metrics.voltage = 3.3 + rng.random()
+        else:
+            telemetry.environment_metrics.temperature = 10 + rng.random() * 20
+            telemetry.environment_metrics.relative_humidity = 30 + rng.random() * 50
+            telemetry.environment_metrics.barometric_pressure = 990 + rng.random() * 40
+        return portnums_pb2.TELEMETRY_APP, telemetry.SerializeToString(), BROADCAST_NUM
+    if kind == 'text':
+        words = ["hola", "alguien", "escucha", "probando", "desde", "la", "sierra", "buenas", "tardes", "73"]
+        text = " ".join(rng.choice(words) for _ in range(rng.randint(2, 12)))
+        return portnums_pb2.TEXT_MESSAGE_APP, text.encode('utf-8'), BROADCAST_NUM
+    return portnums_pb2.TEXT_MESSAGE_APP, f"{config.COMMAND_PREFIX}ping".encode('utf-8'), config.OUR_NODE_NUMBER
+
+def build_envelope(channel, sender_id, packet_id, port_num, payload, destination):
+    data = mesh_pb2.Data(portnum=port_num, payload=payload)
+    envelope = meshbot.mqtt_pb2.ServiceEnvelope()
+    packet = envelope.packet
+    packet.to = destination
+    setattr(packet, 'from', sender_id)
+    packet.id = packet_id
+    packet.channel = channel.hash
+    packet.hop_limit = 3
+    packet.hop_start = 3
+    packet.encrypted = channel.encrypt(packet_id, sender_id, data.SerializeToString())
+    envelope.channel_id = channel.name
+    envelope.gateway_id = f"!{sender_id ^ 0x5A5A5A5A:08x}"
+    return envelope.SerializeToString()
+
+def generate_corpus(packets, nodes, seed):
+    rng = random.Random(seed)
+    node_ids = [rng.randint(0x10000000, 0xFFFFFFFE) for _ in range(nodes)]
+    channel_list = list(meshbot.CHANNELS)
+    kinds = [kind for kind, _ in PACKET_MIX]
+    weights = [weight for _, weight in PACKET_MIX]
+    corpus = []
+    recent = []
+    for _ in range(packets):
+        if recent and rng.random() < DUPLICATE_RATIO:
+            corpus.append(rng.choice(recent))
+            continue
+        port_num, payload, destination = build_payload(rng.choices(kinds, weights)[0], rng.choice(node_ids), rng)
+        raw = build_envelope(rng.choice(channel_list), rng.choice(node_ids), rng.getrandbits(32), port_num, payload, destination)
+        corpus.append(raw)
+        recent.append(raw)
+        if len(recent) > 50:
+            recent.pop(0)
+    return corpus
+
+def save_corpus(path, corpus):
+    with open(path, 'wb') as f:
+        for raw in corpus:
+            f.write(struct.pack('>I', len(raw)))
+            f.write(raw)
+
+def load_corpus(path):
+    corpus = []
+    with open(path, 'rb') as f:
+        data = f.read()
+    offset = 0
+    while offset < len(data):
+        (length,) = struct.unpack_from('>I', data, offset)
+        offset += 4
+        corpus.append(data[offset:offset + length])
+        offset += length
+    return corpus
+
+# --- Medición por etapas ---
+
+class StageTimer:
+    """Acumula el tiempo de cada etapa dentro del paquete en curso."""
+
+    def __init__(self):
+        self.current = dict.fromkeys(STAGES, 0.0)
+
+    def reset(self):
+        for stage in STAGES:
+            self.current[stage] = 0.0
+
+    def wrap(self, stage, func):
+        current = self.current
+
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                current[stage] += time.perf_counter() - start
+        return timed
+
+def install_timers(timer):
+    """
+    Envuelve las funciones reales del pipeline con medidores de tiempo.
+    parse y decode se calculan por diferencia con el tiempo total de cada fase.
+    """
+    meshbot.PACKET_DEDUP.check_and_add = timer.wrap('dedup', meshbot.PACKET_DEDUP.check_and_add)
+    for channel in meshbot.CHANNELS:
+        channel.decrypt = timer.wrap('decrypt', channel.decrypt)
+    for name in ('add_processed_packet', 'update_node', 'update_node_telemetry'):
+        setattr(database, name, timer.wrap('db', getattr(database, name)))
+    meshbot.OUTBOUND.enqueue = timer.wrap('send', meshbot.OUTBOUND.enqueue)
+
+    phases = {}
+    original_parse = meshbot.parse_service_envelope
+    original_handle = meshbot.handle_service_envelope
+
+    def parse_phase(raw_payload):
+        start = time.perf_counter()
+        try:
+            return original_parse(raw_payload)
+        finally:
+            phases['parse'] = time.perf_counter() - start
+            phases['parse_db'] = timer.current['db']
+
+    def handle_phase(client, se):
+        start = time.perf_counter()
+        try:
+            return original_handle(client, se)
+        finally:
+            phases['handle'] = time.perf_counter() - start
+
+    meshbot.parse_service_envelope = parse_phase
+    meshbot.handle_service_envelope = handle_phase
+    return phases
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+def summarize(samples_us):
+    values = sorted(samples_us)
+    return {
+        'mean_us': sum(values) / len(values) if values else 0.0,
+        'p50_us': percentile(values, 0.50),
+        'p99_us': percentile(values, 0.99),
+        'max_us': values[-1] if values else 0.0,
+    }
+
+def run(corpus):
+    database.init_db()
+    timer = StageTimer()
+    phases = install_timers(timer)
+    client = FakeClient()
+    totals = []
+    stage_samples = {stage: [] for stage in STAGES}
+
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        started = time.perf_counter()
+        for raw in corpus:
+            timer.reset()
+            phases.clear()
+            start = time.perf_counter()
+            meshbot.process_incoming_meshtastic_packet(client, raw, "bench")
+            totals.append((time.perf_counter() - start) * 1e6)
+
+            # Lo medido en etapas propias se descuenta de la fase en la que ocurre.
+            current = dict(timer.current)
+            parse_db = phases.get('parse_db', 0.0)
+            handle_db = current['db'] - parse_db
+            current['parse'] = max(phases.get('parse', 0.0) - current['dedup'] - parse_db, 0.0)
+            current['decode'] = max(phases.get('handle', 0.0) - current['decrypt'] - current['send'] - handle_db, 0.0)
+            for stage in STAGES:
+                stage_samples[stage].append(current[stage] * 1e6)
+        elapsed = time.perf_counter() - started
+
+        flush_start = time.perf_counter()
+        database.flush_pending_writes()
+        flush_time = time.perf_counter() - flush_start
+        meshbot.OUTBOUND.stop()
+        database.close_db()
+
+    return {
+        'packets': len(corpus),
+        'unique': meshbot.PACKET_DEDUP.unique,
+        'duplicates': meshbot.PACKET_DEDUP.duplicates,
+        'replies_queued': meshbot.OUTBOUND.stats()['backlog'] + client.published,
+        'elapsed_s': elapsed,
+        'throughput_pps': len(corpus) / elapsed if elapsed else 0.0,
+        'latency': summarize(totals),
+        'stages': {stage: summarize(samples) for stage, samples in stage_samples.items()},
+        'db_flush_s': flush_time,
+    }
+
+# --- Informe y comparación ---
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR, stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+def print_report(results):
+    print(f"{results['packets']} paquetes ({results['unique']} únicos, {results['duplicates']} duplicados) "
+          f"en {results['elapsed_s']:.2f} s -> {results['throughput_pps']:.0f} paquetes/s")
+    latency = results['latency']
+    print(f"{'total':<8} p50 {latency['p50_us']:8.1f} µs   p99 {latency['p99_us']:8.1f} µs   media {latency['mean_us']:8.1f} µs")
+    for stage in STAGES:
+        summary = results['stages'][stage]
+        print(f"{stage:<8} p50 {summary['p50_us']:8.1f} µs   p99 {summary['p99_us']:8.1f} µs   media {summary['mean_us']:8.1f} µs")
+    print(f"Volcado final a la BD: {results['db_flush_s'] * 1000:.1f} ms")
+
+def compare(results, baseline, threshold_percent):
+    """Imprime la diferencia con una ejecución anterior. Devuelve False si hay una regresión."""
+    print(f"\nComparación con {baseline.get('revision') or 'la referencia'}:")
+    ok = True
+    before, after = baseline['throughput_pps'], results['throughput_pps']
+    change = (after - before) / before * 100 if before else 0.0
+    print(f"{'throughput':<12} {before:10.0f} -> {after:10.0f} paquetes/s ({change:+.1f}%)")
+    if change < -threshold_percent:
+        ok = False
+    for name, old, new in [('total', baseline['latency'], results['latency'])] + [
+            (stage, baseline['stages'].get(stage), results['stages'][stage]) for stage in STAGES]:
+        if not old:
+            continue
+        for key in ('p50_us', 'p99_us'):
+            change = (new[key] - old[key]) / old[key] * 100 if old[key] else 0.0
+            print(f"{name + ' ' + key[:3]:<12} {old[key]:10.1f} -> {new[key]:10.1f} µs ({change:+.1f}%)")
+        if name == 'total' and old['p99_us'] and (new['p99_us'] - old['p99_us']) / old['p99_us'] * 100 > threshold_percent:
+            ok = False
+    print("Sin regresiones." if ok else f"REGRESIÓN: empeora más de un {threshold_percent:.0f}%.")
+    return ok
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de la ingesta de paquetes de MeshBot.")
+    parser.add_argument('--packets', type=int, default=20000, help="Paquetes del corpus generado.")
+    parser.add_argument('--nodes', type=int, default=500, help="Nodos distintos en el corpus generado.")
+    parser.add_argument('--seed', type=int, default=1, help="Semilla del generador del corpus.")
+    parser.add_argument('--corpus', help="Carga el corpus de este fichero en vez de generarlo.")
+    parser.add_argument('--save-corpus', help="Guarda el corpus generado en este fichero y termina.")
+    parser.add_argument('--output', help="Guarda los resultados en este fichero JSON.")
+    parser.add_argument('--compare', help="Compara con los resultados JSON de una ejecución anterior.")
+    parser.add_argument('--threshold', type=float, default=10.0, help="Porcentaje de empeoramiento que se considera regresión.")
+    args = parser.parse_args()
+
+    corpus = load_corpus(args.corpus) if args.corpus else generate_corpus(args.packets, args.nodes, args.seed)
+    if args.save_corpus:
+        save_corpus(args.save_corpus, corpus)
+        print(f"Corpus de {len(corpus)} paquetes guardado en {args.save_corpus}")
+        return 0
+
+    results = run(corpus)
+    results.update({
+        'revision': git_revision(),
+        'date': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'corpus': args.corpus or {'packets': args.packets, 'nodes': args.nodes, 'seed': args.seed},
+        'workers': getattr(config, 'WORKER_THREADS', 4),
+    })
+    print_report(results)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"Resultados guardados en {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if not compare(results, baseline, args.threshold):
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -8,7 +8,13 @@ import requests
 import config
 import database
 import math
+import threading
+import time
 from datetime import datetime
+import metrics
+import topology
+import channels
+from cache import TTLCache
 
 # --- Funciones de Ayuda ---
 
@@ -20,28 +26,83 @@ def haversine(lat1, lon1, lat2, lon2):
     c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
     return R * c
 
-def get_weather_from_api(url):
-    """Función interna para procesar la llamada a la API de OpenWeatherMap."""
+# --- Métricas ---
+COMMANDS_EXECUTED = metrics.counter('meshbot_commands_total', "Comandos ejecutados, por comando.", ('command',))
+WEATHER_LATENCY = metrics.histogram('meshbot_weather_api_seconds', "Duración de las llamadas a la API del tiempo, por resultado.", ('result',))
+WEATHER_API_REQUESTS = metrics.counter('meshbot_weather_api_requests_total', "Llamadas a la API del tiempo.")
+WEATHER_API_ERRORS = metrics.counter('meshbot_weather_api_errors_total', "Llamadas a la API del tiempo que fallaron.")
+WEATHER_CACHE_LOOKUPS = metrics.counter('meshbot_weather_cache_lookups_total', "Consultas a la caché del tiempo, por resultado (hit, miss y stale si la API falló y se sirvió un dato caducado).", ('result',))
+metrics.gauge('meshbot_weather_cache_entries', "Consultas del tiempo guardadas en caché.", func=lambda: len(WEATHER_CACHE))
+
+# --- Proveedor del Tiempo ---
+
+WEATHER_API_URL = "http://api.openweathermap.org/data/2.5/weather"
+# Los resultados se guardan aunque caduquen para poder servirlos si la API falla.
+WEATHER_CACHE = TTLCache(getattr(config, 'WEATHER_CACHE_SIZE', 1000), getattr(config, 'WEATHER_CACHE_TTL_MINUTES', 15) * 60, keep_stale=True)
+_weather_session = None
+_weather_session_lock = threading.Lock()
+
+def get_weather_session():
+    """Sesión HTTP compartida, para reutilizar las conexiones con OpenWeatherMap."""
+    global _weather_session
+    if _weather_session is None:
+        with _weather_session_lock:
+            if _weather_session is None:
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=getattr(config, 'WEATHER_HTTP_POOL_SIZE', 4))
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                _weather_session = session
+    return _weather_session
+
+def weather_cache_key(lat=None, lon=None, city=None):
+    """
+    Clave de caché: el nombre de la ciudad normalizado, o las coordenadas redondeadas
+    a una rejilla de WEATHER_GRID_DEGREES para que los nodos cercanos compartan entrada.
+    """
+    if lat is not None and lon is not None:
+        grid = getattr(config, 'WEATHER_GRID_DEGREES', 0.1)
+        return ('geo', round(lat / grid), round(lon / grid))
+    return ('city', " ".join(city.split()).casefold())
+
+def get_weather_from_api(params):
+    """
+    Función interna para procesar la llamada a la API de OpenWeatherMap.
+    Devuelve (texto, éxito); solo los resultados con éxito se guardan en caché.
+    """
+    started = time.perf_counter()
+    text, ok = _query_weather_api(params)
+    WEATHER_LATENCY.observe(time.perf_counter() - started, result='ok' if ok else 'error')
+    return text, ok
+
+def _query_weather_api(params):
+    WEATHER_API_REQUESTS.inc()
     try:
-        response = requests.get(url)
+        response = get_weather_session().get(
+            WEATHER_API_URL,
+            params=params,
+            timeout=(getattr(config, 'WEATHER_CONNECT_TIMEOUT', 3), getattr(config, 'WEATHER_READ_TIMEOUT', 10))
+        )
         response.raise_for_status()
         data = response.json()
         if str(data.get("cod")) != "200":
-             return f"Error: {data.get('message', 'ubicación no encontrada')}"
+             return f"Error: {data.get('message', 'ubicación no encontrada')}", False
         
         city_name = data.get('name', 'Ubicación desconocida')
         desc = data['weather'][0]['description'].capitalize()
         temp = data['main']['temp']
         sensacion = data['main']['feels_like']
         viento = data['wind']['speed'] * 3.6
-        return f"{city_name}: {desc}, {temp:.0f}C (sens. {sensacion:.0f}C). Viento {viento:.0f}km/h."
+        return f"{city_name}: {desc}, {temp:.0f}C (sens. {sensacion:.0f}C). Viento {viento:.0f}km/h.", True
     except requests.exceptions.HTTPError as e:
-        if e.response.status_code == 401: return "Error: Clave de API del tiempo no válida."
-        if e.response.status_code == 404: return "No encontré la ubicación."
-        return "Error consultando el tiempo."
+        WEATHER_API_ERRORS.inc()
+        if e.response.status_code == 401: return "Error: Clave de API del tiempo no válida.", False
+        if e.response.status_code == 404: return "No encontré la ubicación.", False
+        return "Error consultando el tiempo.", False
     except Exception as e:
+        WEATHER_API_ERRORS.inc()
         print(f"Error en get_weather_from_api: {e}")
-        return "No pude obtener el tiempo en este momento."
+        return "No pude obtener el tiempo en este momento.", False
 
 def format_time_ago(dt_str):
     if not dt_str: return "Nunca"
@@ -71,49 +132,105 @@ def get_weather_data(lat=None, lon=None, city=None):
     if not config.WEATHER_API_KEY or config.WEATHER_API_KEY in ['PON_TU_CLAVE_DE_API_AQUI', '']:
         return "Error: La función de tiempo no está configurada por el administrador."
 
-    base_url = "http://api.openweathermap.org/data/2.5/weather"
     params = {
         "appid": config.WEATHER_API_KEY,
         "units": "metric",
         "lang": "es"
     }
     if lat is not None and lon is not None:
-        params['lat'] = lat
-        params['lon'] = lon
+        # Se consulta el centro de la celda para que la entrada de caché valga para toda ella.
+        key = weather_cache_key(lat=lat, lon=lon)
+        params['lat'] = round(key[1] * getattr(config, 'WEATHER_GRID_DEGREES', 0.1), 4)
+        params['lon'] = round(key[2] * getattr(config, 'WEATHER_GRID_DEGREES', 0.1), 4)
     elif city:
+        key = weather_cache_key(city=city)
         params['q'] = city
     else:
         return "Se necesita una ubicación (coordenadas o ciudad) para obtener el tiempo."
-    
-    full_url = f"{base_url}?{requests.compat.urlencode(params)}"
-    return get_weather_from_api(full_url)
+
+    cached = WEATHER_CACHE.get(key)
+    if cached is not None:
+        WEATHER_CACHE_LOOKUPS.inc(result='hit')
+        return cached[0]
+    WEATHER_CACHE_LOOKUPS.inc(result='miss')
+
+    text, ok = get_weather_from_api(params)
+    if ok:
+        WEATHER_CACHE.set(key, (text, time.time()))
+        return text
+
+    stale = WEATHER_CACHE.get(key, allow_stale=True)
+    if stale is not None:
+        WEATHER_CACHE_LOOKUPS.inc(result='stale')
+        age_minutes = int((time.time() - stale[1]) / 60)
+        return f"{stale[0]} (datos de hace {age_minutes} min)"
+    return text
 
 def get_current_time():
     """Función para que la IA obtenga la hora y fecha actual."""
     now = datetime.now()
     return now.strftime('%H:%M:%S del %d/%m/%Y')
 
+# Número máximo de nombres que se sugieren cuando no se encuentra un nodo.
+MAX_NODE_SUGGESTIONS = 3
+
+def node_not_found_message(name):
+    """Mensaje para un nodo inexistente, con sugerencias de nombres parecidos si las hay."""
+    candidates = database.find_nodes_by_name(name, MAX_NODE_SUGGESTIONS)
+    if not candidates:
+        return f"No encontré ningún nodo con el nombre '{name}'."
+    suggestions = ", ".join(f"@{matched_name}" for _, matched_name, _ in candidates)
+    return f"No encontré el nodo '{name}'. ¿Quisiste decir {suggestions}?"
+
+def find_node(identifier_str):
+    """
+    Busca un nodo por su nombre (@nombre o nombre a secas) o por su ID (!hexid).
+    Devuelve (nodo, None) o (None, mensaje de error) si el ID no es válido o no existe,
+    sugiriendo nombres parecidos cuando se buscaba por nombre.
+    """
+    if identifier_str.startswith('!'):
+        try:
+            node = database.get_node_by_id(int(identifier_str[1:], 16))
+        except (ValueError, TypeError):
+            return None, f"El ID '{identifier_str}' no es válido."
+        if not node:
+            return None, f"No encontré información para el nodo '{identifier_str}'."
+        return node, None
+    name = identifier_str[1:] if identifier_str.startswith('@') else identifier_str
+    node = database.get_node_by_name(name)
+    if not node:
+        return None, node_not_found_message(name)
+    return node, None
+
+def split_node_argument(args, is_option):
+    """
+    Separa los argumentos de un comando en el nodo (@nombre, que puede tener espacios, o !id)
+    y las opciones (métrica, periodo, distancia...) que van delante o detrás de él: las
+    palabras que is_option() reconoce desde cada extremo son opciones y el resto, el nodo.
+    Devuelve (nodo o None, opciones, primer argumento que no se entiende o None).
+    """
+    def option(arg):
+        return not arg.startswith(('@', '!')) and is_option(arg)
+
+    start, end = 0, len(args)
+    while start < end and option(args[start]):
+        start += 1
+    while end > start and option(args[end - 1]):
+        end -= 1
+    rest = args[start:end]
+    if rest and not rest[0].startswith(('@', '!')):
+        return None, [], rest[0]
+    return " ".join(rest) or None, args[:start] + args[end:], None
+
 def get_node_info_for_ai(node_identifier):
     """
     Busca un nodo por su nombre (@nombre) o ID (!hexid) y devuelve su información.
     Esta función está diseñada para ser llamada por la IA.
     """
-    node = None
     identifier_str = str(node_identifier).strip()
-
-    if identifier_str.startswith('@'):
-        node = database.get_node_by_name(identifier_str[1:])
-    elif identifier_str.startswith('!'):
-        try:
-            node_id_int = int(identifier_str[1:], 16)
-            node = database.get_node_by_id(node_id_int)
-        except (ValueError, TypeError):
-            return f"El ID '{identifier_str}' no es válido."
-    else:
-        node = database.get_node_by_name(identifier_str)
-
-    if not node:
-        return f"No encontré información para el nodo '{identifier_str}'."
+    node, error = find_node(identifier_str)
+    if error:
+        return error
 
     node_id_hex = f"!{node['node_id']:08x}"
     response_parts = [f"Datos para {node['long_name']} ({node['short_name']}) [{node_id_hex}]:"]
@@ -146,11 +263,246 @@ def get_node_info_for_ai(node_identifier):
     
     return " ".join(response_parts)
 
+# --- Histórico de Telemetría ---
+
+TELEMETRY_METRIC_ALIASES = {
+    'bateria': 'battery_level', 'batería': 'battery_level', 'bat': 'battery_level', 'battery_level': 'battery_level',
+    'voltaje': 'voltage', 'volt': 'voltage', 'v': 'voltage', 'voltage': 'voltage',
+    'temperatura': 'air_temp', 'temp': 'air_temp', 't': 'air_temp', 'air_temp': 'air_temp',
+    'humedad': 'humidity', 'hum': 'humidity', 'h': 'humidity', 'humidity': 'humidity',
+    'presion': 'barometric_pressure', 'presión': 'barometric_pressure', 'p': 'barometric_pressure', 'barometric_pressure': 'barometric_pressure',
+}
+# Métrica: (etiqueta, unidad, decimales)
+TELEMETRY_METRIC_LABELS = {
+    'battery_level': ('Batería', '%', 0),
+    'voltage': ('Voltaje', 'V', 2),
+    'air_temp': ('Temperatura', '°C', 1),
+    'humidity': ('Humedad', '%', 1),
+    'barometric_pressure': ('Presión', 'hPa', 1),
+}
+PERIOD_UNITS_HOURS = {'h': 1, 'd': 24, 's': 24 * 7}
+
+def parse_period_hours(text):
+    """Convierte '12h', '7d' o '2s' (semanas) en horas. Devuelve None si no es un periodo."""
+    text = text.lower()
+    if len(text) < 2 or text[-1] not in PERIOD_UNITS_HOURS or not text[:-1].isdigit():
+        return None
+    return int(text[:-1]) * PERIOD_UNITS_HOURS[text[-1]]
+
+def format_period(hours):
+    if hours % 24 == 0: return f"{hours // 24}d"
+    return f"{hours}h"
+
+def describe_telemetry_history(node, metric, hours):
+    """Resumen en texto de la evolución de una métrica de un nodo en las últimas horas."""
+    label, unit, decimals = TELEMETRY_METRIC_LABELS[metric]
+    node_name = node['long_name'] or node['short_name'] or f"!{node['node_id']:08x}"
+    start = datetime.now().timestamp() - hours * 3600
+    summary = database.get_telemetry_summary(node['node_id'], metric, start)
+    if not summary:
+        return f"No hay histórico de {label.lower()} para {node_name} en {format_period(hours)}."
+
+    def fmt(value):
+        return f"{value:.{decimals}f}{unit}"
+
+    diff = summary['last'] - summary['first']
+    spread = summary['max'] - summary['min']
+    if spread == 0 or abs(diff) < spread * 0.1:
+        trend = "estable"
+    else:
+        trend = "sube" if diff > 0 else "baja"
+    return (
+        f"{label} de {node_name} ({format_period(hours)}): mín {fmt(summary['min'])}, máx {fmt(summary['max'])}, "
+        f"media {fmt(summary['avg'])}. Tendencia: {trend} ({fmt(summary['first'])} → {fmt(summary['last'])}), "
+        f"{summary['count']} muestras."
+    )
+
+def get_node_telemetry_history_for_ai(node_identifier, metric, hours=24):
+    """
+    Devuelve la evolución de una métrica de telemetría de un nodo (mínimo, máximo, media y tendencia).
+    Esta función está diseñada para ser llamada por la IA.
+    """
+    identifier_str = str(node_identifier).strip()
+    metric_key = TELEMETRY_METRIC_ALIASES.get(str(metric).strip().lower())
+    if metric_key is None:
+        return f"La métrica '{metric}' no existe. Usa: batería, voltaje, temperatura, humedad o presión."
+    try:
+        hours = max(1, int(float(hours)))
+    except (ValueError, TypeError):
+        hours = 24
+    node, error = find_node(identifier_str)
+    if error:
+        return error
+    return describe_telemetry_history(node, metric_key, hours)
+
+# --- Nodos Cercanos ---
+
+# Nodos que se listan como máximo en una respuesta de cercanía.
+MAX_NEARBY_RESULTS = 5
+
+def parse_distance_km(text):
+    """Convierte '10km', '500m' o '10' en kilómetros. Devuelve None si no es una distancia."""
+    text = text.lower().replace(',', '.')
+    for suffix, factor in (('km', 1.0), ('m', 0.001), ('', 1.0)):
+        if text.endswith(suffix):
+            number = text[:len(text) - len(suffix)] if suffix else text
+            try:
+                value = float(number) * factor
+            except ValueError:
+                continue
+            return value if value > 0 else None
+    return None
+
+def format_distance(km):
+    return f"{km * 1000:.0f}m" if km < 1 else f"{km:.1f}km"
+
+def describe_nearby_nodes(center_node, radius_km=None, count=MAX_NEARBY_RESULTS, sensor=None):
+    """Lista de nodos cercanos a un nodo, por radio o los `count` más cercanos."""
+    center_name = center_node['long_name'] or f"!{center_node['node_id']:08x}"
+    results, total = database.find_nodes_near(
+        center_node['latitude'], center_node['longitude'], radius_km=radius_km, limit=count,
+        sensor=sensor, exclude_node_id=center_node['node_id']
+    )
+    sensor_text = f" con {TELEMETRY_METRIC_LABELS[sensor][0].lower()}" if sensor else ""
+    if not results:
+        where = f"a menos de {format_distance(radius_km)} de {center_name}" if radius_km is not None else f"cerca de {center_name}"
+        return f"No conozco nodos{sensor_text} {where}."
+
+    parts = []
+    for node, distance in results:
+        name = node['short_name'] or node['long_name'] or f"!{node['node_id']:08x}"
+        part = f"{name} {format_distance(distance)}"
+        if sensor and node[sensor] is not None:
+            label, unit, decimals = TELEMETRY_METRIC_LABELS[sensor]
+            part += f" ({node[sensor]:.{decimals}f}{unit})"
+        parts.append(part)
+    if radius_km is not None:
+        header = f"{total} nodos{sensor_text} a menos de {format_distance(radius_km)} de {center_name}: "
+    else:
+        header = f"Nodos{sensor_text} más cercanos a {center_name}: "
+    response = header + ", ".join(parts)
+    if total > len(results):
+        response += f" (+{total - len(results)} más)"
+    return response
+
+def get_nearby_nodes_for_ai(sender_id, node_identifier=None, radius_km=None, count=MAX_NEARBY_RESULTS, sensor=None):
+    """
+    Busca los nodos más cercanos a un nodo (por defecto, el del usuario), opcionalmente
+    dentro de un radio y solo los que tienen un sensor concreto.
+    Esta función está diseñada para ser llamada por la IA.
+    """
+    if node_identifier:
+        center_node, error = find_node(str(node_identifier).strip())
+        if error:
+            return error
+    elif sender_id is not None:
+        center_node = database.get_node_by_id(sender_id)
+    else:
+        # Respuesta pública: no se usa la posición de quien pregunta.
+        return "Indica el nodo de referencia."
+    if not center_node or not center_node['latitude']:
+        return "No conozco la ubicación del nodo de referencia."
+    sensor_key = None
+    if sensor:
+        sensor_key = TELEMETRY_METRIC_ALIASES.get(str(sensor).strip().lower())
+        if sensor_key is None:
+            return f"El sensor '{sensor}' no existe. Usa: batería, voltaje, temperatura, humedad o presión."
+    try:
+        radius_km = float(radius_km) if radius_km else None
+        count = min(max(1, int(float(count))), 20)
+    except (ValueError, TypeError):
+        radius_km, count = None, MAX_NEARBY_RESULTS
+    return describe_nearby_nodes(center_node, radius_km, count, sensor_key)
+
+# --- Canales ---
+
+# Registro de los canales configurados; meshbot lo usa para cifrar, descifrar y suscribirse.
+CHANNELS = channels.build_registry(config, f"!{config.OUR_NODE_NUMBER:08x}")
+
+# --- Topología de la Red ---
+
+# Modelo de la malla a partir de los saltos, las pasarelas y la señal de los paquetes recibidos.
+TOPOLOGY = topology.TopologyModel(getattr(config, 'TOPOLOGY_DEFAULT_HOP_LIMIT', 3), getattr(config, 'TOPOLOGY_MAX_HOP_LIMIT', 3),
+                                  getattr(config, 'TOPOLOGY_HOP_MARGIN', 1), getattr(config, 'TOPOLOGY_MIN_SAMPLES', 3))
+MAX_TOPOLOGY_GATEWAYS = 3
+MAX_TOPOLOGY_NEIGHBORS = 5
+
+def short_node_name(node_id):
+    node = database.get_node_by_id(node_id)
+    if node and (node['short_name'] or node['long_name']):
+        return node['short_name'] or node['long_name']
+    return f"!{node_id:08x}"
+
+def format_hops(hops):
+    return "directo" if hops == 0 else f"{hops} salto{'s' if hops != 1 else ''}"
+
+def describe_network():
+    summary = TOPOLOGY.summary()
+    if not summary['nodes']:
+        return "Aún no tengo datos de la topología de la red."
+    response = f"Red: {summary['nodes']} nodos, {summary['gateways']} pasarelas MQTT, {summary['links']} enlaces conocidos."
+    if summary['by_hops']:
+        response += " Nodos por distancia: " + ", ".join(f"{format_hops(hops)}: {count}" for hops, count in summary['by_hops'].items()) + "."
+    return response
+
+def describe_node_topology(node_id, name):
+    info = TOPOLOGY.describe(node_id)
+    if info is None:
+        return f"No tengo datos de topología de {name}."
+    node_id_hex = f"!{node_id:08x}"
+    response_parts = [f"{name}:" if name == node_id_hex else f"{name} [{node_id_hex}]:"]
+    if info['hops'] == 0:
+        response_parts.append(f"lo oye directamente una pasarela (hop_limit {TOPOLOGY.hop_limit_for(node_id)}).")
+    elif info['hops'] is not None:
+        response_parts.append(f"a {format_hops(info['hops'])} de la pasarela más cercana (hop_limit {TOPOLOGY.hop_limit_for(node_id)}).")
+    gateways = []
+    for gateway_id, hops, rssi, snr, _ in info['gateways'][:MAX_TOPOLOGY_GATEWAYS]:
+        details = [format_hops(hops)] if hops is not None else []
+        if rssi is not None: details.append(f"{rssi:.0f}dBm")
+        if snr is not None: details.append(f"SNR {snr:.1f}dB")
+        gateways.append(f"{short_node_name(gateway_id)} ({', '.join(details)})" if details else short_node_name(gateway_id))
+    if gateways:
+        extra = len(info['gateways']) - len(gateways)
+        response_parts.append("Le oyen: " + ", ".join(gateways) + (f" (+{extra} más)" if extra > 0 else "") + ".")
+    neighbors = [
+        f"{short_node_name(neighbor_id)} ({snr:.1f}dB)" if snr is not None else short_node_name(neighbor_id)
+        for neighbor_id, snr in info['neighbors'][:MAX_TOPOLOGY_NEIGHBORS]
+    ]
+    if neighbors:
+        response_parts.append("Vecinos: " + ", ".join(neighbors) + ".")
+    return " ".join(response_parts)
+
+def find_topology_node(identifier_str):
+    """Como find_node, pero un ID (!hexid) vale aunque el nodo no esté en la base de datos. Devuelve (id, nombre, error)."""
+    node, error = find_node(identifier_str)
+    if node:
+        return node['node_id'], node['long_name'] or node['short_name'] or f"!{node['node_id']:08x}", None
+    node_id = topology.parse_node_id(identifier_str)
+    if node_id is not None:
+        return node_id, identifier_str, None
+    return None, None, error
+
+def get_mesh_topology_for_ai(node_identifier=None):
+    """
+    Devuelve la topología de la red: un resumen o, para un nodo, a cuántos saltos está,
+    qué pasarelas lo oyen y con qué señal, y sus vecinos. Diseñada para ser llamada por la IA.
+    """
+    if not node_identifier:
+        return describe_network()
+    node_id, name, error = find_topology_node(str(node_identifier).strip())
+    if error:
+        return error
+    return describe_node_topology(node_id, name)
+
 def command_ping(args, history, sender_id):
     return "Pong!"
 
 def command_info(args, history, sender_id):
-    return f"Soy {config.OUR_LONG_NAME} {config.OUR_SHORT_NAME}, un asistente virtual para el canal '{config.SECONDARY_CHANNEL_NAME}'."
+    names = [channel.name for channel in CHANNELS.with_role(channels.ROLE_INTERACTION)]
+    if len(names) == 1:
+        return f"Soy {config.OUR_LONG_NAME} {config.OUR_SHORT_NAME}, un asistente virtual para el canal '{names[0]}'."
+    channel_list = ", ".join(f"'{name}'" for name in names)
+    return f"Soy {config.OUR_LONG_NAME} {config.OUR_SHORT_NAME}, un asistente virtual para los canales {channel_list}."
 
 def command_ayuda(args, history, sender_id):
     available_commands = [cmd for cmd in COMMANDS.keys() if cmd != 'meshbot'] 
@@ -166,8 +518,10 @@ def command_tiempo(args, history, sender_id):
 
     if args[0].startswith('@'):
         node_name = args[0][1:]
-        target_node = database.get_node_by_name(node_name)
-        if target_node and target_node['latitude']:
+        target_node, error = find_node(args[0])
+        if error:
+            return error
+        if target_node['latitude']:
             return get_weather_data(lat=target_node['latitude'], lon=target_node['longitude'])
         else:
             return f"No conozco la ubicación de '{node_name}'."
@@ -181,8 +535,7 @@ def command_hora(args, history, sender_id):
     return f"La hora actual es: {now.strftime('%H:%M:%S')}"
 
 def command_reset(args, history, sender_id):
-    if sender_id in history:
-        del history[sender_id]
+    if history.reset(sender_id):
         return "Tu historial de conversación con la IA ha sido borrado."
     return "No tenías un historial de conversación para borrar."
 
@@ -197,13 +550,9 @@ def command_nodo(args, history, sender_id):
     if not args:
         return "Por favor, especifica un nombre de nodo. Ej: !nodo @MiNodo"
     
-    node_name = args[0]
-    if node_name.startswith('@'):
-        node_name = node_name[1:]
-    
-    node = database.get_node_by_name(node_name)
-    if not node:
-        return f"No encontré ningún nodo con el nombre '{node_name}'."
+    node, error = find_node(" ".join(args))
+    if error:
+        return error
 
     node_id_hex = f"!{node['node_id']:08x}"
     response = f"Info de {node['long_name']} ({node['short_name']}) [{node_id_hex}]:\n"
@@ -234,6 +583,75 @@ def command_nodo(args, history, sender_id):
     return response.strip()
 
 
+def command_historial(args, history, sender_id):
+    """Muestra la evolución de una métrica de telemetría. Ej: !historial @Nodo Sierra bateria 7d"""
+    metric = 'battery_level'
+    hours = 24
+    node_identifier, options, unknown = split_node_argument(
+        args, lambda arg: arg.lower() in TELEMETRY_METRIC_ALIASES or parse_period_hours(arg) is not None
+    )
+    if unknown is not None:
+        return f"No entiendo '{unknown}'. Ej: {config.COMMAND_PREFIX}historial @MiNodo bateria 7d"
+    for arg in options:
+        if arg.lower() in TELEMETRY_METRIC_ALIASES:
+            metric = TELEMETRY_METRIC_ALIASES[arg.lower()]
+        else:
+            hours = parse_period_hours(arg)
+
+    if node_identifier is None:
+        node = database.get_node_by_id(sender_id)
+        if not node:
+            return "No tengo datos de tu nodo. Indica uno. Ej: !historial @MiNodo"
+    else:
+        node, error = find_node(node_identifier)
+        if error:
+            return error
+
+    return describe_telemetry_history(node, metric, hours)
+
+
+def command_cerca(args, history, sender_id):
+    """Muestra los nodos más cercanos. Ej: !cerca, !cerca 10km, !cerca @Nodo Sierra temperatura"""
+    center_node = None
+    radius_km = None
+    sensor = None
+    node_identifier, options, unknown = split_node_argument(
+        args, lambda arg: arg.lower() in TELEMETRY_METRIC_ALIASES or parse_distance_km(arg) is not None
+    )
+    if unknown is not None:
+        return f"No entiendo '{unknown}'. Ej: {config.COMMAND_PREFIX}cerca @Nodo Sierra 10km temperatura"
+    for arg in options:
+        if arg.lower() in TELEMETRY_METRIC_ALIASES:
+            sensor = TELEMETRY_METRIC_ALIASES[arg.lower()]
+        else:
+            radius_km = parse_distance_km(arg)
+    if node_identifier is not None:
+        center_node, error = find_node(node_identifier)
+        if error:
+            return error
+
+    if center_node is None:
+        center_node = database.get_node_by_id(sender_id)
+        if not center_node or not center_node['latitude']:
+            return "No sé tu ubicación. Compártela o indica un nodo. Ej: !cerca @MiNodo"
+    elif not center_node['latitude']:
+        return f"No conozco la ubicación de '{center_node['long_name']}'."
+
+    return describe_nearby_nodes(center_node, radius_km, MAX_NEARBY_RESULTS, sensor)
+
+
+def command_red(args, history, sender_id):
+    """Muestra la topología de la red o de un nodo. Ej: !red, !red @MiNodo, !red yo"""
+    if not args:
+        return describe_network()
+    if args[0].lower() == 'yo':
+        return describe_node_topology(sender_id, short_node_name(sender_id))
+    node_id, name, error = find_topology_node(" ".join(args))
+    if error:
+        return error
+    return describe_node_topology(node_id, name)
+
+
 # --- Diccionario de Comandos ---
 COMMANDS = {
     'ping': {'function': command_ping, 'description': 'Comprueba si el bot está online.'},
@@ -243,6 +661,9 @@ COMMANDS = {
     'hora': {'function': command_hora, 'description': 'Muestra la hora actual del servidor.'},
     'reset': {'function': command_reset, 'description': 'Borra tu historial de conversación con la IA.'},
     'nodo': {'function': command_nodo, 'description': 'Muestra info detallada de un nodo. Ej: !nodo @MiNodo'},
+    'historial': {'function': command_historial, 'description': 'Muestra la evolución de la telemetría de un nodo. Ej: !historial @MiNodo bateria 7d'},
+    'cerca': {'function': command_cerca, 'description': 'Muestra los nodos más cercanos. Ej: !cerca 10km temperatura'},
+    'red': {'function': command_red, 'description': 'Muestra la topología de la red o de un nodo (saltos, pasarelas, vecinos). Ej: !red @MiNodo'},
     'meshbot': {'function': command_meshbot, 'description': 'Muestra información sobre cómo usar el bot de IA.'}
 }
 
@@ -254,6 +675,8 @@ def handle_command(full_command_text, history, sender_id):
     args = parts[1:]
     
     if command in COMMANDS:
+        COMMANDS_EXECUTED.inc(command=command)
         return COMMANDS[command]['function'](args, history, sender_id)
     else:
+        COMMANDS_EXECUTED.inc(command='desconocido')
         return f"Comando '{command}' desconocido. Usa {config.COMMAND_PREFIX}ayuda."
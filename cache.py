@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""
+Módulo de Caché para MeshBot.
+
+Caché en memoria acotada en número de entradas (LRU) y con caducidad por tiempo,
+segura para usarse desde varios hilos.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+class TTLCache:
+    """
+    Caché LRU con caducidad.
+
+    - maxsize: número máximo de entradas; al superarlo se expulsa la menos usada.
+    - ttl_seconds: segundos de vida de cada entrada.
+    - refresh_on_get: si es True la caducidad se cuenta desde el último acceso
+      (TTL de inactividad); si es False, desde que se guardó el valor.
+    - keep_stale: si es True las entradas caducadas no se borran al leerlas,
+      para poder servirlas con get(..., allow_stale=True) si el origen falla.
+    """
+
+    def __init__(self, maxsize, ttl_seconds, refresh_on_get=False, keep_stale=False):
+        self.maxsize = max(1, maxsize)
+        self.ttl_seconds = ttl_seconds
+        self.refresh_on_get = refresh_on_get
+        self.keep_stale = keep_stale
+        self._lock = threading.RLock()
+        self._data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.stale_hits = 0
+        self.evictions = 0
+
+    def _is_expired(self, expires_at, now):
+        return now >= expires_at
+
+    def _purge_expired(self, now):
+        # Las entradas están ordenadas por último uso, así que las caducadas suelen quedar al principio.
+        while self._data:
+            key, (_, expires_at) = next(iter(self._data.items()))
+            if not self._is_expired(expires_at, now):
+                break
+            if self.keep_stale and len(self._data) < self.maxsize:
+                break
+            del self._data[key]
+            self.evictions += 1
+
+    def get(self, key, default=None, allow_stale=False):
+        now = time.monotonic()
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return default
+            value, expires_at = item
+            if self._is_expired(expires_at, now):
+                if allow_stale:
+                    self.stale_hits += 1
+                    return value
+                if not self.keep_stale:
+                    del self._data[key]
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._data.move_to_end(key)
+            if self.refresh_on_get:
+                self._data[key] = (value, now + self.ttl_seconds)
+            return value
+
+    def set(self, key, value, ttl_seconds=None):
+        now = time.monotonic()
+        ttl = self.ttl_seconds if ttl_seconds is None else ttl_seconds
+        with self._lock:
+            self._data[key] = (value, now + ttl)
+            self._data.move_to_end(key)
+            self._purge_expired(now)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key, default=None):
+        with self._lock:
+            item = self._data.pop(key, None)
+            return default if item is None else item[0]
+
+    def purge_expired(self):
+        with self._lock:
+            self._purge_expired(time.monotonic())
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def items(self):
+        """Copia de las entradas vigentes (clave, valor), sin contar como accesos."""
+        now = time.monotonic()
+        with self._lock:
+            return [(key, value) for key, (value, expires_at) in self._data.items() if not self._is_expired(expires_at, now)]
+
+    def __contains__(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            return item is not None and not self._is_expired(item[1], time.monotonic())
+
+    def __delitem__(self, key):
+        with self._lock:
+            del self._data[key]
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._data),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'stale_hits': self.stale_hits,
+                'evictions': self.evictions,
+            }
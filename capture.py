@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+"""
+Módulo de Captura de Tráfico para MeshBot.
+
+Guarda en disco los mensajes MQTT tal como llegan, para poder reproducirlos más
+tarde (pruebas de carga realistas o análisis de un fallo sin bróker).
+
+Formato de los ficheros: una cabecera MAGIC seguida de registros
+    [timestamp: float64][longitud del topic: uint16][longitud del payload: uint32][topic][payload]
+en big-endian. Las escrituras las hace un hilo en segundo plano, así que capturar
+nunca bloquea la recepción; si la cola se llena, el mensaje no se captura.
+"""
+
+import glob
+import mmap
+import os
+import queue
+import struct
+import threading
+import time
+from datetime import datetime
+
+from logutil import log
+
+MAGIC = b"MBCAP01\n"
+RECORD_HEADER = struct.Struct('>dHI')
+FILE_PREFIX = "capture-"
+FILE_SUFFIX = ".bin"
+
+class CaptureWriter:
+    """
+    Escritor de capturas con rotación: cuando el fichero actual supera max_file_bytes
+    se abre uno nuevo, y solo se conservan los max_files más recientes.
+    """
+
+    def __init__(self, directory, max_file_bytes, max_files, queue_size=10000):
+        self.directory = directory
+        self.max_file_bytes = max_file_bytes
+        self.max_files = max(1, max_files)
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = None
+        self._file = None
+        self._file_bytes = 0
+        self.captured = 0
+        self.dropped = 0
+
+    def start(self):
+        if self._thread is not None:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        self._thread = threading.Thread(target=self._run, name="capture", daemon=True)
+        self._thread.start()
+        log('info', f"Capturando el tráfico MQTT en '{self.directory}'.")
+
+    def write(self, topic, payload):
+        """Encola un mensaje para guardarlo. Nunca bloquea; devuelve False si se descarta."""
+        try:
+            self._queue.put_nowait((time.time(), topic, payload))
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+    def stop(self, timeout=5):
+        if self._thread is None:
+            return
+        self._queue.put(None)
+        self._thread.join(timeout)
+        self._thread = None
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            try:
+                self._write_record(*item)
+                # Se vacía al disco cuando no queda nada pendiente en la cola.
+                if self._queue.empty():
+                    self._file.flush()
+            except Exception as e:
+                log('error', f"Error escribiendo la captura: {e}")
+        self._close_file()
+
+    def _write_record(self, timestamp, topic, payload):
+        topic_bytes = topic.encode('utf-8')
+        if self._file is None or self._file_bytes >= self.max_file_bytes:
+            self._rotate()
+        self._file.write(RECORD_HEADER.pack(timestamp, len(topic_bytes), len(payload)))
+        self._file.write(topic_bytes)
+        self._file.write(payload)
+        self._file_bytes += RECORD_HEADER.size + len(topic_bytes) + len(payload)
+        self.captured += 1
+
+    def _rotate(self):
+        self._close_file()
+        name = f"{FILE_PREFIX}{datetime.now().strftime('%Y%m%d-%H%M%S-%f')}{FILE_SUFFIX}"
+        self._file = open(os.path.join(self.directory, name), 'wb')
+        self._file.write(MAGIC)
+        self._file_bytes = len(MAGIC)
+        for old_file in capture_files(self.directory)[:-self.max_files]:
+            try:
+                os.remove(old_file)
+            except OSError as e:
+                log('error', f"No se pudo borrar la captura antigua '{old_file}': {e}")
+
+    def _close_file(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def stats(self):
+        return {'captured': self.captured, 'dropped': self.dropped, 'pending': self._queue.qsize()}
+
+def capture_files(path):
+    """Ficheros de captura de un directorio (del más antiguo al más reciente), o el propio fichero."""
+    if os.path.isdir(path):
+        return sorted(glob.glob(os.path.join(path, f"{FILE_PREFIX}*{FILE_SUFFIX}")))
+    return [path]
+
+def read_capture(path):
+    """
+    Lee un fichero de captura con mmap y devuelve (timestamp, topic, payload) por cada registro.
+    Un último registro incompleto (p. ej. si el bot se detuvo a mitad de escritura) se ignora.
+    """
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size <= len(MAGIC):
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            if data[:len(MAGIC)] != MAGIC:
+                raise ValueError(f"'{path}' no es un fichero de captura de MeshBot.")
+            offset = len(MAGIC)
+            end = len(data)
+            while offset + RECORD_HEADER.size <= end:
+                timestamp, topic_len, payload_len = RECORD_HEADER.unpack_from(data, offset)
+                offset += RECORD_HEADER.size
+                if offset + topic_len + payload_len > end:
+                    break
+                topic = data[offset:offset + topic_len].decode('utf-8')
+                offset += topic_len
+                payload = data[offset:offset + payload_len]
+                offset += payload_len
+                yield timestamp, topic, payload
+
+def replay(paths, handler, realtime=False, speed=1.0):
+    """
+    Pasa todos los registros de las capturas a handler(topic, payload).
+    Con realtime=True respeta los intervalos originales (divididos por speed);
+    si no, los reproduce tan rápido como sea posible. Devuelve el número de registros.
+    """
+    count = 0
+    first_timestamp = None
+    started = time.monotonic()
+    for path in paths:
+        for file_path in capture_files(path):
+            for timestamp, topic, payload in read_capture(file_path):
+                if realtime:
+                    if first_timestamp is None:
+                        first_timestamp = timestamp
+                    delay = (timestamp - first_timestamp) / speed - (time.monotonic() - started)
+                    if delay > 0:
+                        time.sleep(delay)
+                handler(topic, payload)
+                count += 1
+    return count
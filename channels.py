@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""
+Módulo de Canales para MeshBot.
+
+Construye una sola vez, al arrancar, todo lo que se necesita para cifrar, descifrar
+y publicar en cada canal: la clave decodificada, el hash del canal, los topics MQTT
+y el objeto del algoritmo AES. Por cada paquete solo queda por crear el contexto
+CTR con el nonce correspondiente.
+"""
+
+import base64
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+
+# Clave pública por defecto de Meshtastic, a la que equivale la PSK abreviada "AQ==".
+DEFAULT_KEY_B64 = "1PG7OiApB1nwvP+rz05pAQ=="
+
+# --- Funciones de un canal ---
+ROLE_TELEMETRY = 'telemetry'      # Guarda la información de nodos (nodeinfo, posición, telemetría) recibida en él.
+ROLE_INTERACTION = 'interaction'  # Responde a mensajes, comandos y menciones a @meshbot en él.
+ROLE_PRESENCE = 'presence'        # Anuncia el nodo del bot (nodeinfo y posición) en él.
+ROLE_BROADCAST = 'broadcast'      # Recibe los anuncios automáticos del bot.
+ROLES = (ROLE_TELEMETRY, ROLE_INTERACTION, ROLE_PRESENCE, ROLE_BROADCAST)
+
+def xor_hash(data: bytes) -> int:
+    result = 0
+    for char in data: result ^= char
+    return result
+
+def decode_key(key_b64: str) -> bytes:
+    if key_b64 == "AQ==": key_b64 = DEFAULT_KEY_B64
+    return base64.b64decode(key_b64.encode('ascii'))
+
+def generate_channel_hash(name: str, key_bytes: bytes) -> int:
+    return xor_hash(bytes(name, 'utf-8')) ^ xor_hash(key_bytes)
+
+class Channel:
+    """Un canal Meshtastic con su clave y sus topics ya preparados."""
+
+    def __init__(self, name, key_b64, root_topic, node_id_hex, roles=ROLES):
+        unknown_roles = set(roles) - set(ROLES)
+        if unknown_roles:
+            raise ValueError(f"Funciones de canal desconocidas en '{name}': {', '.join(sorted(unknown_roles))}")
+        self.name = name
+        self.key_b64 = key_b64
+        self.key = decode_key(key_b64)
+        self.hash = generate_channel_hash(name, self.key)
+        self.algorithm = algorithms.AES(self.key)
+        self.publish_topic = f"{root_topic}/2/e/{name}/{node_id_hex}"
+        self.subscribe_topic = f"{root_topic}/2/e/{name}/#"
+        self.roles = frozenset(roles)
+        self.telemetry = ROLE_TELEMETRY in self.roles
+        self.interaction = ROLE_INTERACTION in self.roles
+        self.presence = ROLE_PRESENCE in self.roles
+        self.broadcast = ROLE_BROADCAST in self.roles
+
+    def _apply_keystream(self, packet_id, from_node_id, data):
+        nonce = packet_id.to_bytes(8, "little") + from_node_id.to_bytes(8, "little")
+        context = Cipher(self.algorithm, modes.CTR(nonce)).encryptor()
+        return context.update(data) + context.finalize()
+
+    def encrypt(self, packet_id: int, from_node_id: int, payload_bytes: bytes) -> bytes:
+        return self._apply_keystream(packet_id, from_node_id, payload_bytes)
+
+    def decrypt(self, packet_id: int, from_node_id: int, encrypted_payload: bytes) -> bytes:
+        # En AES-CTR cifrar y descifrar son la misma operación.
+        return self._apply_keystream(packet_id, from_node_id, encrypted_payload)
+
+    def __repr__(self):
+        return f"Channel({self.name!r}, hash={self.hash}, roles={sorted(self.roles)})"
+
+class ChannelRegistry:
+    """
+    Conjunto de canales configurados, indexados por nombre y por hash.
+
+    El hash de canal solo ocupa un byte, así que varios canales pueden compartirlo;
+    por eso el índice por hash guarda una lista de candidatos.
+    """
+
+    def __init__(self, channels=()):
+        self._by_name = {}
+        self._by_hash = {}
+        self._by_role = {role: [] for role in ROLES}
+        for channel in channels:
+            self.add(channel)
+
+    def add(self, channel):
+        if channel.name in self._by_name:
+            raise ValueError(f"El canal '{channel.name}' está configurado dos veces.")
+        self._by_name[channel.name] = channel
+        self._by_hash.setdefault(channel.hash, []).append(channel)
+        for role in channel.roles:
+            self._by_role[role].append(channel)
+
+    def get(self, name):
+        return self._by_name.get(name)
+
+    def candidates(self, channel_id, channel_hash=None):
+        """
+        Canales con los que intentar descifrar un paquete: el que coincide con el
+        channel_id del sobre MQTT o, si no hay ninguno, los que tienen su mismo hash.
+        """
+        channel = self._by_name.get(channel_id)
+        if channel is not None:
+            return (channel,)
+        return self._by_hash.get(channel_hash, ())
+
+    def with_role(self, role):
+        """Canales que tienen una función (p. ej. ROLE_PRESENCE), en el orden de la configuración."""
+        return self._by_role[role]
+
+    def __iter__(self):
+        return iter(self._by_name.values())
+
+    def __len__(self):
+        return len(self._by_name)
+
+def legacy_channel_entries(config):
+    """
+    Canales de un config.py anterior a CHANNELS: el primario y, si está activado, el
+    secundario, con las mismas funciones que tenían entonces.
+    """
+    entries = [{'name': config.PRIMARY_CHANNEL_NAME, 'key': config.PRIMARY_CHANNEL_KEY_B64,
+                'roles': [ROLE_TELEMETRY, ROLE_INTERACTION, ROLE_PRESENCE]}]
+    if getattr(config, 'SECONDARY_CHANNEL_ENABLED', False):
+        entries.append({'name': config.SECONDARY_CHANNEL_NAME, 'key': config.SECONDARY_CHANNEL_KEY_B64,
+                        'roles': list(ROLES)})
+    return entries
+
+def build_registry(config, node_id_hex):
+    """
+    Crea el registro de canales a partir de config.CHANNELS, una lista de diccionarios
+    con 'name', 'key' y opcionalmente 'roles' (por defecto, todas) y 'root_topic'. Si el
+    config.py no define CHANNELS, se usan los canales primario y secundario de siempre.
+    """
+    entries = getattr(config, 'CHANNELS', None)
+    if entries is None:
+        entries = legacy_channel_entries(config)
+    return ChannelRegistry(
+        Channel(
+            entry['name'],
+            entry.get('key', 'AQ=='),
+            entry.get('root_topic', config.ROOT_TOPIC),
+            node_id_hex,
+            entry.get('roles', ROLES)
+        )
+        for entry in entries
+    )
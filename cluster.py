@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""
+Módulo de Reparto entre Procesos para MeshBot.
+
+Permite ejecutar varios procesos de MeshBot contra el mismo bróker. Todos se suscriben
+a los topics de los canales con una suscripción compartida de MQTT v5
+($share/<grupo>/<topic>), así que el bróker entrega cada mensaje a uno solo de ellos.
+Como el bróker no sabe nada de remitentes, el proceso que recibe un paquete de un
+remitente que no le corresponde se lo reenvía a su dueño por un topic interno. Así
+todo lo de un mismo remitente (conversación con la IA, invitaciones a DM, detección
+de duplicados) ocurre siempre en el mismo proceso.
+"""
+
+SHARED_PREFIX = "$share"
+
+class Cluster:
+    """Reparto de remitentes entre worker_count procesos; este proceso es el worker_index."""
+
+    def __init__(self, worker_count, worker_index, group, topic):
+        if worker_count < 1:
+            raise ValueError("WORKER_COUNT debe ser al menos 1.")
+        if not 0 <= worker_index < worker_count:
+            raise ValueError(f"WORKER_INDEX debe estar entre 0 y {worker_count - 1}.")
+        self.worker_count = worker_count
+        self.worker_index = worker_index
+        self.group = group
+        self.topic = topic
+        self.inbox_topic = self.worker_topic(worker_index)
+
+    @property
+    def enabled(self):
+        return self.worker_count > 1
+
+    @property
+    def is_leader(self):
+        """El worker 0 se encarga de las tareas que solo debe hacer uno (presencia, anuncios, limpieza)."""
+        return self.worker_index == 0
+
+    def owner(self, sender_id):
+        """
+        Worker dueño de un remitente. Se mezclan los bits del ID antes del módulo para que
+        el reparto no se correlacione con el de los hilos de cada proceso (sender_id % hilos).
+        """
+        return (((sender_id * 0x9E3779B1) & 0xFFFFFFFF) >> 16) % self.worker_count
+
+    def owns(self, sender_id):
+        return not self.enabled or self.owner(sender_id) == self.worker_index
+
+    def worker_topic(self, worker_index):
+        return f"{self.topic}/{self.group}/worker/{worker_index}"
+
+    def subscription(self, topic):
+        """Topic al que suscribirse: compartido entre los workers si hay más de uno."""
+        return f"{SHARED_PREFIX}/{self.group}/{topic}" if self.enabled else topic
+
+    def is_forwarded(self, topic):
+        return self.enabled and topic == self.inbox_topic
+
+    def forward(self, client, sender_id, payload):
+        """Reenvía al worker dueño del remitente un mensaje tal como llegó del bróker."""
+        client.publish(self.worker_topic(self.owner(sender_id)), payload)
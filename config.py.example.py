@@ -8,6 +8,7 @@ Instrucciones:
    (Especialmente las claves de API y los datos de tu red Meshtastic).
 """
 
+import json
 import os
 
 # --- CONFIGURACIÓN DE LA BASE DE DATOS ---
@@ -17,6 +18,30 @@ DATABASE_FILE = os.getenv('DATABASE_FILE', 'meshbot.db')
 NODE_LIST_HOURS = int(os.getenv('NODE_LIST_HOURS', 24))
 # Días de inactividad tras los cuales un nodo se elimina de la base de datos.
 NODE_DB_CLEANUP_DAYS = int(os.getenv('NODE_DB_CLEANUP_DAYS', 30))
+# Días que se guardan en la BD los paquetes ya procesados (para no repetirlos tras un reinicio).
+PROCESSED_PACKETS_RETENTION_DAYS = int(os.getenv('PROCESSED_PACKETS_RETENTION_DAYS', 7))
+# (Avanzado) Tamaño en grados de las celdas del índice espacial de nodos (0.1 grados ≈ 11 km).
+SPATIAL_GRID_DEGREES = float(os.getenv('SPATIAL_GRID_DEGREES', 0.1))
+# Días que se conserva el histórico de telemetría en cada resolución:
+# muestras en bruto, agregados de 5 minutos, de 1 hora y de 1 día (mínimo, máximo y media).
+TELEMETRY_RAW_RETENTION_DAYS = int(os.getenv('TELEMETRY_RAW_RETENTION_DAYS', 7))
+TELEMETRY_5M_RETENTION_DAYS = int(os.getenv('TELEMETRY_5M_RETENTION_DAYS', 30))
+TELEMETRY_1H_RETENTION_DAYS = int(os.getenv('TELEMETRY_1H_RETENTION_DAYS', 365))
+TELEMETRY_1D_RETENTION_DAYS = int(os.getenv('TELEMETRY_1D_RETENTION_DAYS', 1825))
+# (Avanzado) Ventana en minutos durante la que se reconocen en memoria los paquetes duplicados.
+DEDUP_WINDOW_MINUTES = int(os.getenv('DEDUP_WINDOW_MINUTES', 60))
+# (Avanzado) Número máximo de paquetes recordados en memoria para detectar duplicados.
+DEDUP_MAX_ENTRIES = int(os.getenv('DEDUP_MAX_ENTRIES', 200000))
+# (Avanzado) Los cambios de los nodos y los paquetes procesados se acumulan en memoria y se escriben en lote
+# cada DATABASE_FLUSH_INTERVAL_MS milisegundos o al acumular DATABASE_FLUSH_MAX_RECORDS registros.
+DATABASE_FLUSH_INTERVAL_MS = int(os.getenv('DATABASE_FLUSH_INTERVAL_MS', 2000))
+DATABASE_FLUSH_MAX_RECORDS = int(os.getenv('DATABASE_FLUSH_MAX_RECORDS', 500))
+# (Avanzado) Conexiones de lectura que se mantienen abiertas y se comparten entre hilos.
+DATABASE_READ_CONNECTIONS = int(os.getenv('DATABASE_READ_CONNECTIONS', 4))
+# (Avanzado) Tamaño de la caché de páginas de SQLite por conexión, en KB.
+DATABASE_CACHE_SIZE_KB = int(os.getenv('DATABASE_CACHE_SIZE_KB', 8192))
+# (Avanzado) Tamaño máximo del fichero mapeado en memoria por SQLite, en MB (0 lo desactiva).
+DATABASE_MMAP_SIZE_MB = int(os.getenv('DATABASE_MMAP_SIZE_MB', 64))
 
 
 # --- CONFIGURACIÓN DE ANUNCIOS (BROADCAST) ---
@@ -33,6 +58,9 @@ BROADCAST_MESSAGE = os.getenv('BROADCAST_MESSAGE', '¿Necesitas ayuda o tienes u
 PRESENCE_ENABLED = os.getenv('PRESENCE_ENABLED', 'True').lower() in ('true', '1', 'yes')
 # Intervalo en minutos para anunciar la presencia.
 PRESENCE_INTERVAL_MINUTES = int(os.getenv('PRESENCE_INTERVAL_MINUTES', 720))
+# (Avanzado) Retraso aleatorio máximo, en segundos, que se añade a los anuncios periódicos
+# (presencia y BROADCAST_MESSAGE) para no transmitir siempre en el mismo instante.
+SCHEDULER_JITTER_SECONDS = int(os.getenv('SCHEDULER_JITTER_SECONDS', 30))
 
 
 # --- CONFIGURACIÓN GEOGRÁFICA ---
@@ -69,6 +97,29 @@ SECONDARY_CHANNEL_NAME = os.getenv('SECONDARY_CHANNEL_NAME', 'Iberia')
 # Clave PSK del canal secundario en formato Base64.
 SECONDARY_CHANNEL_KEY_B64 = os.getenv('SECONDARY_CHANNEL_KEY', 'AQ==')
 
+# --- LISTA DE CANALES ---
+# Todos los canales que atiende el bot. Por defecto, el primario y el secundario de arriba,
+# pero puedes añadir tantos como quieras (p. ej. varios canales regionales) para que un
+# solo proceso los atienda todos. Cada canal admite:
+#   'name'       -> nombre del canal.
+#   'key'        -> clave PSK en Base64 ("AQ==" es la clave por defecto).
+#   'roles'      -> funciones del canal (por defecto, todas):
+#                     'telemetry'   guarda la información de los nodos recibida en él.
+#                     'interaction' responde a mensajes, comandos y menciones a @meshbot.
+#                     'presence'    anuncia el nodo del bot (nodeinfo y posición).
+#                     'broadcast'   recibe los anuncios automáticos (BROADCAST_MESSAGE).
+#   'root_topic' -> (Opcional) Root Topic propio, si no es ROOT_TOPIC.
+# También se puede definir con la variable de entorno CHANNELS en formato JSON.
+CHANNELS = [
+    {'name': PRIMARY_CHANNEL_NAME, 'key': PRIMARY_CHANNEL_KEY_B64, 'roles': ['telemetry', 'interaction', 'presence']},
+]
+if SECONDARY_CHANNEL_ENABLED:
+    CHANNELS.append({'name': SECONDARY_CHANNEL_NAME, 'key': SECONDARY_CHANNEL_KEY_B64, 'roles': ['telemetry', 'interaction', 'presence', 'broadcast']})
+# Ejemplo con canales regionales:
+# CHANNELS.append({'name': 'Madrid', 'key': 'AQ==', 'roles': ['telemetry', 'interaction']})
+if os.getenv('CHANNELS'):
+    CHANNELS = json.loads(os.getenv('CHANNELS'))
+
 
 # --- IDENTIDAD DEL BOT ---
 # ¡IMPORTANTE! Elige un número de nodo único para tu bot.
@@ -87,7 +138,135 @@ COMMAND_PREFIX = os.getenv('COMMAND_PREFIX', '!')
 INVITATION_COOLDOWN_MINUTES = int(os.getenv('INVITATION_COOLDOWN_MINUTES', 30))
 
 
+# --- CONFIGURACIÓN DE RENDIMIENTO ---
+# Número de hilos que procesan los paquetes entrantes (IA, comandos, base de datos).
+# Los paquetes de un mismo remitente siempre van al mismo hilo y mantienen su orden.
+WORKER_THREADS = int(os.getenv('WORKER_THREADS', 4))
+# Paquetes pendientes que admite cada hilo antes de empezar a descartar.
+WORKER_QUEUE_SIZE = int(os.getenv('WORKER_QUEUE_SIZE', 500))
+
+
+# --- CONFIGURACIÓN MULTIPROCESO ---
+# Número de procesos de MeshBot que se reparten el tráfico (1 = un único proceso).
+# Con más de uno, cada proceso se arranca con su propio WORKER_INDEX (0, 1, ...), todos con la
+# misma base de datos, y el bróker debe admitir MQTT v5 con suscripciones compartidas (p. ej. mosquitto 2.x).
+# El worker 0 es el único que envía la presencia y los anuncios y que limpia la base de datos.
+WORKER_COUNT = int(os.getenv('WORKER_COUNT', 1))
+WORKER_INDEX = int(os.getenv('WORKER_INDEX', 0))
+# Grupo de la suscripción compartida ($share/<grupo>/...).
+CLUSTER_GROUP = os.getenv('CLUSTER_GROUP', 'meshbot')
+# Topic base por el que los workers se reenvían los paquetes de los remitentes que no les corresponden.
+CLUSTER_TOPIC = os.getenv('CLUSTER_TOPIC', 'meshbot-cluster')
+# Cada cuántos segundos incorpora cada worker los nodos que han guardado los demás en la base de datos.
+CLUSTER_INDEX_REFRESH_SECONDS = int(os.getenv('CLUSTER_INDEX_REFRESH_SECONDS', 10))
+
+
+# --- CONFIGURACIÓN DE TRANSMISIÓN ---
+# Parámetros del preset LoRa de la malla, usados para estimar el tiempo en el aire de cada paquete.
+# Los valores por defecto corresponden a LongFast (SF11, 250 kHz, CR 4/5).
+LORA_SPREADING_FACTOR = int(os.getenv('LORA_SPREADING_FACTOR', 11))
+LORA_BANDWIDTH_KHZ = float(os.getenv('LORA_BANDWIDTH_KHZ', 250))
+# Denominador de la tasa de codificación 4/x (5 a 8).
+LORA_CODING_RATE = int(os.getenv('LORA_CODING_RATE', 5))
+# Porcentaje máximo de tiempo en el aire que el bot puede ocupar en cada canal.
+OUTBOUND_DUTY_CYCLE_PERCENT = float(os.getenv('OUTBOUND_DUTY_CYCLE_PERCENT', 10))
+# Ventana en segundos sobre la que se permite acumular ese porcentaje (tamaño máximo de una ráfaga).
+OUTBOUND_AIRTIME_WINDOW_SECONDS = int(os.getenv('OUTBOUND_AIRTIME_WINDOW_SECONDS', 600))
+# Separación mínima en segundos entre dos paquetes del bot en el mismo canal.
+OUTBOUND_MIN_INTERVAL_SECONDS = float(os.getenv('OUTBOUND_MIN_INTERVAL_SECONDS', 1.5))
+# Número máximo de paquetes esperando a ser transmitidos.
+OUTBOUND_MAX_BACKLOG = int(os.getenv('OUTBOUND_MAX_BACKLOG', 200))
+# Saltos (hop_limit) de los paquetes que envía el bot. Los mensajes directos usan los saltos que han
+# necesitado los paquetes recientes del destinatario más TOPOLOGY_HOP_MARGIN, sin pasar de
+# TOPOLOGY_MAX_HOP_LIMIT; hasta reunir TOPOLOGY_MIN_SAMPLES paquetes suyos, y en los anuncios y
+# mensajes al canal, se usa TOPOLOGY_DEFAULT_HOP_LIMIT.
+TOPOLOGY_DEFAULT_HOP_LIMIT = int(os.getenv('TOPOLOGY_DEFAULT_HOP_LIMIT', 3))
+TOPOLOGY_MAX_HOP_LIMIT = int(os.getenv('TOPOLOGY_MAX_HOP_LIMIT', 3))
+TOPOLOGY_HOP_MARGIN = int(os.getenv('TOPOLOGY_HOP_MARGIN', 1))
+TOPOLOGY_MIN_SAMPLES = int(os.getenv('TOPOLOGY_MIN_SAMPLES', 3))
+# Horas sin ver un nodo, una pasarela o un enlace tras las que se olvida en el modelo de la red.
+TOPOLOGY_MAX_AGE_HOURS = int(os.getenv('TOPOLOGY_MAX_AGE_HOURS', 24))
+# Segundos que se espera la confirmación de entrega (ACK) de cada parte de un mensaje directo antes de
+# reenviarla; la espera se multiplica por DELIVERY_BACKOFF_FACTOR en cada reintento. Solo se reenvían
+# las partes que no se han confirmado, y solo a nodos cuyos ACK ya nos han llegado alguna vez.
+DELIVERY_ACK_TIMEOUT_SECONDS = float(os.getenv('DELIVERY_ACK_TIMEOUT_SECONDS', 45))
+DELIVERY_MAX_RETRIES = int(os.getenv('DELIVERY_MAX_RETRIES', 2))  # 0 = no reenviar nunca
+DELIVERY_BACKOFF_FACTOR = float(os.getenv('DELIVERY_BACKOFF_FACTOR', 2))
+# (Avanzado) Cada cuántos segundos se revisan los mensajes pendientes de confirmación.
+DELIVERY_CHECK_SECONDS = int(os.getenv('DELIVERY_CHECK_SECONDS', 5))
+# Envía los mensajes directos comprimidos (TEXT_MESSAGE_COMPRESSED_APP, Unishox2) a los nodos que
+# los admiten: ocupan menos y las respuestas largas necesitan menos paquetes. Requiere el paquete
+# opcional unishox2-py3. Los mensajes al canal se envían siempre sin comprimir.
+TEXT_COMPRESSION_ENABLED = os.getenv('TEXT_COMPRESSION_ENABLED', 'True').lower() in ('true', '1', 'yes')
+# Nodos que admiten texto comprimido, separados por comas (p. ej. "!a1b2c3d4,!0badc0de"). Además
+# se incluye automáticamente cualquier nodo que nos envíe un mensaje comprimido.
+TEXT_COMPRESSION_NODES = [node_id.strip() for node_id in os.getenv('TEXT_COMPRESSION_NODES', '').split(',') if node_id.strip()]
+
+
 # --- CONFIGURACIÓN DE IA Y APIS EXTERNAS ---
 # ¡IMPORTANTE! Introduce aquí tus claves de API.
 GEMINI_API_KEY = os.getenv('GEMINI_API_KEY', 'PON_TU_CLAVE_DE_GEMINI_AQUI')
 WEATHER_API_KEY = os.getenv('WEATHER_API_KEY', 'PON_TU_CLAVE_DE_OPENWEATHERMAP_AQUI')
+# Minutos que se reutiliza una consulta del tiempo antes de volver a pedirla a la API.
+WEATHER_CACHE_TTL_MINUTES = int(os.getenv('WEATHER_CACHE_TTL_MINUTES', 15))
+# Número máximo de ubicaciones guardadas en la caché del tiempo.
+WEATHER_CACHE_SIZE = int(os.getenv('WEATHER_CACHE_SIZE', 1000))
+# Tamaño en grados de la rejilla con la que se agrupan coordenadas cercanas (0.1 ≈ 11 km).
+WEATHER_GRID_DEGREES = float(os.getenv('WEATHER_GRID_DEGREES', 0.1))
+# Tiempos máximos de espera (segundos) para conectar con la API del tiempo y para recibir la respuesta.
+WEATHER_CONNECT_TIMEOUT = float(os.getenv('WEATHER_CONNECT_TIMEOUT', 3))
+WEATHER_READ_TIMEOUT = float(os.getenv('WEATHER_READ_TIMEOUT', 10))
+# Conexiones HTTP que se mantienen abiertas con la API del tiempo.
+WEATHER_HTTP_POOL_SIZE = int(os.getenv('WEATHER_HTTP_POOL_SIZE', 4))
+# Número máximo de conversaciones con la IA que se mantienen en memoria.
+CONVERSATION_CACHE_SIZE = int(os.getenv('CONVERSATION_CACHE_SIZE', 500))
+# Minutos de inactividad tras los que la conversación de un usuario sale de memoria
+# (sigue guardada en la base de datos y se vuelve a cargar con su siguiente mensaje).
+CONVERSATION_IDLE_MINUTES = int(os.getenv('CONVERSATION_IDLE_MINUTES', 60))
+# Días sin actividad tras los que se borra de la base de datos la conversación de un usuario.
+CONVERSATION_RETENTION_DAYS = int(os.getenv('CONVERSATION_RETENTION_DAYS', 30))
+# Turnos (pregunta y respuesta) que se envían tal cual a la IA en cada mensaje; los anteriores
+# se resumen en segundo plano y la IA solo recibe su resumen.
+CONVERSATION_MAX_TURNS = int(os.getenv('CONVERSATION_MAX_TURNS', 6))
+# Tokens aproximados que puede ocupar el historial de una conversación (resumen incluido).
+# Si se superan, se resumen también los turnos más antiguos, aunque no se haya llegado a CONVERSATION_MAX_TURNS.
+CONVERSATION_TOKEN_BUDGET = int(os.getenv('CONVERSATION_TOKEN_BUDGET', 2000))
+# Envía la respuesta de la IA a medida que se genera: cada parte sale en cuanto está completa,
+# numeradas como "1+:", "2+:"... y la última con el total ("3/3:"), en vez de esperar a la respuesta entera.
+AI_STREAMING_ENABLED = os.getenv('AI_STREAMING_ENABLED', 'False').lower() in ('true', '1', 'yes')
+# Caché de respuestas a las consultas públicas a @meshbot: la misma pregunta en el mismo canal
+# se responde desde la caché sin volver a consultar a la IA. Las preguntas en primera persona
+# ("mi nodo", "dónde estoy") no se guardan nunca.
+RESPONSE_CACHE_ENABLED = os.getenv('RESPONSE_CACHE_ENABLED', 'True').lower() in ('true', '1', 'yes')
+RESPONSE_CACHE_SIZE = int(os.getenv('RESPONSE_CACHE_SIZE', 200))
+# Segundos que se guarda una respuesta según el tipo de pregunta.
+RESPONSE_CACHE_TTL_SECONDS = {
+    'time': 30,          # La hora o la fecha.
+    'weather': 600,      # El tiempo.
+    'nodes': 120,        # Datos de nodos concretos.
+    'identity': 86400,   # Quién es el bot.
+    'general': 1800,     # Conocimiento general.
+}
+# Si la misma pregunta ya se respondió en el canal hace menos de estos segundos, no se vuelve
+# a difundir: solo se avisa por DM a quien pregunta.
+RESPONSE_CACHE_REPEAT_SECONDS = int(os.getenv('RESPONSE_CACHE_REPEAT_SECONDS', 300))
+# (Avanzado) Hilos que ejecutan las funciones que pide la IA (el tiempo, nodos...). Las que pide
+# en una misma respuesta se ejecutan a la vez, y cada una tiene como máximo AI_TOOL_TIMEOUT_SECONDS.
+AI_TOOL_THREADS = int(os.getenv('AI_TOOL_THREADS', 8))
+AI_TOOL_TIMEOUT_SECONDS = float(os.getenv('AI_TOOL_TIMEOUT_SECONDS', 15))
+
+
+# --- CONFIGURACIÓN DE CAPTURA DE TRÁFICO ---
+# Si es True, guarda todos los mensajes MQTT recibidos en CAPTURE_DIR para reproducirlos con: python3 meshbot.py --replay <fichero o directorio>
+CAPTURE_ENABLED = os.getenv('CAPTURE_ENABLED', 'False').lower() in ('true', '1', 'yes')
+CAPTURE_DIR = os.getenv('CAPTURE_DIR', 'captures')
+# Tamaño máximo en MB de cada fichero de captura y número de ficheros que se conservan (los más antiguos se borran).
+CAPTURE_MAX_FILE_MB = int(os.getenv('CAPTURE_MAX_FILE_MB', 64))
+CAPTURE_MAX_FILES = int(os.getenv('CAPTURE_MAX_FILES', 10))
+
+# --- CONFIGURACIÓN DE MÉTRICAS ---
+# Si es True, publica métricas en formato Prometheus en http://METRICS_HOST:METRICS_PORT/metrics
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'False').lower() in ('true', '1', 'yes')
+# Dirección en la que escucha el servidor de métricas (127.0.0.1 = solo accesible desde la propia máquina).
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', 9464))
@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+"""
+Módulo de Memoria de Conversaciones para MeshBot.
+
+Cada mensaje a la IA lleva consigo el historial de la conversación, así que si se
+guarda entero cada consulta de un usuario habitual es más lenta y más cara que la
+anterior. Aquí se acota: se conservan literalmente los últimos turnos, los más
+antiguos se resumen en segundo plano en un resumen acumulado, y de cada turno ya
+respondido se quitan las llamadas a funciones y sus resultados (la respuesta final
+ya los recoge). Además, cada conversación tiene un presupuesto aproximado de tokens.
+
+El estado de cada conversación (resumen y últimos turnos, en JSON comprimido) se
+guarda en la base de datos después de cada turno, sin esperar a la escritura. En
+memoria solo quedan los usuarios activos: al reiniciar, o tras olvidarse por
+inactividad, la conversación se vuelve a cargar con el siguiente mensaje del usuario.
+"""
+
+import json
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import google.generativeai as genai
+
+import database
+from cache import TTLCache
+from logutil import log
+
+# Estimación aproximada de tokens a partir del texto (sin llamar a la API).
+CHARS_PER_TOKEN = 4
+SUMMARY_PREFIX = "Resumen de la conversación anterior con este usuario: "
+SUMMARY_ACK = "Entendido."
+
+def content_text(content):
+    return " ".join(part.text for part in content.parts if part.text)
+
+def estimate_tokens(contents):
+    return sum(len(content_text(content)) for content in contents) // CHARS_PER_TOKEN
+
+def strip_tool_parts(content):
+    """Copia del mensaje solo con sus partes de texto, o None si no tiene ninguna."""
+    parts = [genai.protos.Part(text=part.text) for part in content.parts if part.text]
+    if not parts:
+        return None
+    return genai.protos.Content(role=content.role, parts=parts)
+
+def format_transcript(turns):
+    lines = []
+    for turn in turns:
+        for content in turn:
+            speaker = "Usuario" if content.role == 'user' else "MeshBot"
+            lines.append(f"{speaker}: {content_text(content)}")
+    return "\n".join(lines)
+
+def serialize_turns(turns):
+    """Turnos en formato compacto para la base de datos: JSON [[[rol, texto], ...], ...] comprimido con zlib."""
+    if not turns:
+        return None
+    data = [[[content.role, content_text(content)] for content in turn] for turn in turns]
+    return zlib.compress(json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8'))
+
+def deserialize_turns(blob):
+    if not blob:
+        return []
+    data = json.loads(zlib.decompress(blob).decode('utf-8'))
+    return [
+        [genai.protos.Content(role=role, parts=[genai.protos.Part(text=text)]) for role, text in turn]
+        for turn in data
+    ]
+
+class Conversation:
+    """
+    Conversación de un usuario: su sesión de chat, el resumen acumulado y los últimos turnos
+    (cada turno es la lista de mensajes, ya sin llamadas a funciones, de una pregunta y su respuesta).
+    """
+
+    def __init__(self, chat, summary="", turns=None, sender_id=None):
+        self.chat = chat
+        self.sender_id = sender_id
+        self.summary = summary
+        self.turns = list(turns or [])
+        self._pending = []
+        self._summarizing = False
+        self._deleted = False
+        self._base_len = 0
+        self._lock = threading.Lock()
+
+    def _summary_contents(self):
+        if not self.summary:
+            return []
+        return [
+            genai.protos.Content(role='user', parts=[genai.protos.Part(text=SUMMARY_PREFIX + self.summary)]),
+            genai.protos.Content(role='model', parts=[genai.protos.Part(text=SUMMARY_ACK)]),
+        ]
+
+    def begin(self):
+        """Prepara el historial de la sesión antes de enviar un mensaje: resumen y últimos turnos."""
+        with self._lock:
+            history = self._summary_contents() + [content for turn in self.turns for content in turn]
+        self.chat.history = history
+        self._base_len = len(history)
+
+    def commit(self):
+        """Guarda como un turno nuevo lo que se ha añadido a la sesión desde begin()."""
+        turn = [content for content in map(strip_tool_parts, self.chat.history[self._base_len:]) if content is not None]
+        if turn:
+            with self._lock:
+                self.turns.append(turn)
+
+    def rollback(self):
+        """Deshace el turno a medias (p. ej. una llamada a función sin respuesta)."""
+        self.chat.history = self.chat.history[:self._base_len]
+
+    def tokens(self):
+        with self._lock:
+            return estimate_tokens(self._summary_contents()) + sum(estimate_tokens(turn) for turn in self.turns)
+
+    def is_empty(self):
+        with self._lock:
+            return not self.summary and not self.turns and not self._pending
+
+    def snapshot(self):
+        """(resumen, turnos) para guardar. Incluye los turnos que aún esperan a resumirse."""
+        return self.summary, self._pending + self.turns
+
+class ConversationMemory:
+    """
+    Política de memoria de las conversaciones. summarize(resumen_anterior, transcripción) devuelve
+    el resumen nuevo; se llama desde un hilo propio, nunca mientras el usuario espera su respuesta.
+    Si se indica, on_summary(conversación) se llama cada vez que cambia un resumen.
+    """
+
+    def __init__(self, max_turns, token_budget, summarize):
+        self.max_turns = max(1, max_turns)
+        self.token_budget = token_budget
+        self.summarize = summarize
+        # El resumen se limita a una cuarta parte del presupuesto.
+        self.max_summary_chars = token_budget * CHARS_PER_TOKEN // 4
+        # Turnos por resumir que se conservan como mucho si la IA falla al resumir.
+        self.max_pending_turns = self.max_turns * 4
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="conversation-summary")
+        self.on_summary = None
+        self.summaries = 0
+        self.errors = 0
+
+    def trim(self, conversation):
+        """Aparta los turnos que sobran (por número o por presupuesto de tokens) y los manda resumir."""
+        with conversation._lock:
+            turns = conversation.turns
+            tokens = sum(estimate_tokens(turn) for turn in turns) + len(conversation.summary) // CHARS_PER_TOKEN
+            while len(turns) > self.max_turns or (len(turns) > 1 and tokens > self.token_budget):
+                turn = turns.pop(0)
+                tokens -= estimate_tokens(turn)
+                conversation._pending.append(turn)
+            if conversation._pending and not conversation._summarizing:
+                conversation._summarizing = True
+                self._executor.submit(self._summarize, conversation)
+
+    def _summarize(self, conversation):
+        with conversation._lock:
+            pending, conversation._pending = conversation._pending, []
+            previous = conversation.summary
+        try:
+            summary = (self.summarize(previous, format_transcript(pending)) or "").strip()
+        except Exception as e:
+            self.errors += 1
+            log('error', f"No se pudo resumir la conversación: {e}")
+            with conversation._lock:
+                conversation._pending = (pending + conversation._pending)[-self.max_pending_turns:]
+                conversation._summarizing = False
+            return
+        with conversation._lock:
+            self.summaries += 1
+            conversation.summary = summary[:self.max_summary_chars]
+            if conversation._pending:
+                self._executor.submit(self._summarize, conversation)
+            else:
+                conversation._summarizing = False
+        if self.on_summary is not None:
+            self.on_summary(conversation)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+class ConversationStore:
+    """
+    Conversaciones de todos los usuarios. Las de los usuarios activos se mantienen en memoria
+    (hasta cache_size, y se olvidan tras idle_seconds sin mensajes); las demás se cargan de la
+    base de datos al pedirlas. new_chat() crea la sesión de chat de una conversación cargada o nueva.
+    """
+
+    def __init__(self, memory, cache_size, idle_seconds, new_chat):
+        self.memory = memory
+        self.new_chat = new_chat
+        self._cache = TTLCache(cache_size, idle_seconds, refresh_on_get=True)
+        self.loads = 0
+        memory.on_summary = self.save
+
+    def get(self, sender_id):
+        """Conversación de un usuario: de memoria, de la base de datos o una nueva."""
+        user_conversation = self._cache.get(sender_id)
+        if user_conversation is None:
+            user_conversation = self._load(sender_id)
+            self._cache.set(sender_id, user_conversation)
+        return user_conversation
+
+    def _load(self, sender_id):
+        stored = database.load_conversation(sender_id)
+        if stored is None:
+            return Conversation(self.new_chat(), sender_id=sender_id)
+        summary, blob = stored
+        try:
+            turns = deserialize_turns(blob)
+        except Exception as e:
+            log('error', f"No se pudo leer la conversación guardada de !{sender_id:08x}: {e}")
+            turns = []
+        self.loads += 1
+        user_conversation = Conversation(self.new_chat(), summary, turns, sender_id)
+        # Los límites pueden haber cambiado desde que se guardó.
+        self.memory.trim(user_conversation)
+        return user_conversation
+
+    def save(self, conversation):
+        """Guarda el estado de una conversación (la escritura en disco es diferida)."""
+        with conversation._lock:
+            if conversation._deleted:
+                # Un resumen que termina después de un !reset no debe resucitar la conversación.
+                return
+            summary, turns = conversation.snapshot()
+            database.save_conversation(conversation.sender_id, summary, serialize_turns(turns))
+
+    def discard(self, sender_id):
+        """Olvida la copia en memoria; la próxima vez se carga lo último que se guardó."""
+        self._cache.pop(sender_id)
+
+    def reset(self, sender_id):
+        """Borra la conversación de un usuario. Devuelve si tenía algo que borrar."""
+        user_conversation = self._cache.pop(sender_id)
+        if user_conversation is not None:
+            existed = not user_conversation.is_empty()
+            with user_conversation._lock:
+                user_conversation._deleted = True
+        else:
+            stored = database.load_conversation(sender_id)
+            existed = stored is not None and bool(stored[0] or stored[1])
+        if existed:
+            database.save_conversation(sender_id, "", None)
+        return existed
+
+    def last_invitation(self, sender_id):
+        return database.get_last_invitation(sender_id)
+
+    def set_last_invitation(self, sender_id, sent_at):
+        database.set_last_invitation(sender_id, sent_at)
+
+    def __len__(self):
+        return len(self._cache)
+
+    def stats(self):
+        stats = self._cache.stats()
+        stats['loads'] = self.loads
+        return stats
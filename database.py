@@ -3,243 +3,929 @@
 Módulo de Base de Datos para MeshBot.
 
 Gestiona la base de datos SQLite para la persistencia de datos,
-como los IDs de los mensajes ya procesados y la información de los nodos de la red.
+como los paquetes ya procesados y la información de los nodos de la red.
 """
 
+import functools
+import queue
 import sqlite3
+import threading
+import time
+from contextlib import contextmanager
 import config
+import metrics
+import node_index
+import spatial
 from datetime import datetime, timedelta
 
+DB_LATENCY = metrics.histogram('meshbot_db_call_seconds', "Duración de las llamadas a la base de datos, por operación.", ('operation',))
+DB_FLUSH_LATENCY = metrics.histogram('meshbot_db_flush_seconds', "Duración de cada volcado del buffer de escritura diferida.")
+DB_FLUSH_RECORDS = metrics.counter('meshbot_db_flushed_records_total', "Registros escritos por el buffer de escritura diferida.")
+
+def _timed(func):
+    """Registra la duración de cada llamada a la función en el histograma de la base de datos."""
+    operation = func.__name__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            DB_LATENCY.observe(time.perf_counter() - started, operation=operation)
+    return wrapper
+
 def get_db_connection():
-    """Crea y devuelve una conexión a la base de datos."""
-    conn = sqlite3.connect(config.DATABASE_FILE)
+    """
+    Crea y devuelve una conexión a la base de datos en modo WAL y con los PRAGMA de rendimiento.
+    La conexión puede usarse desde cualquier hilo, pero solo desde uno a la vez.
+    """
+    conn = sqlite3.connect(
+        config.DATABASE_FILE,
+        timeout=30,
+        check_same_thread=False,
+        cached_statements=256
+    )
     conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute("PRAGMA temp_store = MEMORY")
+    conn.execute(f"PRAGMA cache_size = {-int(getattr(config, 'DATABASE_CACHE_SIZE_KB', 8192))}")
+    conn.execute(f"PRAGMA mmap_size = {int(getattr(config, 'DATABASE_MMAP_SIZE_MB', 64)) * 1024 * 1024}")
     return conn
 
+class ConnectionManager:
+    """
+    Mantiene abiertas una única conexión de escritura, protegida por un lock,
+    y un pequeño pool de conexiones de lectura compartidas entre hilos.
+    Al reutilizar las conexiones, sqlite3 reutiliza también las sentencias
+    ya preparadas de su caché en lugar de volver a analizarlas.
+    """
+
+    def __init__(self, reader_pool_size):
+        self._reader_pool_size = max(1, reader_pool_size)
+        self._write_lock = threading.RLock()
+        self._pool_lock = threading.Lock()
+        self._writer = None
+        self._readers = queue.LifoQueue()
+        self._all_readers = []
+
+    @contextmanager
+    def write(self):
+        """Entrega la conexión de escritura dentro de una transacción (commit o rollback al salir)."""
+        with self._write_lock:
+            if self._writer is None:
+                self._writer = get_db_connection()
+            try:
+                yield self._writer
+                self._writer.commit()
+            except Exception:
+                self._writer.rollback()
+                raise
+
+    @contextmanager
+    def read(self):
+        """Presta una conexión de lectura del pool, creándola si aún no se ha alcanzado el límite."""
+        conn = None
+        try:
+            conn = self._readers.get_nowait()
+        except queue.Empty:
+            with self._pool_lock:
+                if len(self._all_readers) < self._reader_pool_size:
+                    conn = get_db_connection()
+                    self._all_readers.append(conn)
+            if conn is None:
+                conn = self._readers.get()
+        try:
+            yield conn
+        finally:
+            self._readers.put(conn)
+
+    def close(self):
+        with self._write_lock:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+        with self._pool_lock:
+            for conn in self._all_readers:
+                conn.close()
+            self._all_readers = []
+            self._readers = queue.LifoQueue()
+
+_connections = ConnectionManager(getattr(config, 'DATABASE_READ_CONNECTIONS', 4))
+
+def _fetchone(conn, query, params=()):
+    # Se cierra el cursor para liberar la instantánea de lectura de WAL.
+    cursor = conn.execute(query, params)
+    try:
+        return cursor.fetchone()
+    finally:
+        cursor.close()
+
+def _fetchall(conn, query, params=()):
+    cursor = conn.execute(query, params)
+    try:
+        return cursor.fetchall()
+    finally:
+        cursor.close()
+
+NODE_FIELDS = (
+    'long_name', 'short_name', 'latitude', 'longitude', 'altitude',
+    'battery_level', 'voltage', 'air_temp', 'humidity', 'barometric_pressure'
+)
+
+_NODE_UPSERT_SQL = (
+    f"INSERT INTO nodes (node_id, {', '.join(NODE_FIELDS)}, last_seen) "
+    f"VALUES ({', '.join('?' * (len(NODE_FIELDS) + 2))}) "
+    "ON CONFLICT(node_id) DO UPDATE SET "
+    + ", ".join(f"{field} = COALESCE(excluded.{field}, nodes.{field})" for field in NODE_FIELDS)
+    + ", last_seen = MAX(excluded.last_seen, nodes.last_seen)"
+)
+
+_PROCESSED_PACKET_UPSERT_SQL = (
+    "INSERT INTO processed_packets (sender_id, packet_id, timestamp) VALUES (?, ?, ?) "
+    "ON CONFLICT(sender_id, packet_id) DO UPDATE SET timestamp = excluded.timestamp"
+)
+
+_CONVERSATION_UPSERT_SQL = (
+    "INSERT INTO conversations (sender_id, summary, turns, updated_at) VALUES (?, ?, ?, ?) "
+    "ON CONFLICT(sender_id) DO UPDATE SET summary = excluded.summary, turns = excluded.turns, updated_at = excluded.updated_at"
+)
+
+_INVITATION_UPSERT_SQL = (
+    "INSERT INTO conversations (sender_id, summary, last_invitation_sent, updated_at) VALUES (?, '', ?, ?) "
+    "ON CONFLICT(sender_id) DO UPDATE SET last_invitation_sent = excluded.last_invitation_sent, updated_at = excluded.updated_at"
+)
+
+# --- Histórico de telemetría ---
+TELEMETRY_METRICS = ('battery_level', 'voltage', 'air_temp', 'humidity', 'barometric_pressure')
+
+# Resoluciones del histórico, de la más fina a la más gruesa: (nombre, tabla, segundos por cubo).
+# Las muestras en bruto no tienen cubo fijo; se estima una cada minuto para elegir resolución.
+TELEMETRY_RESOLUTIONS = (
+    ('raw', 'telemetry_samples', 60),
+    ('5m', 'telemetry_5m', 300),
+    ('1h', 'telemetry_1h', 3600),
+    ('1d', 'telemetry_1d', 86400),
+)
+
+def _telemetry_retention_days(resolution):
+    return {
+        'raw': getattr(config, 'TELEMETRY_RAW_RETENTION_DAYS', 7),
+        '5m': getattr(config, 'TELEMETRY_5M_RETENTION_DAYS', 30),
+        '1h': getattr(config, 'TELEMETRY_1H_RETENTION_DAYS', 365),
+        '1d': getattr(config, 'TELEMETRY_1D_RETENTION_DAYS', 1825),
+    }[resolution]
+
+_TELEMETRY_SAMPLE_SQL = (
+    "INSERT OR IGNORE INTO telemetry_samples (node_id, metric, timestamp, value) VALUES (?, ?, ?, ?)"
+)
+
+def _telemetry_rollup_sql(table):
+    return (
+        f"INSERT INTO {table} (node_id, metric, bucket, min_value, max_value, sum_value, sample_count) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?) "
+        "ON CONFLICT(node_id, metric, bucket) DO UPDATE SET "
+        f"min_value = MIN({table}.min_value, excluded.min_value), "
+        f"max_value = MAX({table}.max_value, excluded.max_value), "
+        f"sum_value = {table}.sum_value + excluded.sum_value, "
+        f"sample_count = {table}.sample_count + excluded.sample_count"
+    )
+
+def _write_telemetry_samples(conn, samples):
+    """
+    Guarda las muestras en bruto y las acumula en las tablas de 5 minutos, 1 hora y 1 día.
+    Los agregados se calculan primero en memoria para escribir una sola fila por cubo y lote.
+
+    Si llegan dos muestras de la misma métrica y nodo en el mismo segundo solo cuenta la
+    primera, también entre lotes distintos (un duplicado tardío, un lote que se reintenta
+    tras un fallo): solo se acumulan las muestras que la tabla en bruto no tenía ya.
+    """
+    unique = {}
+    for sample in samples:
+        unique.setdefault(sample[:3], sample)
+    samples = [sample for sample in unique.values() if conn.execute(_TELEMETRY_SAMPLE_SQL, sample).rowcount]
+    for _, table, bucket_seconds in TELEMETRY_RESOLUTIONS[1:]:
+        buckets = {}
+        for node_id, metric, timestamp, value in samples:
+            key = (node_id, metric, timestamp - timestamp % bucket_seconds)
+            current = buckets.get(key)
+            if current is None:
+                buckets[key] = [value, value, value, 1]
+            else:
+                current[0] = min(current[0], value)
+                current[1] = max(current[1], value)
+                current[2] += value
+                current[3] += 1
+        conn.executemany(_telemetry_rollup_sql(table), [key + tuple(values) for key, values in buckets.items()])
+
+class WriteBehindBuffer:
+    """
+    Buffer de escritura diferida.
+
+    Los cambios de los nodos se combinan en memoria por node_id (el último valor de
+    cada campo gana y last_seen se queda con el máximo). Los paquetes procesados y las
+    muestras de telemetría simplemente se acumulan. De las conversaciones y de las
+    invitaciones a DM solo se guarda el último estado de cada usuario. Un hilo en
+    segundo plano lo vuelca todo en una única transacción, cada cierto intervalo o en cuanto se acumulan suficientes registros.
+    """
+
+    def __init__(self, flush_interval_ms, max_records):
+        self.flush_interval = flush_interval_ms / 1000.0
+        self.max_records = max(1, max_records)
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pending = {}
+        self._flushing = {}
+        self._pending_packets = []
+        self._pending_samples = []
+        self._flushing_samples = []
+        self._pending_conversations = {}
+        self._flushing_conversations = {}
+        self._pending_invitations = {}
+        self._flushing_invitations = {}
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+        self.flushes = 0
+        self.records_flushed = 0
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name="db-writer", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Detiene el hilo y vuelca todo lo pendiente."""
+        if self._thread is not None:
+            self._stopping.set()
+            self._wakeup.set()
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def merge(self, node_id, last_seen, fields):
+        with self._lock:
+            entry = self._pending.get(node_id)
+            if entry is None:
+                entry = self._pending[node_id] = {'last_seen': last_seen}
+            elif last_seen > entry['last_seen']:
+                entry['last_seen'] = last_seen
+            entry.update(fields)
+            pending_count = len(self._pending)
+        if pending_count >= self.max_records:
+            self._wakeup.set()
+
+    def append_packet(self, sender_id, packet_id, timestamp):
+        with self._lock:
+            self._pending_packets.append((sender_id, packet_id, timestamp))
+            pending_count = len(self._pending_packets)
+        if pending_count >= self.max_records:
+            self._wakeup.set()
+
+    def append_samples(self, samples):
+        with self._lock:
+            self._pending_samples.extend(samples)
+            pending_count = len(self._pending_samples)
+        if pending_count >= self.max_records:
+            self._wakeup.set()
+
+    def put_conversation(self, sender_id, summary, turns, updated_at):
+        with self._lock:
+            self._pending_conversations[sender_id] = (summary, turns, updated_at)
+        self._wakeup.set()
+
+    def put_invitation(self, sender_id, sent_at):
+        with self._lock:
+            self._pending_invitations[sender_id] = sent_at
+
+    def pending_conversation(self, sender_id):
+        """Último estado aún no volcado de una conversación (summary, turns, updated_at), o None."""
+        with self._lock:
+            return self._pending_conversations.get(sender_id) or self._flushing_conversations.get(sender_id)
+
+    def pending_invitation(self, sender_id):
+        with self._lock:
+            return self._pending_invitations.get(sender_id) or self._flushing_invitations.get(sender_id)
+
+    def pending_samples(self, node_id, metric):
+        """Muestras de telemetría aún no volcadas de una métrica de un nodo, como (timestamp, valor)."""
+        with self._lock:
+            return [
+                (timestamp, value)
+                for sample_node, sample_metric, timestamp, value in self._flushing_samples + self._pending_samples
+                if sample_node == node_id and sample_metric == metric
+            ]
+
+    def pending_for(self, node_id):
+        """Cambios aún no volcados de un nodo (incluido el lote que se está escribiendo), o None."""
+        with self._lock:
+            flushing = self._flushing.get(node_id)
+            pending = self._pending.get(node_id)
+            if flushing is None and pending is None:
+                return None
+            return _merge_entries(flushing, pending)
+
+    def pending_items(self):
+        with self._lock:
+            node_ids = set(self._flushing) | set(self._pending)
+            return [(node_id, _merge_entries(self._flushing.get(node_id), self._pending.get(node_id))) for node_id in node_ids]
+
+    def flush(self):
+        """Escribe todos los cambios pendientes en una sola transacción. Devuelve el número de registros escritos."""
+        with self._flush_lock:
+            with self._lock:
+                if (not self._pending and not self._pending_packets and not self._pending_samples
+                        and not self._pending_conversations and not self._pending_invitations):
+                    return 0
+                self._flushing, self._pending = self._pending, {}
+                batch = self._flushing
+                packets, self._pending_packets = self._pending_packets, []
+                self._flushing_samples, self._pending_samples = self._pending_samples, []
+                samples = self._flushing_samples
+                self._flushing_conversations, self._pending_conversations = self._pending_conversations, {}
+                conversations = self._flushing_conversations
+                self._flushing_invitations, self._pending_invitations = self._pending_invitations, {}
+                invitations = self._flushing_invitations
+
+            rows = [
+                (node_id,) + tuple(entry.get(field) for field in NODE_FIELDS) + (entry['last_seen'],)
+                for node_id, entry in batch.items()
+            ]
+            started = time.perf_counter()
+            try:
+                with _connections.write() as conn:
+                    if rows:
+                        conn.executemany(_NODE_UPSERT_SQL, rows)
+                    if packets:
+                        conn.executemany(_PROCESSED_PACKET_UPSERT_SQL, packets)
+                    if samples:
+                        _write_telemetry_samples(conn, samples)
+                    if conversations:
+                        conn.executemany(_CONVERSATION_UPSERT_SQL, [(sender_id,) + state for sender_id, state in conversations.items()])
+                    if invitations:
+                        conn.executemany(_INVITATION_UPSERT_SQL, [(sender_id, sent_at, sent_at) for sender_id, sent_at in invitations.items()])
+            except Exception as e:
+                print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] [  ERROR  ] Error volcando escrituras diferidas a la BD: {e}")
+                with self._lock:
+                    # Se devuelven al buffer sin pisar los cambios que hayan llegado mientras tanto.
+                    for node_id, entry in batch.items():
+                        self._pending[node_id] = _merge_entries(entry, self._pending.get(node_id))
+                    self._flushing = {}
+                    self._pending_packets = packets + self._pending_packets
+                    self._pending_samples = samples + self._pending_samples
+                    self._flushing_samples = []
+                    self._pending_conversations = {**conversations, **self._pending_conversations}
+                    self._flushing_conversations = {}
+                    self._pending_invitations = {**invitations, **self._pending_invitations}
+                    self._flushing_invitations = {}
+                return 0
+
+            with self._lock:
+                self._flushing = {}
+                self._flushing_samples = []
+                self._flushing_conversations = {}
+                self._flushing_invitations = {}
+            written = len(rows) + len(packets) + len(samples) + len(conversations) + len(invitations)
+            DB_FLUSH_LATENCY.observe(time.perf_counter() - started)
+            DB_FLUSH_RECORDS.inc(written)
+            self.flushes += 1
+            self.records_flushed += written
+            return written
+
+    def _run(self):
+        while not self._stopping.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+def _merge_entries(older, newer):
+    if older is None:
+        return dict(newer)
+    merged = dict(older)
+    if newer is not None:
+        last_seen = max(older['last_seen'], newer['last_seen'])
+        merged.update(newer)
+        merged['last_seen'] = last_seen
+    return merged
+
+_write_buffer = WriteBehindBuffer(getattr(config, 'DATABASE_FLUSH_INTERVAL_MS', 2000), getattr(config, 'DATABASE_FLUSH_MAX_RECORDS', 500))
+# Índice en memoria de los nombres de los nodos; se carga en init_db y se mantiene desde update_node.
+_name_index = node_index.NameIndex()
+# Máscara de sensores (spatial.SENSOR_FLAGS) de cada nodo, calculada en SQL.
+_SENSOR_MASK_SQL = " + ".join(
+    f"(CASE WHEN {metric} IS NOT NULL THEN {flag} ELSE 0 END)" for metric, flag in spatial.SENSOR_FLAGS.items()
+)
+# Momento de la última carga de los índices desde la base de datos (ver refresh_indexes).
+_indexes_refreshed_at = None
+# Índice espacial en memoria de las posiciones de los nodos, para consultas de cercanía.
+_spatial_index = spatial.SpatialIndex(getattr(config, 'SPATIAL_GRID_DEGREES', 0.1))
+
+def _apply_pending(row, node_id):
+    """Devuelve el nodo como diccionario con los cambios aún no volcados aplicados encima."""
+    pending = _write_buffer.pending_for(node_id)
+    if pending is None:
+        return dict(row) if row is not None else None
+    node = dict(row) if row is not None else dict.fromkeys(('node_id',) + NODE_FIELDS + ('last_seen',))
+    node['node_id'] = node_id
+    for field in NODE_FIELDS:
+        if pending.get(field) is not None:
+            node[field] = pending[field]
+    last_seen = pending['last_seen'].isoformat(" ")
+    if node['last_seen'] is None or last_seen > node['last_seen']:
+        node['last_seen'] = last_seen
+    return node
+
+def flush_pending_writes():
+    """Fuerza el volcado inmediato de las escrituras diferidas."""
+    return _write_buffer.flush()
+
+def close_db():
+    """Vuelca las escrituras pendientes y cierra todas las conexiones abiertas."""
+    _write_buffer.stop()
+    _connections.close()
+
 def init_db():
     """
     Inicializa la base de datos. Crea las tablas si no existen.
     """
-    conn = get_db_connection()
-    try:
-        # MODIFICADO: Añadimos campo para la presión barométrica
-        conn.execute('''
-            CREATE TABLE IF NOT EXISTS nodes (
-                node_id INTEGER PRIMARY KEY,
-                long_name TEXT,
-                short_name TEXT,
-                latitude REAL,
-                longitude REAL,
-                altitude INTEGER,
-                battery_level REAL,
-                voltage REAL,
-                air_temp REAL,
-                humidity REAL,
-                barometric_pressure REAL,
-                last_seen DATETIME NOT NULL
-            )
-        ''')
-        conn.execute('''
-            CREATE TABLE IF NOT EXISTS processed_messages (
-                id INTEGER PRIMARY KEY,
-                message_uid INTEGER NOT NULL UNIQUE,
-                timestamp DATETIME NOT NULL
-            )
-        ''')
-        conn.commit()
-        print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] [  INFO   ] Base de datos '{config.DATABASE_FILE}' inicializada correctamente.")
+    try:
+        with _connections.write() as conn:
+            # MODIFICADO: Añadimos campo para la presión barométrica
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS nodes (
+                    node_id INTEGER PRIMARY KEY,
+                    long_name TEXT,
+                    short_name TEXT,
+                    latitude REAL,
+                    longitude REAL,
+                    altitude INTEGER,
+                    battery_level REAL,
+                    voltage REAL,
+                    air_temp REAL,
+                    humidity REAL,
+                    barometric_pressure REAL,
+                    last_seen DATETIME NOT NULL
+                )
+            ''')
+            # Sustituye a la antigua tabla processed_messages, que no tenía en cuenta el remitente.
+            conn.execute("DROP TABLE IF EXISTS processed_messages")
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS processed_packets (
+                    sender_id INTEGER NOT NULL,
+                    packet_id INTEGER NOT NULL,
+                    timestamp DATETIME NOT NULL,
+                    PRIMARY KEY (sender_id, packet_id)
+                ) WITHOUT ROWID
+            ''')
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_processed_packets_timestamp ON processed_packets (timestamp)")
+            # Histórico de telemetría: muestras en bruto (una fila por métrica) y agregados por cubo de tiempo.
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS telemetry_samples (
+                    node_id INTEGER NOT NULL,
+                    metric TEXT NOT NULL,
+                    timestamp INTEGER NOT NULL,
+                    value REAL NOT NULL,
+                    PRIMARY KEY (node_id, metric, timestamp)
+                ) WITHOUT ROWID
+            ''')
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_telemetry_samples_timestamp ON telemetry_samples (timestamp)")
+            for _, table, _ in TELEMETRY_RESOLUTIONS[1:]:
+                conn.execute(f'''
+                    CREATE TABLE IF NOT EXISTS {table} (
+                        node_id INTEGER NOT NULL,
+                        metric TEXT NOT NULL,
+                        bucket INTEGER NOT NULL,
+                        min_value REAL NOT NULL,
+                        max_value REAL NOT NULL,
+                        sum_value REAL NOT NULL,
+                        sample_count INTEGER NOT NULL,
+                        PRIMARY KEY (node_id, metric, bucket)
+                    ) WITHOUT ROWID
+                ''')
+            # Estado de las conversaciones con la IA: resumen, últimos turnos (comprimidos) e invitaciones a DM.
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS conversations (
+                    sender_id INTEGER PRIMARY KEY,
+                    summary TEXT NOT NULL DEFAULT '',
+                    turns BLOB,
+                    last_invitation_sent DATETIME,
+                    updated_at DATETIME NOT NULL
+                )
+            ''')
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_conversations_updated_at ON conversations (updated_at)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_nodes_long_name ON nodes (long_name COLLATE NOCASE)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_nodes_short_name ON nodes (short_name COLLATE NOCASE)")
+            _name_index.load(_fetchall(conn, "SELECT node_id, long_name, short_name FROM nodes"))
+            _spatial_index.load(_fetchall(conn, f"SELECT node_id, latitude, longitude, {_SENSOR_MASK_SQL} FROM nodes"))
+        global _indexes_refreshed_at
+        _indexes_refreshed_at = datetime.now()
+        _write_buffer.start()
+        print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] [  INFO   ] Base de datos '{config.DATABASE_FILE}' inicializada correctamente ({len(_name_index)} nodos con nombre, {len(_spatial_index)} con posición).")
     except Exception as e:
         print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] [  ERROR  ] Error inicializando la base de datos: {e}")
-    finally:
-        conn.close()
 
-def update_node(node_id, long_name=None, short_name=None, lat=None, lon=None, alt=None):
+def refresh_indexes():
     """
-    Añade o actualiza la información de un nodo en la base de datos.
+    Incorpora a los índices en memoria los nodos que otros procesos han guardado en la
+    base de datos compartida desde la última llamada. Solo hace falta con varios procesos.
+    Se relee un margen hacia atrás porque cada proceso vuelca sus cambios con retraso.
     """
-    conn = get_db_connection()
+    global _indexes_refreshed_at
+    started = datetime.now()
+    since = (_indexes_refreshed_at or started) - timedelta(milliseconds=getattr(config, 'DATABASE_FLUSH_INTERVAL_MS', 2000), seconds=10)
     try:
-        now = datetime.now()
-        conn.execute(
-            "INSERT OR IGNORE INTO nodes (node_id, last_seen) VALUES (?, ?)",
-            (node_id, now)
-        )
-        conn.execute("UPDATE nodes SET last_seen = ? WHERE node_id = ?", (now, node_id))
+        with _connections.read() as conn:
+            rows = _fetchall(
+                conn,
+                f"SELECT node_id, long_name, short_name, latitude, longitude, {_SENSOR_MASK_SQL} AS sensors FROM nodes WHERE last_seen >= ?",
+                (since,)
+            )
+        for row in rows:
+            if row['long_name'] is not None and row['short_name'] is not None:
+                _name_index.update(row['node_id'], row['long_name'], row['short_name'])
+            if row['sensors']:
+                _spatial_index.add_sensors(row['node_id'], [metric for metric, flag in spatial.SENSOR_FLAGS.items() if row['sensors'] & flag])
+            if row['latitude'] is not None and row['longitude'] is not None:
+                _spatial_index.update(row['node_id'], row['latitude'], row['longitude'])
+        _indexes_refreshed_at = started
+    except Exception as e:
+        print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] [  ERROR  ] Error actualizando los índices de nodos: {e}")
 
+@_timed
+def update_node(node_id, long_name=None, short_name=None, lat=None, lon=None, alt=None):
+    """
+    Añade o actualiza la información de un nodo. El cambio se guarda en el buffer
+    de escritura diferida y se vuelca a la base de datos en el siguiente lote.
+    """
+    try:
+        fields = {}
         if long_name is not None and short_name is not None:
-            conn.execute(
-                "UPDATE nodes SET long_name = ?, short_name = ? WHERE node_id = ?",
-                (long_name, short_name, node_id)
-            )
-        
+            fields['long_name'] = long_name
+            fields['short_name'] = short_name
+            _name_index.update(node_id, long_name, short_name)
         if lat is not None and lon is not None:
-            conn.execute(
-                "UPDATE nodes SET latitude = ?, longitude = ?, altitude = ? WHERE node_id = ?",
-                (lat, lon, alt, node_id)
-            )
-        
-        conn.commit()
+            fields['latitude'] = lat
+            fields['longitude'] = lon
+            fields['altitude'] = alt
+            _spatial_index.update(node_id, lat, lon)
+        _write_buffer.merge(node_id, datetime.now(), fields)
     except Exception as e:
         print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] [  ERROR  ] Error actualizando nodo en la BD: {e}")
-    finally:
-        conn.close()
 
 # MODIFICADO: Se añade el parámetro para la presión barométrica
+@_timed
 def update_node_telemetry(node_id, battery_level=None, voltage=None, air_temp=None, humidity=None, barometric_pressure=None):
     """
-    Actualiza los datos de telemetría de un nodo existente.
+    Actualiza los datos de telemetría de un nodo (a través del buffer de escritura diferida).
     """
-    conn = get_db_connection()
     try:
+        values = {
+            'battery_level': battery_level,
+            'voltage': voltage,
+            'air_temp': air_temp,
+            'humidity': humidity,
+            'barometric_pressure': barometric_pressure
+        }
+        fields = {field: value for field, value in values.items() if value is not None}
         now = datetime.now()
-        conn.execute(
-            "INSERT OR IGNORE INTO nodes (node_id, last_seen) VALUES (?, ?)",
-            (node_id, now)
-        )
-        
-        fields_to_update = []
-        params = []
-        
-        if battery_level is not None:
-            fields_to_update.append("battery_level = ?")
-            params.append(battery_level)
-        if voltage is not None:
-            fields_to_update.append("voltage = ?")
-            params.append(voltage)
-        if air_temp is not None:
-            fields_to_update.append("air_temp = ?")
-            params.append(air_temp)
-        if humidity is not None:
-            fields_to_update.append("humidity = ?")
-            params.append(humidity)
-        if barometric_pressure is not None:
-            fields_to_update.append("barometric_pressure = ?")
-            params.append(barometric_pressure)
-
-        if fields_to_update:
-            fields_to_update.append("last_seen = ?")
-            params.append(now)
-            
-            query = f"UPDATE nodes SET {', '.join(fields_to_update)} WHERE node_id = ?"
-            params.append(node_id)
-            
-            conn.execute(query, tuple(params))
-            conn.commit()
-
+        _write_buffer.merge(node_id, now, fields)
+        _spatial_index.add_sensors(node_id, fields)
+        timestamp = int(now.timestamp())
+        _write_buffer.append_samples([(node_id, metric, timestamp, float(value)) for metric, value in fields.items()])
     except Exception as e:
         print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] [  ERROR  ] Error actualizando telemetría del nodo: {e}")
-    finally:
-        conn.close()
 
 
+@_timed
 def get_node_by_name(name):
     """
-    Busca un nodo en la base de datos por su nombre largo o corto.
+    Busca un nodo por su nombre largo o corto, sin distinguir mayúsculas ni acentos.
+    Usa el índice de nombres en memoria, que ya incluye los cambios aún no volcados.
     """
-    conn = get_db_connection()
     try:
-        cursor = conn.cursor()
-        cursor.execute(
-            "SELECT * FROM nodes WHERE long_name = ? COLLATE NOCASE OR short_name = ? COLLATE NOCASE",
-            (name, name)
-        )
-        return cursor.fetchone()
+        if _name_index.loaded:
+            node_ids = _name_index.find_exact(name)
+            return get_node_by_id(node_ids[0]) if node_ids else None
+
+        with _connections.read() as conn:
+            row = _fetchone(
+                conn,
+                "SELECT * FROM nodes WHERE long_name = ? COLLATE NOCASE OR short_name = ? COLLATE NOCASE",
+                (name, name)
+            )
+        return _apply_pending(row, row['node_id']) if row is not None else None
     except Exception as e:
         print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] [  ERROR  ] Error buscando nodo por nombre: {e}")
         return None
-    finally:
-        conn.close()
 
+@_timed
+def find_nodes_by_name(query, limit=5):
+    """
+    Busca nodos cuyo nombre coincide exactamente, empieza por la búsqueda o se le parece.
+    Devuelve una lista de (nodo, nombre coincidente, tipo de coincidencia) ordenada de mejor a peor.
+    """
+    try:
+        results = []
+        for match in _name_index.search(query, limit):
+            node = get_node_by_id(match.node_id)
+            if node is not None:
+                results.append((node, match.name, match.kind))
+        return results
+    except Exception as e:
+        print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] [  ERROR  ] Error buscando nodos parecidos: {e}")
+        return []
+
+@_timed
+def find_nodes_near(lat, lon, radius_km=None, limit=10, sensor=None, exclude_node_id=None):
+    """
+    Busca los nodos más cercanos a un punto usando el índice espacial.
+    Con radius_km devuelve los que están dentro del radio; si no, los `limit` más cercanos.
+    sensor (p. ej. 'air_temp') limita la búsqueda a nodos que han enviado esa métrica.
+    Devuelve (lista de (nodo, distancia en km) con como mucho `limit` elementos, total encontrado).
+    """
+    try:
+        sensor_mask = spatial.SENSOR_FLAGS.get(sensor, 0) if sensor else 0
+        if radius_km is not None:
+            matches = _spatial_index.within(lat, lon, radius_km, sensor_mask, exclude_node_id)
+        else:
+            matches = _spatial_index.nearest(lat, lon, limit, sensor_mask, exclude_node_id)
+        results = []
+        for node_id, distance in matches[:limit]:
+            node = get_node_by_id(node_id)
+            if node is not None:
+                results.append((node, distance))
+        return results, len(matches)
+    except Exception as e:
+        print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] [  ERROR  ] Error buscando nodos cercanos: {e}")
+        return [], 0
+
+def count_nodes():
+    """Número de nodos guardados en la base de datos (los nuevos aparecen tras el siguiente volcado)."""
+    try:
+        with _connections.read() as conn:
+            return _fetchone(conn, "SELECT COUNT(*) FROM nodes")[0]
+    except Exception as e:
+        print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] [  ERROR  ] Error contando nodos: {e}")
+        return 0
+
+@_timed
 def get_node_by_id(node_id):
     """
     Busca un nodo en la base de datos por su ID numérico.
+    También tiene en cuenta los cambios aún no volcados.
     """
-    conn = get_db_connection()
     try:
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM nodes WHERE node_id = ?", (node_id,))
-        return cursor.fetchone()
+        with _connections.read() as conn:
+            row = _fetchone(conn, "SELECT * FROM nodes WHERE node_id = ?", (node_id,))
+        return _apply_pending(row, node_id)
     except Exception as e:
         print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] [  ERROR  ] Error buscando nodo por ID: {e}")
         return None
-    finally:
-        conn.close()
 
+@_timed
 def get_recent_nodes(hours_limit):
     """
     Devuelve una lista de nodos vistos en las últimas X horas.
     """
-    conn = get_db_connection()
     try:
+        _write_buffer.flush()
         time_limit = datetime.now() - timedelta(hours=hours_limit)
-        cursor = conn.cursor()
-        cursor.execute(
-            "SELECT * FROM nodes WHERE last_seen < ? ORDER BY last_seen DESC",
-            (time_limit,)
-        )
-        return cursor.fetchall()
+        with _connections.read() as conn:
+            return _fetchall(
+                conn,
+                "SELECT * FROM nodes WHERE last_seen < ? ORDER BY last_seen DESC",
+                (time_limit,)
+            )
     except Exception as e:
         print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] [  ERROR  ] Error obteniendo nodos recientes: {e}")
         return []
-    finally:
-        conn.close()
 
 
-def add_message_id(msg_uid):
-    """Añade el ID de un mensaje a la base de datos."""
-    conn = get_db_connection()
+@_timed
+def add_processed_packet(sender_id, packet_id):
+    """
+    Registra un paquete procesado para recordarlo tras un reinicio.
+    La escritura es diferida y se hace en lote junto con el resto de cambios.
+    """
     try:
-        conn.execute(
-            "INSERT INTO processed_messages (message_uid, timestamp) VALUES (?, ?)",
-            (msg_uid, datetime.now())
-        )
-        conn.commit()
-    except sqlite3.IntegrityError:
-        pass
+        _write_buffer.append_packet(sender_id, packet_id, datetime.now())
     except Exception as e:
-        print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] [  ERROR  ] Error añadiendo ID a la BD: {e}")
-    finally:
-        conn.close()
+        print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] [  ERROR  ] Error añadiendo paquete a la BD: {e}")
+
+def load_processed_packets(since_minutes):
+    """Devuelve los pares (remitente, id de paquete) procesados en los últimos X minutos."""
+    try:
+        time_limit = datetime.now() - timedelta(minutes=since_minutes)
+        with _connections.read() as conn:
+            rows = _fetchall(
+                conn,
+                "SELECT sender_id, packet_id FROM processed_packets WHERE timestamp >= ?",
+                (time_limit,)
+            )
+        return [(row['sender_id'], row['packet_id']) for row in rows]
+    except Exception as e:
+        print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] [  ERROR  ] Error cargando paquetes procesados: {e}")
+        return []
 
-def message_id_exists(msg_uid):
-    """Comprueba si un ID de mensaje ya existe en la base de datos."""
-    conn = get_db_connection()
+@_timed
+def load_conversation(sender_id):
+    """
+    Devuelve (resumen, turnos serializados) de la conversación de un usuario, o None si no tiene.
+    Incluye los cambios aún no volcados del buffer de escritura diferida.
+    """
+    pending = _write_buffer.pending_conversation(sender_id)
+    if pending is not None:
+        return pending[0], pending[1]
     try:
-        cursor = conn.cursor()
-        cursor.execute("SELECT 1 FROM processed_messages WHERE message_uid = ?", (msg_uid,))
-        return cursor.fetchone() is not None
+        with _connections.read() as conn:
+            row = _fetchone(conn, "SELECT summary, turns FROM conversations WHERE sender_id = ?", (sender_id,))
+        return (row['summary'], row['turns']) if row is not None else None
     except Exception as e:
-        print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] [  ERROR  ] Error consultando ID en la BD: {e}")
-        return False
-    finally:
-        conn.close()
+        print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] [  ERROR  ] Error cargando la conversación: {e}")
+        return None
+
+def save_conversation(sender_id, summary, turns):
+    """Guarda (de forma diferida) el resumen y los turnos serializados de la conversación de un usuario."""
+    _write_buffer.put_conversation(sender_id, summary, turns, datetime.now())
+
+@_timed
+def get_last_invitation(sender_id):
+    """Momento de la última invitación a DM enviada a un usuario, o None."""
+    pending = _write_buffer.pending_invitation(sender_id)
+    if pending is not None:
+        return pending
+    try:
+        with _connections.read() as conn:
+            row = _fetchone(conn, "SELECT last_invitation_sent FROM conversations WHERE sender_id = ?", (sender_id,))
+        if row is None or row['last_invitation_sent'] is None:
+            return None
+        return datetime.fromisoformat(row['last_invitation_sent'])
+    except Exception as e:
+        print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] [  ERROR  ] Error cargando la última invitación: {e}")
+        return None
+
+def set_last_invitation(sender_id, sent_at):
+    _write_buffer.put_invitation(sender_id, sent_at)
+
+def cleanup_old_conversations(days_limit):
+    """Borra las conversaciones sin actividad en los últimos días_limit días."""
+    try:
+        _write_buffer.flush()
+        time_limit = datetime.now() - timedelta(days=days_limit)
+        with _connections.write() as conn:
+            deleted = conn.execute("DELETE FROM conversations WHERE updated_at < ?", (time_limit,)).rowcount
+        if deleted > 0:
+            print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] [  INFO   ] Limpiadas {deleted} conversaciones inactivas de la base de datos.")
+    except Exception as e:
+        print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] [  ERROR  ] Error limpiando la BD de conversaciones: {e}")
 
 def cleanup_old_messages():
-    """Elimina registros de mensajes de más de 7 días para mantener la BD limpia."""
-    conn = get_db_connection()
+    """Elimina los registros de paquetes procesados más antiguos que PROCESSED_PACKETS_RETENTION_DAYS."""
     try:
-        seven_days_ago = datetime.now() - timedelta(days=7)
-        cursor = conn.cursor()
-        cursor.execute("DELETE FROM processed_messages WHERE timestamp < ?", (seven_days_ago,))
-        conn.commit()
+        _write_buffer.flush()
+        time_limit = datetime.now() - timedelta(days=getattr(config, 'PROCESSED_PACKETS_RETENTION_DAYS', 7))
+        with _connections.write() as conn:
+            conn.execute("DELETE FROM processed_packets WHERE timestamp < ?", (time_limit,))
     except Exception as e:
         print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] [  ERROR  ] Error limpiando la BD de mensajes: {e}")
-    finally:
-        conn.close()
 
 def cleanup_old_nodes(days_limit):
     """
     NUEVA FUNCIÓN: Elimina nodos inactivos de la base de datos.
     """
-    conn = get_db_connection()
     try:
+        _write_buffer.flush()
         time_limit = datetime.now() - timedelta(days=days_limit)
-        cursor = conn.cursor()
-        cursor.execute("DELETE FROM nodes WHERE last_seen < ?", (time_limit,))
-        conn.commit()
-        if cursor.rowcount > 0:
-            print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] [  INFO   ] Limpiados {cursor.rowcount} nodos inactivos de la base de datos.")
+        with _connections.write() as conn:
+            old_ids = [row['node_id'] for row in _fetchall(conn, "SELECT node_id FROM nodes WHERE last_seen < ?", (time_limit,))]
+            cursor = conn.execute("DELETE FROM nodes WHERE last_seen < ?", (time_limit,))
+            deleted = cursor.rowcount
+        for node_id in old_ids:
+            _name_index.remove(node_id)
+            _spatial_index.remove(node_id)
+        if deleted > 0:
+            print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] [  INFO   ] Limpiados {deleted} nodos inactivos de la base de datos.")
     except Exception as e:
         print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] [  ERROR  ] Error limpiando la BD de nodos: {e}")
-    finally:
-        conn.close()
+
+def cleanup_telemetry_history():
+    """Aplica la política de retención de cada resolución del histórico de telemetría."""
+    try:
+        _write_buffer.flush()
+        now = int(datetime.now().timestamp())
+        with _connections.write() as conn:
+            for resolution, table, _ in TELEMETRY_RESOLUTIONS:
+                time_limit = now - _telemetry_retention_days(resolution) * 86400
+                column = 'timestamp' if resolution == 'raw' else 'bucket'
+                conn.execute(f"DELETE FROM {table} WHERE {column} < ?", (time_limit,))
+    except Exception as e:
+        print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] [  ERROR  ] Error limpiando el histórico de telemetría: {e}")
+
+def choose_telemetry_resolution(start, end, max_points):
+    """
+    Elige la resolución más fina que conserva datos desde 'start' y no devuelve más de
+    max_points cubos para el rango pedido. Si ninguna cumple, se usa la diaria.
+    """
+    now = datetime.now().timestamp()
+    for resolution, table, bucket_seconds in TELEMETRY_RESOLUTIONS:
+        if start < now - _telemetry_retention_days(resolution) * 86400:
+            continue
+        if (end - start) / bucket_seconds <= max_points:
+            return resolution, table, bucket_seconds
+    return TELEMETRY_RESOLUTIONS[-1]
+
+@_timed
+def get_telemetry_history(node_id, metric, start, end=None, max_points=200):
+    """
+    Devuelve (resolución, puntos) con la evolución de una métrica de un nodo entre dos
+    instantes (segundos epoch). Cada punto es un diccionario con timestamp, min, max, avg y count.
+    """
+    if metric not in TELEMETRY_METRICS:
+        raise ValueError(f"Métrica desconocida: {metric}")
+    try:
+        end = int(end if end is not None else datetime.now().timestamp())
+        start = int(start)
+        resolution, table, bucket_seconds = choose_telemetry_resolution(start, end, max_points)
+        # Las muestras que siguen en el buffer se suman a lo guardado, sin forzar un volcado.
+        pending = [(timestamp, value) for timestamp, value in _write_buffer.pending_samples(node_id, metric) if start <= timestamp <= end]
+        with _connections.read() as conn:
+            if resolution == 'raw':
+                rows = _fetchall(
+                    conn,
+                    "SELECT timestamp, value AS min_value, value AS max_value, value AS sum_value, 1 AS sample_count "
+                    "FROM telemetry_samples WHERE node_id = ? AND metric = ? AND timestamp BETWEEN ? AND ? ORDER BY timestamp",
+                    (node_id, metric, start, end)
+                )
+            else:
+                rows = _fetchall(
+                    conn,
+                    f"SELECT bucket AS timestamp, min_value, max_value, sum_value, sample_count FROM {table} "
+                    "WHERE node_id = ? AND metric = ? AND bucket BETWEEN ? AND ? ORDER BY bucket",
+                    (node_id, metric, start - start % bucket_seconds, end)
+                )
+            if pending:
+                # Las que ya se han volcado (o repiten un segundo guardado) ya están contadas.
+                placeholders = ",".join("?" * len(pending))
+                stored = {row['timestamp'] for row in _fetchall(
+                    conn,
+                    f"SELECT timestamp FROM telemetry_samples WHERE node_id = ? AND metric = ? AND timestamp IN ({placeholders})",
+                    (node_id, metric) + tuple(timestamp for timestamp, _ in pending)
+                )}
+        points = {
+            row['timestamp']: {
+                'timestamp': row['timestamp'],
+                'min': row['min_value'],
+                'max': row['max_value'],
+                'sum': row['sum_value'],
+                'count': row['sample_count'],
+            }
+            for row in rows
+        }
+        if pending:
+            seen = set(stored)
+            for timestamp, value in pending:
+                if timestamp in seen:
+                    continue
+                seen.add(timestamp)
+                bucket = timestamp if resolution == 'raw' else timestamp - timestamp % bucket_seconds
+                point = points.get(bucket)
+                if point is None:
+                    points[bucket] = {'timestamp': bucket, 'min': value, 'max': value, 'sum': value, 'count': 1}
+                else:
+                    point['min'] = min(point['min'], value)
+                    point['max'] = max(point['max'], value)
+                    point['sum'] += value
+                    point['count'] += 1
+        points = [points[bucket] for bucket in sorted(points)]
+        for point in points:
+            point['avg'] = point.pop('sum') / point['count']
+        return resolution, points
+    except Exception as e:
+        print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] [  ERROR  ] Error consultando el histórico de telemetría: {e}")
+        return None, []
+
+@_timed
+def get_telemetry_summary(node_id, metric, start, end=None):
+    """
+    Resume una métrica en un rango: mínimo, máximo, media, número de muestras y la media
+    del primer y último cubo (para ver la tendencia). Devuelve None si no hay datos.
+    """
+    resolution, points = get_telemetry_history(node_id, metric, start, end)
+    if not points:
+        return None
+    total = sum(point['avg'] * point['count'] for point in points)
+    count = sum(point['count'] for point in points)
+    return {
+        'resolution': resolution,
+        'min': min(point['min'] for point in points),
+        'max': max(point['max'] for point in points),
+        'avg': total / count,
+        'count': count,
+        'first': points[0]['avg'],
+        'last': points[-1]['avg'],
+        'first_timestamp': points[0]['timestamp'],
+        'last_timestamp': points[-1]['timestamp'],
+    }
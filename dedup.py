@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""
+Módulo de Deduplicación de Paquetes para MeshBot.
+
+Muchos gateways republican el mismo paquete, así que la mayoría del tráfico
+entrante son duplicados. Este módulo los detecta en memoria, sin acceder a disco,
+usando como clave el par (remitente, id de paquete).
+"""
+
+import threading
+import time
+
+class PacketDeduplicator:
+    """
+    Conjunto rotatorio de paquetes vistos, acotado en tiempo y en tamaño.
+
+    Se mantienen dos generaciones: la actual y la anterior. Cuando la actual
+    cubre la ventana de tiempo configurada o alcanza la mitad del tamaño máximo,
+    pasa a ser la anterior y la más vieja se descarta. Así un paquete se recuerda
+    durante al menos una ventana completa (salvo que se alcance el límite de tamaño)
+    y la memoria nunca supera max_entries claves.
+    """
+
+    def __init__(self, window_seconds, max_entries):
+        self.window_seconds = window_seconds
+        self.max_entries = max(2, max_entries)
+        self._lock = threading.Lock()
+        self._current = set()
+        self._previous = set()
+        self._generation_started = time.monotonic()
+        self.duplicates = 0
+        self.unique = 0
+
+    def _rotate_if_needed(self, now):
+        if (now - self._generation_started >= self.window_seconds
+                or len(self._current) >= self.max_entries // 2):
+            self._previous = self._current
+            self._current = set()
+            self._generation_started = now
+
+    def check_and_add(self, sender_id, packet_id):
+        """Devuelve True si el paquete ya se había visto; si no, lo registra y devuelve False."""
+        key = (sender_id, packet_id)
+        with self._lock:
+            self._rotate_if_needed(time.monotonic())
+            if key in self._current or key in self._previous:
+                self.duplicates += 1
+                return True
+            self._current.add(key)
+            self.unique += 1
+            return False
+
+    def load(self, keys):
+        """Precarga claves (remitente, id) ya procesadas, por ejemplo las guardadas antes de reiniciar."""
+        with self._lock:
+            for key in keys:
+                self._rotate_if_needed(time.monotonic())
+                self._current.add(tuple(key))
+
+    def __len__(self):
+        with self._lock:
+            return len(self._current) + len(self._previous)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._current) + len(self._previous),
+                'duplicates': self.duplicates,
+                'unique': self.unique,
+            }
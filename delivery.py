@@ -0,0 +1,287 @@
+# -*- coding: utf-8 -*-
+"""
+Módulo de Seguimiento de Entregas para MeshBot.
+
+Los mensajes directos se envían con want_ack, así que el destinatario contesta con
+un paquete ROUTING_APP cuyo request_id es el ID del paquete original: sin error si
+lo ha recibido (ACK) o con el motivo del fallo (NAK). Este módulo recuerda cada
+paquete enviado por su ID, empareja esas respuestas y calcula la latencia y la
+tasa de entrega por destinatario y por canal.
+
+Cada parte de un mensaje largo se sigue por separado, de modo que si no llega la
+confirmación de una parte solo se reenvía esa, con una espera que crece en cada
+intento. Solo se reintenta con destinatarios que ya han confirmado algún paquete:
+si sus ACK nunca llegan hasta nosotros, reenviar solo gastaría tiempo en el aire.
+"""
+
+import threading
+import time
+
+from meshtastic import mesh_pb2
+
+import metrics
+from cache import TTLCache
+from logutil import log
+
+# Errores de enrutamiento tras los que merece la pena volver a intentarlo.
+RETRYABLE_ERRORS = frozenset((
+    mesh_pb2.Routing.NO_ROUTE,
+    mesh_pb2.Routing.GOT_NAK,
+    mesh_pb2.Routing.TIMEOUT,
+    mesh_pb2.Routing.MAX_RETRANSMIT,
+    mesh_pb2.Routing.NO_RESPONSE,
+    mesh_pb2.Routing.DUTY_CYCLE_LIMIT,
+    mesh_pb2.Routing.RATE_LIMIT_EXCEEDED,
+))
+
+DELIVERIES = metrics.counter('meshbot_deliveries_total', "Paquetes con confirmación de entrega solicitada, por canal y resultado.", ('channel', 'result'))
+RETRANSMISSIONS = metrics.counter('meshbot_retransmissions_total', "Partes de mensajes reenviadas por no recibir confirmación, por canal.", ('channel',))
+DELIVERY_LATENCY = metrics.histogram('meshbot_delivery_latency_seconds', "Tiempo desde que se transmite un paquete hasta que llega su confirmación, por canal.", ('channel',),
+                                     buckets=(1, 2.5, 5, 10, 20, 30, 45, 60, 90, 120, 300))
+
+def error_name(error_reason):
+    try:
+        return mesh_pb2.Routing.Error.Name(error_reason)
+    except ValueError:
+        return str(error_reason)
+
+class DeliveryStats:
+    """Contadores de entrega de un destinatario o de un canal."""
+
+    __slots__ = ('sent', 'delivered', 'failed', 'retransmitted', 'latency_sum', 'latency_max', 'last_delivered_at')
+
+    def __init__(self):
+        self.sent = 0
+        self.delivered = 0
+        self.failed = 0
+        self.retransmitted = 0
+        self.latency_sum = 0.0
+        self.latency_max = 0.0
+        self.last_delivered_at = None
+
+    def success_rate(self):
+        finished = self.delivered + self.failed
+        return self.delivered / finished if finished else None
+
+    def as_dict(self):
+        return {
+            'sent': self.sent,
+            'delivered': self.delivered,
+            'failed': self.failed,
+            'retransmitted': self.retransmitted,
+            'success_rate': self.success_rate(),
+            'latency_avg': self.latency_sum / self.delivered if self.delivered else None,
+            'latency_max': self.latency_max,
+        }
+
+class TrackedPacket:
+    """
+    Un paquete (o parte de mensaje) pendiente de confirmación. transmit() lo vuelve a
+    encolar con un ID nuevo y devuelve ese ID, o None si no se pudo encolar.
+    """
+
+    __slots__ = ('transmit', 'destination_id', 'channel_name', 'label', 'packet_ids', 'sent_times', 'attempts', 'enqueued_at', 'deadline')
+
+    def __init__(self, transmit, destination_id, channel_name, label):
+        self.transmit = transmit
+        self.destination_id = destination_id
+        self.channel_name = channel_name
+        self.label = label
+        self.packet_ids = []
+        # Momento en que se transmitió cada intento, por ID de paquete.
+        self.sent_times = {}
+        self.attempts = 0
+        self.enqueued_at = time.monotonic()
+        self.deadline = None
+
+class DeliveryTracker:
+    """
+    Seguimiento de los paquetes enviados con want_ack, seguro para usarse desde varios hilos.
+
+    track() encola el paquete (llamando a transmit) y lo registra; mark_sent() se llama cuando
+    el planificador lo publica de verdad, y a partir de ahí corre el plazo de ack_timeout
+    segundos, que se multiplica por backoff_factor en cada reintento. check() se llama
+    periódicamente para reenviar o dar por perdidos los paquetes sin confirmación.
+    """
+
+    def __init__(self, ack_timeout, max_retries, backoff_factor, max_destinations=1000, destination_ttl=7 * 24 * 60 * 60):
+        self.ack_timeout = ack_timeout
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        # Un paquete que no llega a publicarse (p. ej. por un error del bróker) se olvida pasado este tiempo.
+        self.max_unsent_seconds = max(ack_timeout * 10, 600)
+        self._lock = threading.Lock()
+        self._pending = {}
+        # Paquetes que el planificador publica antes de que track() termine de registrarlos.
+        self._sent_early = {}
+        self._by_destination = TTLCache(max_destinations, destination_ttl, refresh_on_get=True)
+        self._by_channel = {}
+        self.unmatched = 0
+
+    def _stats_for(self, destination_id, channel_name):
+        destination_stats = self._by_destination.get(destination_id)
+        if destination_stats is None:
+            destination_stats = DeliveryStats()
+            self._by_destination.set(destination_id, destination_stats)
+        channel_stats = self._by_channel.get(channel_name)
+        if channel_stats is None:
+            channel_stats = self._by_channel[channel_name] = DeliveryStats()
+        return destination_stats, channel_stats
+
+    def track(self, transmit, destination_id, channel_name, label=None):
+        """Encola un paquete por primera vez y empieza a seguirlo. Devuelve su ID, o None si no se encoló."""
+        packet = TrackedPacket(transmit, destination_id, channel_name, label)
+        packet_id = transmit()
+        if packet_id is None:
+            return None
+        with self._lock:
+            packet.packet_ids.append(packet_id)
+            packet.attempts = 1
+            self._register(packet, packet_id)
+            for stats in self._stats_for(destination_id, channel_name):
+                stats.sent += 1
+        return packet_id
+
+    def _register(self, packet, packet_id):
+        """Debe llamarse con el lock tomado."""
+        self._pending[packet_id] = packet
+        sent_at = self._sent_early.pop(packet_id, None)
+        if sent_at is not None:
+            self._set_sent(packet, packet_id, sent_at)
+
+    def _set_sent(self, packet, packet_id, sent_at):
+        packet.sent_times[packet_id] = sent_at
+        packet.deadline = sent_at + self.ack_timeout * self.backoff_factor ** (packet.attempts - 1)
+
+    def mark_sent(self, packet_id):
+        now = time.monotonic()
+        with self._lock:
+            packet = self._pending.get(packet_id)
+            if packet is None:
+                self._sent_early[packet_id] = now
+            elif packet_id == packet.packet_ids[-1]:
+                self._set_sent(packet, packet_id, now)
+
+    def handle_routing(self, request_id, sender_id, error_reason):
+        """
+        Procesa una respuesta ROUTING_APP. Devuelve el paquete al que corresponde, o None si
+        no es de ninguno que estemos siguiendo o es un ACK de un nodo intermedio.
+        """
+        with self._lock:
+            packet = self._pending.get(request_id)
+            if packet is None:
+                self.unmatched += 1
+                return None
+            if error_reason == mesh_pb2.Routing.NONE:
+                if sender_id != packet.destination_id:
+                    # Un nodo intermedio lo ha retransmitido: sigue su camino, pero aún no está entregado.
+                    return None
+                self._finish(packet, delivered=True, packet_id=request_id)
+                return packet
+            if request_id != packet.packet_ids[-1]:
+                # NAK de un intento anterior: ya hay otro en camino.
+                return packet
+            retry = error_reason in RETRYABLE_ERRORS and self._can_retry(packet)
+            if not retry:
+                self._finish(packet, delivered=False)
+        log('advertencia', f"NAK de !{sender_id:08x} para el paquete {request_id:08x}{self._describe(packet)}: {error_name(error_reason)}.")
+        if retry:
+            self._retransmit(packet)
+        return packet
+
+    def _can_retry(self, packet):
+        if packet.attempts > self.max_retries:
+            return False
+        destination_stats = self._by_destination.get(packet.destination_id)
+        return destination_stats is not None and destination_stats.delivered > 0
+
+    def _describe(self, packet):
+        return f" ({packet.label})" if packet.label else ""
+
+    def _finish(self, packet, delivered, packet_id=None):
+        """
+        Da por terminado el seguimiento de un paquete; packet_id es el intento confirmado.
+        Debe llamarse con el lock tomado.
+        """
+        for attempt_id in packet.packet_ids:
+            self._pending.pop(attempt_id, None)
+        destination_stats, channel_stats = self._stats_for(packet.destination_id, packet.channel_name)
+        if delivered:
+            now = time.monotonic()
+            sent_at = packet.sent_times.get(packet_id)
+            latency = now - sent_at if sent_at is not None else 0.0
+            for stats in (destination_stats, channel_stats):
+                stats.delivered += 1
+                stats.latency_sum += latency
+                stats.latency_max = max(stats.latency_max, latency)
+                stats.last_delivered_at = now
+            DELIVERY_LATENCY.observe(latency, channel=packet.channel_name)
+            DELIVERIES.inc(channel=packet.channel_name, result='delivered')
+        else:
+            for stats in (destination_stats, channel_stats):
+                stats.failed += 1
+            DELIVERIES.inc(channel=packet.channel_name, result='failed')
+
+    def _retransmit(self, packet):
+        """Vuelve a encolar un paquete con un ID nuevo; las confirmaciones de los IDs anteriores siguen valiendo."""
+        packet_id = packet.transmit()
+        with self._lock:
+            if packet.packet_ids[0] not in self._pending:
+                # Llegó la confirmación mientras se reenviaba.
+                return
+            if packet_id is None:
+                self._finish(packet, delivered=False)
+                return
+            packet.packet_ids.append(packet_id)
+            packet.attempts += 1
+            packet.enqueued_at = time.monotonic()
+            packet.deadline = None
+            self._register(packet, packet_id)
+            for stats in self._stats_for(packet.destination_id, packet.channel_name):
+                stats.retransmitted += 1
+        RETRANSMISSIONS.inc(channel=packet.channel_name)
+        log('info', f"Reenviando a !{packet.destination_id:08x}{self._describe(packet)}, intento {packet.attempts}.")
+
+    def check(self):
+        """Reenvía o da por perdidos los paquetes cuyo plazo de confirmación ha vencido."""
+        now = time.monotonic()
+        to_retry = []
+        with self._lock:
+            for packet_id, sent_at in list(self._sent_early.items()):
+                if now - sent_at > self.max_unsent_seconds:
+                    del self._sent_early[packet_id]
+            for packet_id, packet in list(self._pending.items()):
+                if packet_id != packet.packet_ids[-1]:
+                    continue
+                if packet.deadline is None:
+                    if now - packet.enqueued_at > self.max_unsent_seconds:
+                        self._finish(packet, delivered=False)
+                    continue
+                if now < packet.deadline:
+                    continue
+                if self._can_retry(packet):
+                    packet.deadline = None
+                    to_retry.append(packet)
+                else:
+                    self._finish(packet, delivered=False)
+                    log('advertencia', f"Sin confirmación de !{packet.destination_id:08x}{self._describe(packet)} tras {packet.attempts} intento(s).")
+        for packet in to_retry:
+            self._retransmit(packet)
+
+    def destination_stats(self, destination_id):
+        with self._lock:
+            destination_stats = self._by_destination.get(destination_id)
+            return destination_stats.as_dict() if destination_stats is not None else None
+
+    def pending(self):
+        with self._lock:
+            return len({id(packet) for packet in self._pending.values()})
+
+    def stats(self):
+        with self._lock:
+            return {
+                'pending': len({id(packet) for packet in self._pending.values()}),
+                'unmatched': self.unmatched,
+                'by_channel': {channel_name: stats.as_dict() for channel_name, stats in self._by_channel.items()},
+                'by_destination': {f"!{destination_id:08x}": stats.as_dict() for destination_id, stats in self._by_destination.items()},
+            }
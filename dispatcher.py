@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""
+Módulo de Despacho de Paquetes para MeshBot.
+
+Reparte el procesamiento de los paquetes entrantes (IA, comandos, base de datos)
+entre un conjunto acotado de hilos trabajadores, para que el hilo de red de MQTT
+nunca quede bloqueado. Todos los paquetes de un mismo remitente se encolan en el
+mismo trabajador, de modo que se procesan en el mismo orden en que llegaron.
+"""
+
+import queue
+import threading
+import time
+
+from logutil import log
+
+_STOP = object()
+
+class PacketDispatcher:
+    """
+    Pool de trabajadores con una cola acotada por trabajador.
+
+    La clave de reparto (normalmente el ID del remitente) decide el trabajador,
+    así que el orden se mantiene por clave. Si la cola del trabajador está llena,
+    el trabajo se descarta y se contabiliza en lugar de bloquear al productor.
+    """
+
+    def __init__(self, num_workers, queue_size, name="worker"):
+        self.name = name
+        self._queues = [queue.Queue(maxsize=queue_size) for _ in range(max(1, num_workers))]
+        self._threads = []
+        self._lock = threading.Lock()
+        self.submitted = 0
+        self.processed = 0
+        self.dropped = 0
+        self.errors = 0
+
+    def start(self):
+        if self._threads:
+            return
+        for index, work_queue in enumerate(self._queues):
+            thread = threading.Thread(target=self._worker_loop, args=(work_queue,), name=f"{self.name}-{index}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        log('info', f"Despachador iniciado con {len(self._queues)} trabajadores.")
+
+    def submit(self, key, func, *args):
+        """Encola func(*args) en el trabajador asignado a 'key'. Devuelve False si se descarta."""
+        work_queue = self._queues[key % len(self._queues)]
+        try:
+            work_queue.put_nowait((func, args))
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+            return False
+        with self._lock:
+            self.submitted += 1
+        return True
+
+    def _worker_loop(self, work_queue):
+        while True:
+            item = work_queue.get()
+            if item is _STOP:
+                break
+            func, args = item
+            try:
+                func(*args)
+            except Exception as e:
+                with self._lock:
+                    self.errors += 1
+                log('error', f"Error en trabajador del despachador: {e}")
+            finally:
+                with self._lock:
+                    self.processed += 1
+
+    def queue_depth(self):
+        """Número total de trabajos pendientes en todas las colas."""
+        return sum(work_queue.qsize() for work_queue in self._queues)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'workers': len(self._queues),
+                'queue_depth': self.queue_depth(),
+                'queue_depths': [work_queue.qsize() for work_queue in self._queues],
+                'submitted': self.submitted,
+                'processed': self.processed,
+                'dropped': self.dropped,
+                'errors': self.errors,
+            }
+
+    def stop(self, timeout=10):
+        """
+        Termina los trabajos ya encolados y detiene los hilos, esperando como mucho timeout
+        segundos en total. Si la cola de un trabajador está llena, se descartan sus trabajos
+        pendientes para que el aviso de parada quepa sin bloquear.
+        """
+        deadline = time.monotonic() + timeout
+        for index, work_queue in enumerate(self._queues):
+            try:
+                work_queue.put_nowait(_STOP)
+                continue
+            except queue.Full:
+                pass
+            discarded = 0
+            while True:
+                try:
+                    work_queue.get_nowait()
+                    discarded += 1
+                except queue.Empty:
+                    break
+            with self._lock:
+                self.dropped += discarded
+            log('advertencia', f"Cola del trabajador {self.name}-{index} llena al detener: {discarded} paquete(s) descartado(s).")
+            try:
+                work_queue.put_nowait(_STOP)
+            except queue.Full:
+                log('advertencia', f"No se pudo avisar de la parada al trabajador {self.name}-{index}.")
+        for thread in self._threads:
+            thread.join(max(0, deadline - time.monotonic()))
+            if thread.is_alive():
+                log('advertencia', f"El trabajador {thread.name} no terminó a tiempo; se abandona.")
+        self._threads = []
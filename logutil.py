@@ -0,0 +1,14 @@
+# -*- coding: utf-8 -*-
+"""
+Módulo de Logging para MeshBot.
+
+Todos los módulos escriben sus mensajes con la misma función log(), para que el
+formato de las líneas sea el mismo en todo el bot.
+"""
+
+from datetime import datetime
+
+def log(level, message):
+    """Función de logging estándar."""
+    timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    print(f"[{timestamp}] [{level.upper():^9}] {message}")
@@ -13,10 +13,13 @@ Repositorio del proyecto: https://github.com/lhupyn/meshbot
 """
 
 # --- Módulos Estándar de Python ---
+import argparse
+import os
 import sys
 import time
 import random
-import base64
+import shutil
+import tempfile
 import threading
 from datetime import datetime, timedelta
 
@@ -26,8 +29,6 @@ try:
     import google.generativeai as genai
     import requests
     from meshtastic import mesh_pb2, mqtt_pb2, portnums_pb2, BROADCAST_NUM, config_pb2, telemetry_pb2
-    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
-    from cryptography.hazmat.backends import default_backend
 except ImportError as e:
     print(f"Error: Faltan dependencias críticas ({e.name}). Por favor, instálalas.")
     print("Asegúrate de ejecutar: pip install paho-mqtt google-generativeai requests meshtastic cryptography")
@@ -38,7 +39,23 @@ try:
     import config
     import bot_commands
     import database
-    from bot_commands import get_weather_data, get_current_time, get_node_info_for_ai
+    import dispatcher
+    import dedup
+    import channels
+    import outbound
+    import metrics
+    import capture
+    import cluster
+    import scheduler
+    import ai_tools
+    import segmenter
+    import response_cache
+    import conversation
+    import textcodec
+    import delivery
+    import topology
+    from logutil import log
+    from bot_commands import get_weather_data, get_current_time, get_node_info_for_ai, get_node_telemetry_history_for_ai, get_nearby_nodes_for_ai, get_mesh_topology_for_ai
 except ImportError as e:
     print(f"CRITICO: No se encuentra un archivo del proyecto: {e.name}.")
     sys.exit(1)
@@ -47,156 +64,214 @@ except ImportError as e:
 # --- Constantes y Variables Globales ---
 OUR_NODE_ID_HEX = f"!{config.OUR_NODE_NUMBER:08x}"
 MAX_PAYLOAD_LEN = mesh_pb2.Constants.DATA_PAYLOAD_LEN - 10 
-CONVERSATION_HISTORY = {}
-LAST_INVITATION_SENT = {}
 PRIVATE_REQUEST_KEYWORDS = ["dm", "privado", "abreme un privado"]
+AI_ERROR_MESSAGE = "Tuve un problema al procesar tu solicitud con la IA."
+# Las reproducciones con --no-ai contestan con este texto en lugar de consultar a la IA.
+AI_ENABLED = True
+AI_DISABLED_MESSAGE = "[IA desactivada durante la reproducción]"
+# Respuestas a las consultas públicas a @meshbot que se repiten, por canal y pregunta normalizada.
+RESPONSE_CACHE = response_cache.ResponseCache(
+    getattr(config, 'RESPONSE_CACHE_SIZE', 200),
+    getattr(config, 'RESPONSE_CACHE_TTL_SECONDS', response_cache.DEFAULT_TTL_SECONDS),
+    getattr(config, 'RESPONSE_CACHE_REPEAT_SECONDS', 300)
+) if getattr(config, 'RESPONSE_CACHE_ENABLED', True) else None
+PACKET_DISPATCHER = dispatcher.PacketDispatcher(getattr(config, 'WORKER_THREADS', 4), getattr(config, 'WORKER_QUEUE_SIZE', 500))
+# Reparto de remitentes entre procesos cuando se ejecutan varios (WORKER_COUNT > 1).
+CLUSTER = cluster.Cluster(getattr(config, 'WORKER_COUNT', 1), getattr(config, 'WORKER_INDEX', 0), getattr(config, 'CLUSTER_GROUP', 'meshbot'), getattr(config, 'CLUSTER_TOPIC', 'meshbot-cluster'))
+# Canales que atiende el bot, con sus claves y funciones.
+CHANNELS = bot_commands.CHANNELS
+# Puertos cuya información solo se guarda si el canal tiene la función de telemetría.
+TELEMETRY_PORTS = (portnums_pb2.NODEINFO_APP, portnums_pb2.POSITION_APP, portnums_pb2.TELEMETRY_APP,
+                   portnums_pb2.NEIGHBORINFO_APP, portnums_pb2.TRACEROUTE_APP)
+TEXT_PORTS = (portnums_pb2.TEXT_MESSAGE_APP, portnums_pb2.TEXT_MESSAGE_COMPRESSED_APP)
+# Decide si cada mensaje se envía comprimido (solo a quien lo admite) y en cuántas partes.
+TEXT_ENCODER = textcodec.TextEncoder(
+    MAX_PAYLOAD_LEN, mesh_pb2.Constants.DATA_PAYLOAD_LEN, getattr(config, 'TEXT_COMPRESSION_ENABLED', True),
+    [int(node_id.lstrip('!'), 16) for node_id in getattr(config, 'TEXT_COMPRESSION_NODES', [])]
+)
+# Saltos, pasarelas y vecinos de cada nodo; de aquí sale el hop_limit de los mensajes directos.
+TOPOLOGY = bot_commands.TOPOLOGY
+# SNR desconocido en los TRACEROUTE (INT8_MIN).
+TRACEROUTE_SNR_UNKNOWN = -128
+# Seguimiento de las confirmaciones de entrega (ROUTING_APP) de los mensajes directos.
+DELIVERY = delivery.DeliveryTracker(
+    getattr(config, 'DELIVERY_ACK_TIMEOUT_SECONDS', 45), getattr(config, 'DELIVERY_MAX_RETRIES', 2), getattr(config, 'DELIVERY_BACKOFF_FACTOR', 2)
+)
+# Con varios procesos, cada uno transmite con su parte del ciclo de trabajo permitido.
+OUTBOUND = outbound.OutboundScheduler(
+    duty_cycle_percent=getattr(config, 'OUTBOUND_DUTY_CYCLE_PERCENT', 10) / CLUSTER.worker_count,
+    window_seconds=getattr(config, 'OUTBOUND_AIRTIME_WINDOW_SECONDS', 600),
+    min_interval_seconds=getattr(config, 'OUTBOUND_MIN_INTERVAL_SECONDS', 1.5),
+    max_backlog=getattr(config, 'OUTBOUND_MAX_BACKLOG', 200),
+    spreading_factor=getattr(config, 'LORA_SPREADING_FACTOR', 11),
+    bandwidth_hz=getattr(config, 'LORA_BANDWIDTH_KHZ', 250) * 1000,
+    coding_rate=getattr(config, 'LORA_CODING_RATE', 5)
+)
+# Tareas periódicas (presencia, anuncios, limpieza...), todas en un mismo hilo.
+SCHEDULER = scheduler.Scheduler()
+PACKET_DEDUP = dedup.PacketDeduplicator(getattr(config, 'DEDUP_WINDOW_MINUTES', 60) * 60, getattr(config, 'DEDUP_MAX_ENTRIES', 200000))
+# Cada worker publica sus métricas en su propio puerto (METRICS_PORT + número de worker).
+METRICS_PORT = getattr(config, 'METRICS_PORT', 9464) + CLUSTER.worker_index
+# Captura opcional del tráfico MQTT entrante para reproducirlo después con --replay.
+CAPTURE_DIR = os.path.join(getattr(config, 'CAPTURE_DIR', 'captures'), f"worker-{CLUSTER.worker_index}") if CLUSTER.enabled else getattr(config, 'CAPTURE_DIR', 'captures')
+CAPTURE = capture.CaptureWriter(CAPTURE_DIR, getattr(config, 'CAPTURE_MAX_FILE_MB', 64) * 1024 * 1024, getattr(config, 'CAPTURE_MAX_FILES', 10)) if getattr(config, 'CAPTURE_ENABLED', False) else None
 
-# --- FUNCIONES AUXILIARES Y DE LOG ---
-def log(level, message):
-    """Función de logging estándar."""
-    timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    print(f"[{timestamp}] [{level.upper():^9}] {message}")
+# --- MÉTRICAS ---
+PACKETS_RECEIVED = metrics.counter('meshbot_packets_received_total', "Paquetes recibidos y descifrados, por puerto y canal.", ('portnum', 'channel'))
+PACKETS_DUPLICATE = metrics.counter('meshbot_packets_duplicate_total', "Paquetes duplicados descartados.")
+PACKETS_FORWARDED = metrics.counter('meshbot_packets_forwarded_total', "Paquetes reenviados al proceso dueño de su remitente.")
+PACKETS_DROPPED = metrics.counter('meshbot_packets_dropped_total', "Paquetes descartados por tener la cola de procesamiento llena.")
+DECRYPT_FAILURES = metrics.counter('meshbot_decrypt_failures_total', "Paquetes que no se pudieron descifrar, por canal.", ('channel',))
+AI_REQUESTS = metrics.counter('meshbot_ai_requests_total', "Consultas a la IA, por resultado.", ('result',))
+AI_LATENCY = metrics.histogram('meshbot_ai_roundtrip_seconds', "Duración de cada llamada a Gemini.")
+PUBLIC_QUERIES = metrics.counter('meshbot_public_queries_total', "Consultas públicas a @meshbot, por resultado de la caché de respuestas.", ('result',))
+AI_TOOL_LATENCY = metrics.histogram('meshbot_ai_tool_seconds', "Duración de cada herramienta ejecutada por la IA.", ('tool',))
+metrics.gauge('meshbot_worker_queue_depth', "Paquetes esperando en las colas de los workers.", func=lambda: PACKET_DISPATCHER.queue_depth())
+metrics.gauge('meshbot_outbound_backlog', "Paquetes pendientes de transmitir, por prioridad.", ('priority',),
+              func=lambda: {(name,): count for name, count in OUTBOUND.stats()['backlog_by_priority'].items()})
+metrics.gauge('meshbot_conversations_active', "Conversaciones con la IA en memoria.", func=lambda: len(CONVERSATIONS))
+metrics.gauge('meshbot_response_cache_entries', "Respuestas públicas guardadas en caché.", func=lambda: len(RESPONSE_CACHE) if RESPONSE_CACHE is not None else 0)
+metrics.gauge('meshbot_topology_nodes', "Nodos en el modelo de topología de la red.", func=lambda: len(TOPOLOGY))
+metrics.gauge('meshbot_deliveries_pending', "Mensajes directos esperando confirmación de entrega.", func=lambda: DELIVERY.pending())
+metrics.gauge('meshbot_dedup_entries', "Paquetes recordados para detectar duplicados.", func=lambda: len(PACKET_DEDUP))
+metrics.gauge('meshbot_scheduler_job_last_duration_seconds', "Duración de la última ejecución de cada tarea periódica.", ('job',),
+              func=lambda: {(job.name,): job.last_duration for job in SCHEDULER.jobs() if job.last_duration is not None})
+metrics.gauge('meshbot_scheduler_job_next_run_timestamp', "Próxima ejecución de cada tarea periódica (segundos desde epoch).", ('job',),
+              func=lambda: {(job.name,): job.next_run().timestamp() for job in SCHEDULER.jobs() if job.due is not None})
+metrics.gauge('meshbot_known_nodes', "Nodos conocidos en la base de datos.", func=lambda: database.count_nodes())
 
 # --- LÓGICA DE PROTOCOLO Y CIFRADO ---
 
-def xor_hash(data: bytes) -> int:
-    result = 0
-    for char in data: result ^= char
-    return result
+def encode_data(port_num, payload_data):
+    """Serializa el mensaje Data (puerto + carga útil) que después se cifra en cada canal."""
+    data = mesh_pb2.Data()
+    data.portnum = port_num
+    data.payload = payload_data
+    return data.SerializeToString()
 
-def generate_channel_hash(name: str, key_b64: str) -> int:
-    try:
-        if key_b64 == "AQ==": key_b64 = "1PG7OiApB1nwvP+rz05pAQ=="
-        key_bytes = base64.b64decode(key_b64.encode('ascii'))
-        return xor_hash(bytes(name, 'utf-8')) ^ xor_hash(key_bytes)
-    except Exception as e:
-        log('error', f"Error generando hash de canal para '{name}': {e}")
-        return 0
-
-def encrypt_payload(key_b64: str, packet_id: int, from_node_id: int, payload_bytes: bytes) -> bytes:
-    if key_b64 == "AQ==": key_b64 = "1PG7OiApB1nwvP+rz05pAQ=="
-    key_bytes = base64.b64decode(key_b64.encode('ascii'))
-    nonce_packet_id = packet_id.to_bytes(8, "little")
-    nonce_from_node = from_node_id.to_bytes(8, "little")
-    nonce = nonce_packet_id + nonce_from_node
-    cipher = Cipher(algorithms.AES(key_bytes), modes.CTR(nonce), backend=default_backend())
-    encryptor = cipher.encryptor()
-    return encryptor.update(payload_bytes) + encryptor.finalize()
-
-def decrypt_payload(key_b64: str, packet_id: int, from_node_id: int, encrypted_payload: bytes) -> bytes:
-    if key_b64 == "AQ==": key_b64 = "1PG7OiApB1nwvP+rz05pAQ=="
-    key_bytes = base64.b64decode(key_b64.encode('ascii'))
-    nonce_packet_id = packet_id.to_bytes(8, "little")
-    nonce_from_node = from_node_id.to_bytes(8, "little")
-    nonce = nonce_packet_id + nonce_from_node
-    cipher = Cipher(algorithms.AES(key_bytes), modes.CTR(nonce), backend=default_backend())
-    decryptor = cipher.decryptor()
-    return decryptor.update(encrypted_payload) + decryptor.finalize()
-
-def generate_mesh_packet(destination_id, payload_data, port_num, want_ack, channel_name, channel_key):
+def generate_mesh_packet(destination_id, data_bytes, want_ack, channel, hop_limit=None):
+    if hop_limit is None:
+        hop_limit = TOPOLOGY.default_hop_limit
     mp = mesh_pb2.MeshPacket()
     setattr(mp, 'from', config.OUR_NODE_NUMBER)
     mp.to = destination_id
     mp.id = random.randint(0, 0xFFFFFFFF)
-    mp.hop_limit = 3
-    mp.hop_start = 3
+    mp.hop_limit = hop_limit
+    mp.hop_start = hop_limit
     mp.want_ack = want_ack
-    mp.channel = generate_channel_hash(channel_name, channel_key)
-    data = mesh_pb2.Data()
-    data.portnum = port_num
-    data.payload = payload_data
-    encrypted_bytes = encrypt_payload(
-        channel_key,
-        mp.id,
-        config.OUR_NODE_NUMBER,
-        data.SerializeToString()
+    mp.channel = channel.hash
+    mp.encrypted = channel.encrypt(mp.id, config.OUR_NODE_NUMBER, data_bytes)
+    return mqtt_pb2.ServiceEnvelope(packet=mp, channel_id=channel.name, gateway_id=OUR_NODE_ID_HEX)
+
+def enqueue_service_envelope(client, service_envelope, channel, priority, description=None, on_sent=None):
+    """Entrega un paquete ya cifrado al planificador de transmisión."""
+    queued = OUTBOUND.enqueue(
+        client,
+        channel.publish_topic,
+        service_envelope.SerializeToString(),
+        channel.name,
+        priority,
+        description=description,
+        airtime_bytes=len(service_envelope.packet.encrypted),
+        on_sent=on_sent
     )
-    mp.encrypted = encrypted_bytes
-    return mqtt_pb2.ServiceEnvelope(packet=mp, channel_id=channel_name, gateway_id=OUR_NODE_ID_HEX)
-
-def send_long_message(client, destination_id, text, channel_name):
-    parts = []
-    words = text.split()
-    current_part = ""
-
-    for word in words:
-        if not current_part:
-            if len(word.encode('utf-8')) > MAX_PAYLOAD_LEN:
-                 parts.append(word)
-                 continue
-            current_part = word
-        elif len((current_part + " " + word).encode('utf-8')) > MAX_PAYLOAD_LEN:
-            parts.append(current_part)
-            current_part = word
-        else:
-            current_part += " " + word
-    
-    if current_part:
-        parts.append(current_part)
-
-    total_parts = len(parts)
-    for i, part in enumerate(parts):
-        prefix = f"{i+1}/{total_parts}: " if total_parts > 1 else ""
-        publish_meshtastic_message(client, destination_id, prefix + part, channel_name, is_part_of_long_message=True)
-        if total_parts > 1:
-            time.sleep(1.5)
-
-def publish_meshtastic_message(client, destination_id, text_message, channel_name, is_part_of_long_message=False):
-    encoded_message = text_message.encode('utf-8')
-    if not is_part_of_long_message and len(encoded_message) > mesh_pb2.Constants.DATA_PAYLOAD_LEN:
+    if not queued:
+        log('advertencia', f"Cola de transmisión llena. Paquete para '{channel.name}' descartado.")
+    return queued
+
+def default_priority(destination_id):
+    return outbound.PRIORITY_PUBLIC if destination_id == BROADCAST_NUM else outbound.PRIORITY_DM
+
+def send_long_message(client, destination_id, text, channel_name, priority=None):
+    """Divide el texto en partes que quepan en un paquete (comprimidas si el destino lo admite) y las encola en orden."""
+    for part in TEXT_ENCODER.split(text, destination_id):
+        publish_meshtastic_message(client, destination_id, part, channel_name, is_part_of_long_message=True, priority=priority)
+
+def send_ai_response(client, destination_id, text, sender_id, channel_name, public=False):
+    """
+    Consulta a la IA y envía la respuesta a destination_id. Con AI_STREAMING_ENABLED la
+    respuesta se recibe en streaming y cada parte se encola en cuanto está completa,
+    numeradas como "1+: ", "2+: "... y la última con el total ("3/3: ").
+    Con public=True la respuesta no depende de quién pregunta (ver get_ai_response).
+    """
+    if not getattr(config, 'AI_STREAMING_ENABLED', False):
+        response_text = get_ai_response(text, sender_id, public=public)
+        if response_text:
+            send_long_message(client, destination_id, response_text, channel_name)
+        return response_text
+
+    def emit(index, part, last):
+        publish_meshtastic_message(client, destination_id, segmenter.streaming_prefix(index, last) + part, channel_name, is_part_of_long_message=True)
+
+    stream = segmenter.Segmenter(MAX_PAYLOAD_LEN, emit)
+    response_text = get_ai_response(text, sender_id, on_text=stream.feed, public=public)
+    if not stream.received and response_text:
+        # La respuesta no llegó en streaming (p. ej. el mensaje de error).
+        stream.feed(response_text)
+    stream.finish()
+    return response_text
+
+def publish_meshtastic_message(client, destination_id, text_message, channel_name, is_part_of_long_message=False, priority=None):
+    if not is_part_of_long_message and len(text_message.encode('utf-8')) > mesh_pb2.Constants.DATA_PAYLOAD_LEN:
          log('advertencia', "Mensaje largo detectado. Usando send_long_message para dividirlo.")
-         send_long_message(client, destination_id, text_message, channel_name); return
+         send_long_message(client, destination_id, text_message, channel_name, priority=priority); return
     
-    channel_key = config.PRIMARY_CHANNEL_KEY_B64
-    if channel_name == config.SECONDARY_CHANNEL_NAME:
-        channel_key = config.SECONDARY_CHANNEL_KEY_B64
-        
-    service_envelope = generate_mesh_packet(destination_id, encoded_message, portnums_pb2.TEXT_MESSAGE_APP, want_ack=True, channel_name=channel_name, channel_key=channel_key)
-    if service_envelope:
-        topic = f"{config.ROOT_TOPIC}/2/e/{channel_name}/{OUR_NODE_ID_HEX}"
-        client.publish(topic, service_envelope.SerializeToString())
-        log_dest = "BROADCAST" if destination_id == BROADCAST_NUM else f"!{destination_id:08x}"
-        log('info', f"Mensaje enviado a {log_dest} en '{channel_name}': '{text_message}'")
+    channel = CHANNELS.get(channel_name)
+    if channel is None:
+        log('error', f"No se puede enviar el mensaje: el canal '{channel_name}' no está configurado.")
+        return
+
+    if priority is None:
+        priority = default_priority(destination_id)
+
+    port_num, payload = TEXT_ENCODER.encode(text_message, destination_id)
+    data_bytes = encode_data(port_num, payload)
+    log_dest = "BROADCAST" if destination_id == BROADCAST_NUM else f"!{destination_id:08x}"
+    description = f"Mensaje enviado a {log_dest} en '{channel_name}': '{text_message}'"
+    if destination_id == BROADCAST_NUM:
+        enqueue_service_envelope(client, generate_mesh_packet(destination_id, data_bytes, want_ack=True, channel=channel), channel, priority, description)
+        return
+
+    attempts = []
+
+    def transmit():
+        # Cada intento lleva un ID nuevo: los nodos que ya vieron el anterior lo descartarían como duplicado.
+        # El primero usa los saltos justos para llegar al destino; los reintentos, al menos los de siempre.
+        hop_limit = TOPOLOGY.hop_limit_for(destination_id)
+        if attempts:
+            hop_limit = max(hop_limit, TOPOLOGY.default_hop_limit)
+        attempts.append(hop_limit)
+        service_envelope = generate_mesh_packet(destination_id, data_bytes, want_ack=True, channel=channel, hop_limit=hop_limit)
+        packet_id = service_envelope.packet.id
+        if not enqueue_service_envelope(client, service_envelope, channel, priority, description, on_sent=lambda: DELIVERY.mark_sent(packet_id)):
+            return None
+        return packet_id
+
+    DELIVERY.track(transmit, destination_id, channel_name, label=f"'{text_message[:24]}'")
 
 def publish_nodeinfo(client):
-    """Publishes node info to all configured channels."""
+    """Publica el NodeInfo del bot en los canales con la función de presencia."""
     try:
         user_payload = mesh_pb2.User(id=OUR_NODE_ID_HEX, long_name=config.OUR_LONG_NAME, short_name=config.OUR_SHORT_NAME, hw_model=255, role=config_pb2.Config.DeviceConfig.CLIENT_MUTE).SerializeToString()
-        
-        service_envelope_primary = generate_mesh_packet(destination_id=BROADCAST_NUM, payload_data=user_payload, port_num=portnums_pb2.NODEINFO_APP, want_ack=False, channel_name=config.PRIMARY_CHANNEL_NAME, channel_key=config.PRIMARY_CHANNEL_KEY_B64)
-        if service_envelope_primary:
-            topic_primary = f"{config.ROOT_TOPIC}/2/e/{config.PRIMARY_CHANNEL_NAME}/{OUR_NODE_ID_HEX}"
-            client.publish(topic_primary, service_envelope_primary.SerializeToString())
-            log('info', f"Anuncio de presencia (NodeInfo) enviado a BROADCAST en canal '{config.PRIMARY_CHANNEL_NAME}'")
-
-        if config.SECONDARY_CHANNEL_ENABLED:
-            service_envelope_secondary = generate_mesh_packet(destination_id=BROADCAST_NUM, payload_data=user_payload, port_num=portnums_pb2.NODEINFO_APP, want_ack=False, channel_name=config.SECONDARY_CHANNEL_NAME, channel_key=config.SECONDARY_CHANNEL_KEY_B64)
-            if service_envelope_secondary:
-                topic_secondary = f"{config.ROOT_TOPIC}/2/e/{config.SECONDARY_CHANNEL_NAME}/{OUR_NODE_ID_HEX}"
-                client.publish(topic_secondary, service_envelope_secondary.SerializeToString())
-                log('info', f"Anuncio de presencia (NodeInfo) enviado a BROADCAST en canal '{config.SECONDARY_CHANNEL_NAME}'")
+        data_bytes = encode_data(portnums_pb2.NODEINFO_APP, user_payload)
+
+        for channel in CHANNELS.with_role(channels.ROLE_PRESENCE):
+            service_envelope = generate_mesh_packet(destination_id=BROADCAST_NUM, data_bytes=data_bytes, want_ack=False, channel=channel)
+            enqueue_service_envelope(client, service_envelope, channel, outbound.PRIORITY_PRESENCE, f"Anuncio de presencia (NodeInfo) enviado a BROADCAST en canal '{channel.name}'")
 
     except Exception as e:
         log('error', f"No se pudo enviar el NodeInfo: {e}")
 
 def publish_position(client):
-    """Publishes position to all configured channels."""
+    """Publica la posición del bot en los canales con la función de presencia."""
     if not config.POSITION_ENABLED or (config.BOT_LATITUDE == 0.0 and config.BOT_LONGITUDE == 0.0): return
     try:
         position_payload = mesh_pb2.Position(latitude_i=int(config.BOT_LATITUDE * 1e7), longitude_i=int(config.BOT_LONGITUDE * 1e7), altitude=config.BOT_ALTITUDE, time=int(time.time())).SerializeToString()
-        
-        service_envelope_primary = generate_mesh_packet(destination_id=BROADCAST_NUM, payload_data=position_payload, port_num=portnums_pb2.POSITION_APP, want_ack=False, channel_name=config.PRIMARY_CHANNEL_NAME, channel_key=config.PRIMARY_CHANNEL_KEY_B64)
-        if service_envelope_primary:
-            topic_primary = f"{config.ROOT_TOPIC}/2/e/{config.PRIMARY_CHANNEL_NAME}/{OUR_NODE_ID_HEX}"
-            client.publish(topic_primary, service_envelope_primary.SerializeToString())
-            log('info', f"Anuncio de posición enviado a BROADCAST en canal '{config.PRIMARY_CHANNEL_NAME}'")
-
-        if config.SECONDARY_CHANNEL_ENABLED:
-            service_envelope_secondary = generate_mesh_packet(destination_id=BROADCAST_NUM, payload_data=position_payload, port_num=portnums_pb2.POSITION_APP, want_ack=False, channel_name=config.SECONDARY_CHANNEL_NAME, channel_key=config.SECONDARY_CHANNEL_KEY_B64)
-            if service_envelope_secondary:
-                topic_secondary = f"{config.ROOT_TOPIC}/2/e/{config.SECONDARY_CHANNEL_NAME}/{OUR_NODE_ID_HEX}"
-                client.publish(topic_secondary, service_envelope_secondary.SerializeToString())
-                log('info', f"Anuncio de posición enviado a BROADCAST en canal '{config.SECONDARY_CHANNEL_NAME}'")
+        data_bytes = encode_data(portnums_pb2.POSITION_APP, position_payload)
+
+        for channel in CHANNELS.with_role(channels.ROLE_PRESENCE):
+            service_envelope = generate_mesh_packet(destination_id=BROADCAST_NUM, data_bytes=data_bytes, want_ack=False, channel=channel)
+            enqueue_service_envelope(client, service_envelope, channel, outbound.PRIORITY_PRESENCE, f"Anuncio de posición enviado a BROADCAST en canal '{channel.name}'")
 
     except Exception as e:
         log('error', f"No se pudo enviar la Posición: {e}")
@@ -247,54 +322,252 @@ get_node_data_tool = genai.protos.Tool(
     ]
 )
 
-def get_ai_response(text, sender_id):
+get_telemetry_history_tool = genai.protos.Tool(
+    function_declarations=[
+        genai.protos.FunctionDeclaration(
+            name='get_node_telemetry_history',
+            description="Obtiene la evolución histórica de una métrica de telemetría de un nodo (mínimo, máximo, media y tendencia) en las últimas horas. Úsalo cuando el usuario pregunte cómo ha cambiado la batería, el voltaje, la temperatura, la humedad o la presión de un nodo.",
+            parameters=genai.protos.Schema(
+                type=genai.protos.Type.OBJECT,
+                properties={
+                    'node_identifier': genai.protos.Schema(
+                        type=genai.protos.Type.STRING,
+                        description="El identificador del nodo: su nombre largo, corto (prefijado con '@') o su ID hexadecimal (prefijado con '!')."
+                    ),
+                    'metric': genai.protos.Schema(
+                        type=genai.protos.Type.STRING,
+                        description="La métrica a consultar: 'bateria', 'voltaje', 'temperatura', 'humedad' o 'presion'."
+                    ),
+                    'hours': genai.protos.Schema(
+                        type=genai.protos.Type.NUMBER,
+                        description="Número de horas hacia atrás a consultar. Por ejemplo 24 para el último día o 168 para la última semana."
+                    )
+                },
+                required=['node_identifier', 'metric']
+            )
+        )
+    ]
+)
+
+get_nearby_nodes_tool = genai.protos.Tool(
+    function_declarations=[
+        genai.protos.FunctionDeclaration(
+            name='get_nearby_nodes',
+            description="Busca los nodos de la red más cercanos a un nodo (por defecto, el del usuario), con su distancia. Úsalo para preguntas como 'qué nodos hay a menos de 10 km' o 'cuál es el nodo más cercano con sensor de temperatura'.",
+            parameters=genai.protos.Schema(
+                type=genai.protos.Type.OBJECT,
+                properties={
+                    'node_identifier': genai.protos.Schema(
+                        type=genai.protos.Type.STRING,
+                        description="Nodo de referencia: su nombre largo, corto (prefijado con '@') o su ID hexadecimal (prefijado con '!'). Omítelo para usar el nodo del usuario."
+                    ),
+                    'radius_km': genai.protos.Schema(
+                        type=genai.protos.Type.NUMBER,
+                        description="Radio de búsqueda en kilómetros. Omítelo para obtener simplemente los más cercanos."
+                    ),
+                    'count': genai.protos.Schema(
+                        type=genai.protos.Type.NUMBER,
+                        description="Número máximo de nodos a devolver (por defecto 5)."
+                    ),
+                    'sensor': genai.protos.Schema(
+                        type=genai.protos.Type.STRING,
+                        description="Solo nodos con este sensor: 'bateria', 'voltaje', 'temperatura', 'humedad' o 'presion'."
+                    )
+                }
+            )
+        )
+    ]
+)
+
+get_mesh_topology_tool = genai.protos.Tool(
+    function_declarations=[
+        genai.protos.FunctionDeclaration(
+            name='get_mesh_topology',
+            description="Obtiene la topología de la red Meshtastic: sin nodo, un resumen (nodos, pasarelas MQTT y cuántos nodos hay a cada distancia en saltos); con un nodo, a cuántos saltos está, qué pasarelas lo oyen y con qué señal (RSSI/SNR), y sus vecinos por radio. Úsalo para preguntas sobre cobertura, saltos, alcance o cómo llega la señal a un nodo.",
+            parameters=genai.protos.Schema(
+                type=genai.protos.Type.OBJECT,
+                properties={
+                    'node_identifier': genai.protos.Schema(
+                        type=genai.protos.Type.STRING,
+                        description="El nodo a consultar: su nombre largo, corto (prefijado con '@') o su ID hexadecimal (prefijado con '!'). Omítelo para el resumen de la red."
+                    )
+                }
+            )
+        )
+    ]
+)
+
+# Qué ejecutar cuando Gemini llama a cada función declarada arriba.
+AI_TOOLS = [
+    ai_tools.AITool('get_weather_data', get_weather_data, required=['city']),
+    ai_tools.AITool('get_current_time', get_current_time),
+    ai_tools.AITool('get_node_info_for_ai', get_node_info_for_ai, required=['node_identifier']),
+    ai_tools.AITool('get_node_telemetry_history', get_node_telemetry_history_for_ai,
+                    required=['node_identifier', 'metric'], optional={'hours': 24}),
+    ai_tools.AITool('get_nearby_nodes', get_nearby_nodes_for_ai, with_sender=True,
+                    optional={'node_identifier': None, 'radius_km': None, 'count': 5, 'sensor': None}),
+    ai_tools.AITool('get_mesh_topology', get_mesh_topology_for_ai, optional={'node_identifier': None}),
+]
+AI_TOOL_RUNNER = ai_tools.AIToolRunner(AI_TOOLS, getattr(config, 'AI_TOOL_THREADS', 8), getattr(config, 'AI_TOOL_TIMEOUT_SECONDS', 15), AI_TOOL_LATENCY)
+
+_AI_MODEL = None
+_SUMMARY_MODEL = None
+_AI_MODEL_LOCK = threading.Lock()
+
+def build_system_instruction():
+    identity_str = (
+        f"Eres MeshBot, un asistente de IA factual y directo. Tu propia identidad en la red es: Nombre Largo='{config.OUR_LONG_NAME}', "
+        f"Nombre Corto='{config.OUR_SHORT_NAME}', ID='{OUR_NODE_ID_HEX}'. "
+    )
+    if config.POSITION_ENABLED and config.BOT_LATITUDE != 0.0:
+        identity_str += f"Mi ubicación fija es Latitud {config.BOT_LATITUDE:.4f}, Longitud {config.BOT_LONGITUDE:.4f}. "
+
+    # MODIFICADO: Prompt del sistema actualizado para mayor flexibilidad y sin info de config.
+    return (
+        identity_str +
+        "**Reglas de Contexto e Identidad (MUY IMPORTANTE):**\n"
+        "1. **Tu Identidad:** Si el usuario pregunta por tu identidad (quién eres, tu nombre, tu ID, tu nodo, tu ubicación, dónde estás), DEBES responder usando la información de 'Tu propia identidad en la red' y 'Mi ubicación fija' que se te proporciona al principio de estas instrucciones. NO uses herramientas para esto.\n"
+        "2. **Identidad del Usuario:** Si el usuario pregunta por su propia información ('mi nodo', 'mi ubicación', 'dónde estoy'), DEBES usar el ID del usuario que se te proporciona para buscar su información con la herramienta `get_node_info_for_ai`.\n"
+        "3. **Contexto de Conversación:** Presta atención al historial. Si una pregunta es ambigua como '¿y su ubicación?', asume que se refiere al último sujeto del que hablaron (ya sea tú, el usuario, u otro nodo).\n\n"
+        "Tu objetivo principal es proporcionar respuestas precisas y concisas. **No uses saludos, despedidas ni ningún tipo de relleno conversacional.** Ve directamente al grano.\n\n"
+        "**Cómo Responder:**\n"
+        "1. **Prioriza las Herramientas:** Si la pregunta del usuario puede ser respondida de forma precisa por una de tus herramientas, úsala. Las herramientas son para:\n"
+        "   - `get_weather_data`: Para el tiempo, clima o temperatura.\n"
+        "   - `get_current_time`: Para la hora o fecha actual.\n"
+        "   - `get_node_info_for_ai`: Para datos específicos sobre nodos de la red (telemetría, ubicación, etc.).\n"
+        "   - `get_node_telemetry_history`: Para la evolución en el tiempo de la telemetría de un nodo (batería, temperatura, etc.).\n"
+        "   - `get_nearby_nodes`: Para saber qué nodos hay cerca del usuario o de otro nodo, y a qué distancia.\n"
+        "   - `get_mesh_topology`: Para la estructura de la red: a cuántos saltos está un nodo, qué pasarelas lo oyen, con qué señal y cuáles son sus vecinos.\n"
+        "2. **Conocimiento General:** Si la pregunta no encaja con ninguna de las herramientas, responde usando tu conocimiento general. Sé útil y proporciona la información que se te solicita.\n"
+        "3. **Sé Conciso:** Siempre da respuestas breves y directas, ideales para las pantallas de los dispositivos de radio.\n"
+        "4. **Si no sabes, dilo:** Si una pregunta es demasiado compleja o no tienes la información, es mejor decir que no la tienes a inventar una respuesta."
+    )
+
+def get_ai_model():
+    """
+    Devuelve el modelo de Gemini, configurándolo la primera vez.
+    Las instrucciones del sistema solo dependen de la configuración del bot, así que el
+    mismo modelo sirve para todos los usuarios; su contexto va en cada mensaje.
+    """
+    global _AI_MODEL
+    if _AI_MODEL is None:
+        with _AI_MODEL_LOCK:
+            if _AI_MODEL is None:
+                genai.configure(api_key=config.GEMINI_API_KEY)
+                _AI_MODEL = genai.GenerativeModel(
+                    'gemini-1.5-flash-latest',
+                    tools=[get_weather_tool, get_time_tool, get_node_data_tool, get_telemetry_history_tool, get_nearby_nodes_tool, get_mesh_topology_tool],
+                    system_instruction=build_system_instruction()
+                )
+    return _AI_MODEL
+
+def summarize_conversation(previous_summary, transcript):
+    """Resume los turnos antiguos de una conversación junto con su resumen anterior (ver conversation.py)."""
+    global _SUMMARY_MODEL
+    if _SUMMARY_MODEL is None:
+        # Configura genai; va antes de tomar el lock porque get_ai_model() también lo toma.
+        get_ai_model()
+        with _AI_MODEL_LOCK:
+            if _SUMMARY_MODEL is None:
+                _SUMMARY_MODEL = genai.GenerativeModel(
+                    'gemini-1.5-flash-latest',
+                    system_instruction=(
+                        "Resumes conversaciones entre un usuario y MeshBot, un asistente de una red Meshtastic. "
+                        "Escribe un único párrafo breve, en español, con los datos que puedan servir para continuar la "
+                        "conversación: de qué se habló, nodos, lugares y cifras mencionados, y preferencias del usuario. "
+                        "Sin saludos ni comentarios sobre el propio resumen."
+                    )
+                )
+    prompt = (f"Resumen anterior: {previous_summary}\n\n" if previous_summary else "") + f"Conversación a resumir:\n{transcript}"
+    with AI_LATENCY.time():
+        return _SUMMARY_MODEL.generate_content(prompt).text
+
+# Memoria acotada de cada conversación: últimos turnos literales y resumen de los anteriores.
+CONVERSATION_MEMORY = conversation.ConversationMemory(getattr(config, 'CONVERSATION_MAX_TURNS', 6), getattr(config, 'CONVERSATION_TOKEN_BUDGET', 2000), summarize_conversation)
+# Conversaciones guardadas en la base de datos; en memoria solo las de los usuarios activos.
+CONVERSATIONS = conversation.ConversationStore(
+    CONVERSATION_MEMORY, getattr(config, 'CONVERSATION_CACHE_SIZE', 500), getattr(config, 'CONVERSATION_IDLE_MINUTES', 60) * 60,
+    lambda: get_ai_model().start_chat(history=[])
+)
+
+def send_to_gemini(chat, content, on_text=None):
+    """
+    Envía un mensaje a la sesión de chat y devuelve la respuesta completa. Con on_text la
+    respuesta se pide en streaming y su texto se va pasando a on_text según llega, salvo
+    en los turnos en que la IA pide funciones (ese texto no es la respuesta final).
+
+    Como la llamada a función puede llegar después de un texto previo ("Voy a consultar
+    el tiempo..."), el texto de cada turno se retiene hasta que el turno termina sin pedir
+    funciones o hasta que ya ocupa un paquete entero (el primer trozo completo): un texto
+    previo a una llamada a función nunca es tan largo. Si se piden funciones, lo retenido
+    se descarta.
+    """
+    with AI_LATENCY.time():
+        if on_text is None:
+            return chat.send_message(content)
+        response = chat.send_message(content, stream=True)
+        held = []
+        held_bytes = 0
+        streaming = False
+        calls_function = False
+        for chunk in response:
+            for part in chunk.candidates[0].content.parts:
+                if part.function_call:
+                    calls_function = True
+                elif part.text and not calls_function:
+                    if streaming:
+                        on_text(part.text)
+                        continue
+                    held.append(part.text)
+                    held_bytes += len(part.text.encode('utf-8'))
+                    if held_bytes > MAX_PAYLOAD_LEN:
+                        streaming = True
+                        on_text("".join(held))
+                        held = []
+        if held and not calls_function:
+            on_text("".join(held))
+        elif calls_function and streaming:
+            log('advertencia', "La IA pidió funciones después de empezar a enviar su respuesta en streaming.")
+        return response
+
+def get_ai_response(text, sender_id, on_text=None, public=False):
+    """
+    Respuesta de la IA a un mensaje de sender_id, dentro de su conversación. Con public=True
+    (respuestas públicas que se guardan en la caché y sirven para cualquiera) se usa una sesión
+    nueva sin historial ni datos del usuario, y la respuesta no se guarda en su conversación.
+    """
+    if not AI_ENABLED:
+        AI_REQUESTS.inc(result='disabled')
+        return AI_DISABLED_MESSAGE
+    user_conversation = None
     try:
-        genai.configure(api_key=config.GEMINI_API_KEY)
-        
         user_context = ""
-        user_node = database.get_node_by_id(sender_id)
+        user_node = database.get_node_by_id(sender_id) if not public else None
         if user_node:
             user_name = user_node['long_name'] or user_node['short_name'] or f"!{sender_id:08x}"
             user_context = f"Estás hablando con el usuario '{user_name}' (ID !{sender_id:08x}). "
             if user_node['latitude'] is not None:
                 user_context += f"Su última ubicación conocida es Lat: {user_node['latitude']:.4f}, Lon: {user_node['longitude']:.4f}. "
 
-        identity_str = (
-            f"Eres MeshBot, un asistente de IA factual y directo. Tu propia identidad en la red es: Nombre Largo='{config.OUR_LONG_NAME}', "
-            f"Nombre Corto='{config.OUR_SHORT_NAME}', ID='{OUR_NODE_ID_HEX}'. "
-        )
-        if config.POSITION_ENABLED and config.BOT_LATITUDE != 0.0:
-            identity_str += f"Mi ubicación fija es Latitud {config.BOT_LATITUDE:.4f}, Longitud {config.BOT_LONGITUDE:.4f}. "
-
-        # MODIFICADO: Prompt del sistema actualizado para mayor flexibilidad y sin info de config.
-        system_instruction = (
-            identity_str +
-            "**Reglas de Contexto e Identidad (MUY IMPORTANTE):**\n"
-            "1. **Tu Identidad:** Si el usuario pregunta por tu identidad (quién eres, tu nombre, tu ID, tu nodo, tu ubicación, dónde estás), DEBES responder usando la información de 'Tu propia identidad en la red' y 'Mi ubicación fija' que se te proporciona al principio de estas instrucciones. NO uses herramientas para esto.\n"
-            "2. **Identidad del Usuario:** Si el usuario pregunta por su propia información ('mi nodo', 'mi ubicación', 'dónde estoy'), DEBES usar el ID del usuario que se te proporciona para buscar su información con la herramienta `get_node_info_for_ai`.\n"
-            "3. **Contexto de Conversación:** Presta atención al historial. Si una pregunta es ambigua como '¿y su ubicación?', asume que se refiere al último sujeto del que hablaron (ya sea tú, el usuario, u otro nodo).\n\n"
-            "Tu objetivo principal es proporcionar respuestas precisas y concisas. **No uses saludos, despedidas ni ningún tipo de relleno conversacional.** Ve directamente al grano.\n\n"
-            "**Cómo Responder:**\n"
-            "1. **Prioriza las Herramientas:** Si la pregunta del usuario puede ser respondida de forma precisa por una de tus herramientas, úsala. Las herramientas son para:\n"
-            "   - `get_weather_data`: Para el tiempo, clima o temperatura.\n"
-            "   - `get_current_time`: Para la hora o fecha actual.\n"
-            "   - `get_node_info_for_ai`: Para datos específicos sobre nodos de la red (telemetría, ubicación, etc.).\n"
-            "2. **Conocimiento General:** Si la pregunta no encaja con ninguna de las herramientas, responde usando tu conocimiento general. Sé útil y proporciona la información que se te solicita.\n"
-            "3. **Sé Conciso:** Siempre da respuestas breves y directas, ideales para las pantallas de los dispositivos de radio.\n"
-            "4. **Si no sabes, dilo:** Si una pregunta es demasiado compleja o no tienes la información, es mejor decir que no la tienes a inventar una respuesta."
-        )
-        
-        model = genai.GenerativeModel(
-            'gemini-1.5-flash-latest', 
-            tools=[get_weather_tool, get_time_tool, get_node_data_tool], 
-            system_instruction=system_instruction
-        )
-        chat = model.start_chat(history=CONVERSATION_HISTORY.get(sender_id, []))
-        
-        final_prompt = f"{user_context}El usuario dice: '{text}'"
+        if public:
+            chat = get_ai_model().start_chat(history=[])
+            tool_sender_id = None
+            final_prompt = (
+                "Pregunta pública en el canal; la respuesta se difunde a todos, así que no depende de quién "
+                f"pregunta. Si hace falta un lugar o un nodo y no se indica, dilo. El usuario dice: '{text}'"
+            )
+        else:
+            # Los mensajes de un mismo usuario se procesan siempre en el mismo hilo,
+            # así que su sesión nunca se usa desde dos sitios a la vez.
+            user_conversation = CONVERSATIONS.get(sender_id)
+            # La sesión lleva solo el resumen y los últimos turnos (ver conversation.py).
+            user_conversation.begin()
+            chat = user_conversation.chat
+            tool_sender_id = sender_id
+            final_prompt = f"{user_context}El usuario dice: '{text}'"
         
         log('debug', f"Enviando a Gemini para !{sender_id:08x}: '{final_prompt}'")
-        response = chat.send_message(final_prompt)
+        response = send_to_gemini(chat, final_prompt, on_text)
         
         while True:
             # CORRECCIÓN: Bucle para manejar múltiples llamadas a función
@@ -306,81 +579,170 @@ def get_ai_response(text, sender_id):
             if not function_calls:
                 # No hay más llamadas a función, la respuesta final está lista
                 response_text = response.candidates[0].content.parts[0].text.strip().replace('\n', ' ')
-                CONVERSATION_HISTORY[sender_id] = chat.history
+                if user_conversation is not None:
+                    user_conversation.commit()
+                    CONVERSATION_MEMORY.trim(user_conversation)
+                    CONVERSATIONS.save(user_conversation)
+                AI_REQUESTS.inc(result='ok')
                 return response_text
 
-            # Hay llamadas a función, las ejecutamos todas
-            log('info', f"Gemini quiere llamar a {len(function_calls)} función(es).")
-            
-            function_responses = []
-            for function_call in function_calls:
-                log('info', f"Ejecutando: {function_call.name}")
-                api_response = None
-                if function_call.name == 'get_weather_data':
-                    city_arg = function_call.args.get('city')
-                    if city_arg: api_response = get_weather_data(city=city_arg)
-                    else: log('warning', "Llamada a get_weather_data sin 'city'."); api_response = "Error: falta la ciudad."
-                elif function_call.name == 'get_current_time':
-                    api_response = get_current_time()
-                elif function_call.name == 'get_node_info_for_ai':
-                    node_arg = function_call.args.get('node_identifier')
-                    if node_arg: api_response = get_node_info_for_ai(node_identifier=node_arg)
-                    else: log('warning', "Llamada a get_node_info_for_ai sin 'node_identifier'."); api_response = "Error: falta el nodo."
-                
-                function_responses.append(genai.protos.Part(
-                    function_response=genai.protos.FunctionResponse(
-                        name=function_call.name,
-                        response={'result': api_response or "Error ejecutando función."}
-                    )
-                ))
+            # Hay llamadas a función: se ejecutan todas a la vez y se responden en el mismo orden.
+            log('info', f"Gemini quiere llamar a {len(function_calls)} función(es): {', '.join(fc.name for fc in function_calls)}")
+            results = AI_TOOL_RUNNER.run([(fc.name, fc.args) for fc in function_calls], tool_sender_id)
+            function_responses = [
+                genai.protos.Part(function_response=genai.protos.FunctionResponse(name=fc.name, response={'result': result}))
+                for fc, result in zip(function_calls, results)
+            ]
 
             # Enviamos todas las respuestas de las funciones a la vez
             log('info', f"Enviando {len(function_responses)} resultado(s) de vuelta a Gemini.")
-            response = chat.send_message(function_responses)
+            response = send_to_gemini(chat, function_responses, on_text)
 
     except Exception as e:
+        if user_conversation is not None:
+            # Se deshace el turno a medias (p. ej. una llamada a función sin respuesta).
+            try:
+                user_conversation.rollback()
+            except Exception:
+                CONVERSATIONS.discard(sender_id)
+        AI_REQUESTS.inc(result='error')
         log('error', f"Error en la interacción con Gemini: {e}")
-        return "Tuve un problema al procesar tu solicitud con la IA."
+        return AI_ERROR_MESSAGE
+
+def format_elapsed(seconds):
+    return "unos segundos" if seconds < 60 else f"{int(seconds // 60)} min"
+
+def answer_public_query(client, query_text, sender_id, channel_name):
+    """
+    Responde en el canal a una consulta pública a @meshbot, pasando por la caché de respuestas.
+    Si la misma pregunta se respondió en el canal hace poco, no se repite la difusión:
+    solo se avisa al usuario por DM de que ya está respondida.
+    """
+    normalized = response_cache.normalize_query(query_text)
+    intent = response_cache.classify(normalized)
+    if RESPONSE_CACHE is None or intent is None:
+        PUBLIC_QUERIES.inc(result='uncached')
+        send_ai_response(client, BROADCAST_NUM, query_text, sender_id, channel_name)
+        return
+
+    def compute():
+        # La respuesta se guarda para todos: se genera sin los datos ni el historial de quien pregunta.
+        response_text = send_ai_response(client, BROADCAST_NUM, query_text, sender_id, channel_name, public=True)
+        return None if response_text == AI_ERROR_MESSAGE else response_text
+
+    def on_ready(entry, computed):
+        # Si la misma pregunta ya se estaba respondiendo, se llama desde el hilo que la responde.
+        if computed:
+            PUBLIC_QUERIES.inc(result='miss')
+            return
+        if entry is None:
+            # La consulta igual que se estaba respondiendo falló: se responde esta por separado.
+            PUBLIC_QUERIES.inc(result='uncached')
+            send_ai_response(client, BROADCAST_NUM, query_text, sender_id, channel_name)
+            return
+
+        elapsed = RESPONSE_CACHE.recently_sent(entry)
+        if elapsed is not None:
+            PUBLIC_QUERIES.inc(result='repeat')
+            log('info', f"Consulta repetida de !{sender_id:08x}; ya se respondió en '{channel_name}' hace {format_elapsed(elapsed)}.")
+            send_long_message(client, sender_id, f"Respondí a esa misma pregunta en el canal hace {format_elapsed(elapsed)}.", channel_name)
+            return
+        PUBLIC_QUERIES.inc(result='hit')
+        log('info', f"Respuesta a !{sender_id:08x} servida desde la caché ({intent}).")
+        send_long_message(client, BROADCAST_NUM, entry.text, channel_name)
+        RESPONSE_CACHE.mark_sent(entry)
+
+    RESPONSE_CACHE.get_or_compute((channel_name, normalized), intent, compute, on_ready)
 
 # --- PROCESAMIENTO DE MENSAJES ENTRANTES ---
+def port_name(port_num):
+    """Nombre del puerto de Meshtastic (p. ej. 'TEXT_MESSAGE_APP'), o su número si no se conoce."""
+    try:
+        return portnums_pb2.PortNum.Name(port_num)
+    except ValueError:
+        return str(port_num)
+
+def parse_service_envelope(raw_payload):
+    """
+    Decodifica el sobre MQTT y descarta los paquetes propios o ya procesados.
+    Es la parte barata del procesamiento y se ejecuta en el hilo de red.
+    Devuelve el ServiceEnvelope o None si el paquete debe ignorarse.
+    """
+    se = mqtt_pb2.ServiceEnvelope(); se.ParseFromString(raw_payload)
+    return filter_service_envelope(se)
+
+def filter_service_envelope(se):
+    """Devuelve el ServiceEnvelope ya decodificado, o None si es un paquete propio o duplicado."""
+    mp = se.packet
+    sender_id = getattr(mp, 'from')
+
+    if sender_id == config.OUR_NODE_NUMBER:
+        return None
+
+    # Cada pasarela que oye el paquete envía su copia: se anotan todas antes de descartar los duplicados.
+    TOPOLOGY.observe(sender_id, mp.id, topology.parse_node_id(se.gateway_id), mp.hop_start, mp.hop_limit, mp.rx_rssi, mp.rx_snr)
+
+    if PACKET_DEDUP.check_and_add(sender_id, mp.id):
+        PACKETS_DUPLICATE.inc()
+        return None
+
+    database.add_processed_packet(sender_id, mp.id)
+    return se
+
 def process_incoming_meshtastic_packet(client, raw_payload, topic):
+    """Procesa un paquete de principio a fin en el hilo actual."""
+    try:
+        se = parse_service_envelope(raw_payload)
+    except Exception as e:
+        log('error', f"Error procesando paquete entrante: {e}")
+        return
+    if se is not None:
+        handle_service_envelope(client, se)
+
+def decrypt_packet(mp, sender_id, channel_id):
+    """
+    Descifra el paquete con el canal de su channel_id o, si no es un canal conocido,
+    probando los canales con el mismo hash. Devuelve el canal usado, o None si no se pudo.
+    """
+    candidates = CHANNELS.candidates(channel_id, mp.channel)
+    for channel in candidates:
+        try:
+            mp.decoded.ParseFromString(channel.decrypt(mp.id, sender_id, mp.encrypted))
+            return channel
+        except Exception:
+            continue
+    if candidates:
+        DECRYPT_FAILURES.inc(channel=channel_id)
+        log('error', f"Fallo al descifrar mensaje de !{sender_id:08x} en '{channel_id}'. Clave incorrecta o paquete corrupto.")
+    return None
+
+def handle_service_envelope(client, se):
+    """Descifra el paquete y ejecuta la lógica correspondiente a su puerto."""
     try:
-        se = mqtt_pb2.ServiceEnvelope(); se.ParseFromString(raw_payload)
         mp = se.packet
         sender_id = getattr(mp, 'from')
-        
-        if sender_id == config.OUR_NODE_NUMBER:
-            return
-        
-        if database.message_id_exists(mp.id):
-            return
-        
-        database.add_message_id(mp.id)
         source_channel = se.channel_id
+        channel = CHANNELS.get(source_channel)
 
         if mp.HasField('encrypted'):
-            key_to_use = None
-            
-            if source_channel == config.PRIMARY_CHANNEL_NAME:
-                key_to_use = config.PRIMARY_CHANNEL_KEY_B64
-            elif config.SECONDARY_CHANNEL_ENABLED and source_channel == config.SECONDARY_CHANNEL_NAME:
-                key_to_use = config.SECONDARY_CHANNEL_KEY_B64
-            
-            if not key_to_use:
-                return
-
-            try:
-                decrypted_bytes = decrypt_payload(key_to_use, mp.id, sender_id, mp.encrypted)
-                mp.decoded.ParseFromString(decrypted_bytes)
-            except Exception as e:
-                log('error', f"Fallo al descifrar mensaje de !{sender_id:08x} en '{source_channel}'. Clave incorrecta o paquete corrupto.")
+            channel = decrypt_packet(mp, sender_id, source_channel)
+            if channel is None:
                 return
+            source_channel = channel.name
 
         if not mp.HasField('decoded'):
             return
 
         port_num = mp.decoded.portnum
         log_channel_msg = f"en canal '{source_channel}'"
+        PACKETS_RECEIVED.inc(portnum=port_name(port_num), channel=source_channel)
+
+        # Cada canal solo hace lo que le permiten sus funciones. Los paquetes que llegan
+        # ya descifrados de un canal no configurado (p. ej. DMs) se procesan siempre.
+        if port_num in TELEMETRY_PORTS and channel is not None and not channel.telemetry:
+            return
+        if port_num in TEXT_PORTS and channel is not None and not channel.interaction:
+            return
 
         if port_num == portnums_pb2.NODEINFO_APP:
             user_info = mesh_pb2.User(); user_info.ParseFromString(mp.decoded.payload)
@@ -420,21 +782,49 @@ def process_incoming_meshtastic_packet(client, raw_payload, topic):
                     barometric_pressure=pressure
                 )
 
-        # --- CAMBIO PRINCIPAL AQUÍ ---
-        # Se elimina la comprobación del canal para que los mensajes de texto se procesen en ambos canales
-        elif port_num == portnums_pb2.TEXT_MESSAGE_APP:
-            text = mp.decoded.payload.decode('utf-8', 'ignore')
+        elif port_num == portnums_pb2.NEIGHBORINFO_APP:
+            neighbor_info = mesh_pb2.NeighborInfo(); neighbor_info.ParseFromString(mp.decoded.payload)
+            node_id = neighbor_info.node_id or sender_id
+            TOPOLOGY.add_neighbors(node_id, [(neighbor.node_id, neighbor.snr) for neighbor in neighbor_info.neighbors])
+            log('info', f"NeighborInfo de !{node_id:08x}: {len(neighbor_info.neighbors)} vecinos {log_channel_msg}")
+
+        elif port_num == portnums_pb2.TRACEROUTE_APP:
+            route = mesh_pb2.RouteDiscovery(); route.ParseFromString(mp.decoded.payload)
+            snr_towards = [snr / 4 if snr != TRACEROUTE_SNR_UNKNOWN else None for snr in route.snr_towards]
+            if mp.decoded.request_id:
+                # Respuesta: la ruta de ida va de quien lo pidió (el destino de la respuesta) a quien responde.
+                TOPOLOGY.add_route([mp.to] + list(route.route) + [sender_id], snr_towards)
+                snr_back = [snr / 4 if snr != TRACEROUTE_SNR_UNKNOWN else None for snr in route.snr_back]
+                TOPOLOGY.add_route([sender_id] + list(route.route_back) + [mp.to], snr_back)
+            else:
+                # Petición aún en camino: solo se conoce el tramo recorrido.
+                TOPOLOGY.add_route([sender_id] + list(route.route), snr_towards)
+            log('info', f"Traceroute de !{sender_id:08x}: {len(route.route)} saltos intermedios {log_channel_msg}")
+
+        elif port_num == portnums_pb2.ROUTING_APP:
+            if mp.to != config.OUR_NODE_NUMBER or not mp.decoded.request_id:
+                return
+            routing = mesh_pb2.Routing(); routing.ParseFromString(mp.decoded.payload)
+            packet = DELIVERY.handle_routing(mp.decoded.request_id, sender_id, routing.error_reason)
+            if packet is not None and routing.error_reason == mesh_pb2.Routing.NONE:
+                log('info', f"ACK de !{sender_id:08x} para {packet.label} {log_channel_msg}")
+
+        elif port_num in TEXT_PORTS:
+            text = textcodec.decode_text(port_num, mp.decoded.payload)
+            if text is None:
+                log('advertencia', f"Texto comprimido de !{sender_id:08x} ignorado: falta el paquete unishox2-py3.")
+                return
+            if port_num == portnums_pb2.TEXT_MESSAGE_COMPRESSED_APP:
+                TEXT_ENCODER.mark_capable(sender_id)
             
             if mp.to == config.OUR_NODE_NUMBER:
                 log('info', f"DM de !{sender_id:08x} en '{source_channel}': '{text}'")
-                response_text = ""
                 if text.startswith(config.COMMAND_PREFIX):
-                    response_text = bot_commands.handle_command(text, CONVERSATION_HISTORY, sender_id)
+                    response_text = bot_commands.handle_command(text, CONVERSATIONS, sender_id)
+                    if response_text:
+                        send_long_message(client, sender_id, response_text, source_channel)
                 else:
-                    response_text = get_ai_response(text, sender_id)
-
-                if response_text:
-                    send_long_message(client, sender_id, response_text, source_channel)
+                    send_ai_response(client, sender_id, text, sender_id, source_channel)
                 return
 
             elif mp.to == BROADCAST_NUM and text.strip().lower().startswith('@meshbot'):
@@ -443,24 +833,22 @@ def process_incoming_meshtastic_packet(client, raw_payload, topic):
                 if len(original_text_parts) > 1 and original_text_parts[1].lower() not in PRIVATE_REQUEST_KEYWORDS:
                     query_text = original_text_parts[1]
                     log('info', f"Consulta pública de !{sender_id:08x} para @meshbot: '{query_text}'")
-                    response_text = get_ai_response(query_text, sender_id)
-                    if response_text:
-                        send_long_message(client, BROADCAST_NUM, response_text, source_channel)
+                    answer_public_query(client, query_text, sender_id, source_channel)
                     
                     now = datetime.now()
-                    last_sent = LAST_INVITATION_SENT.get(sender_id)
+                    last_sent = CONVERSATIONS.last_invitation(sender_id)
                     
                     if not last_sent or (now - last_sent) > timedelta(minutes=config.INVITATION_COOLDOWN_MINUTES):
                         log('info', f"Enviando invitación a DM a !{sender_id:08x} (Cooldown finalizado).")
                         invitation_text = "He respondido en el canal. Si prefieres, puedes hablar conmigo en privado."
                         send_long_message(client, sender_id, invitation_text, source_channel)
-                        LAST_INVITATION_SENT[sender_id] = now
+                        CONVERSATIONS.set_last_invitation(sender_id, now)
                     else:
                         log('info', f"No se envía invitación a DM a !{sender_id:08x} (En Cooldown).")
 
                 else:
                     log('info', f"Invocación de @meshbot por !{sender_id:08x}. Enviando ayuda a DM.")
-                    response_text = bot_commands.handle_command("!meshbot", CONVERSATION_HISTORY, sender_id)
+                    response_text = bot_commands.handle_command("!meshbot", CONVERSATIONS, sender_id)
                     send_long_message(client, sender_id, response_text, source_channel)
                 return
 
@@ -473,81 +861,223 @@ def on_connect(client, userdata, flags, rc, properties):
     if rc == 0:
         log('info', f"Conectado a {config.MQTT_BROKER}")
         
-        primary_channel_topic = f"{config.ROOT_TOPIC}/2/e/{config.PRIMARY_CHANNEL_NAME}/#"
-        client.subscribe(primary_channel_topic)
-        log('info', f"Suscrito al topic del canal primario: {primary_channel_topic}")
+        for topic in dict.fromkeys(channel.subscribe_topic for channel in CHANNELS):
+            client.subscribe(CLUSTER.subscription(topic))
+            log('info', f"Suscrito al topic: {CLUSTER.subscription(topic)}")
 
-        if config.SECONDARY_CHANNEL_ENABLED:
-            secondary_channel_topic = f"{config.ROOT_TOPIC}/2/e/{config.SECONDARY_CHANNEL_NAME}/#"
-            client.subscribe(secondary_channel_topic)
-            log('info', f"Suscrito al topic del canal secundario: {secondary_channel_topic}")
-
-        dm_topic = f"{config.ROOT_TOPIC}/2/c/{OUR_NODE_ID_HEX}"
+        dm_topic = CLUSTER.subscription(f"{config.ROOT_TOPIC}/2/c/{OUR_NODE_ID_HEX}")
         client.subscribe(dm_topic)
         log('info', f"Suscrito al topic de DM: {dm_topic}")
 
+        if CLUSTER.enabled:
+            client.subscribe(CLUSTER.inbox_topic)
+            log('info', f"Worker {CLUSTER.worker_index + 1} de {CLUSTER.worker_count}. Recibiendo reenvíos en: {CLUSTER.inbox_topic}")
+
         log('info', f"Bot '{config.OUR_LONG_NAME}' ({OUR_NODE_ID_HEX}) en modo escucha...")
-        if config.PRESENCE_ENABLED: 
-            threading.Thread(target=presence_scheduler, args=(client,), daemon=True).start()
+        if config.PRESENCE_ENABLED and CLUSTER.is_leader:
+            # on_connect se repite en cada reconexión; la tarea solo se registra la primera vez.
+            SCHEDULER.add_job('presence', lambda: publish_presence(client), config.PRESENCE_INTERVAL_MINUTES * 60,
+                              first_delay=0, jitter_seconds=getattr(config, 'SCHEDULER_JITTER_SECONDS', 30))
     else: 
         log('error', f"Fallo al conectar al bróker MQTT, código: {rc}."); client.disconnect()
 
-def on_message(client, userdata, msg): process_incoming_meshtastic_packet(client, msg.payload, msg.topic)
+def on_message(client, userdata, msg):
+    forwarded = CLUSTER.is_forwarded(msg.topic)
+    if CAPTURE is not None and not forwarded:
+        CAPTURE.write(msg.topic, msg.payload)
+    try:
+        se = mqtt_pb2.ServiceEnvelope(); se.ParseFromString(msg.payload)
+        sender_id = getattr(se.packet, 'from')
+        # Los paquetes de remitentes de otro worker se le reenvían sin procesarlos aquí.
+        if not CLUSTER.owns(sender_id) and sender_id != config.OUR_NODE_NUMBER:
+            CLUSTER.forward(client, sender_id, msg.payload)
+            PACKETS_FORWARDED.inc()
+            return
+        se = filter_service_envelope(se)
+    except Exception as e:
+        log('error', f"Error procesando paquete entrante: {e}")
+        return
+    if se is None:
+        return
+    if not PACKET_DISPATCHER.submit(sender_id, handle_service_envelope, client, se):
+        PACKETS_DROPPED.inc()
+        log('advertencia', f"Cola de procesamiento llena. Paquete de !{sender_id:08x} descartado.")
+
 def on_disconnect(client, userdata, d, rc, p): log('advertencia', f"Desconectado (código: {rc}).")
 
-def broadcast_scheduler(client):
-    if not config.BROADCAST_ENABLED or not config.SECONDARY_CHANNEL_ENABLED: return
-    log('info', f"Anuncios automáticos habilitados para '{config.SECONDARY_CHANNEL_NAME}'.")
-    while True:
-        time.sleep(config.BROADCAST_INTERVAL_MINUTES * 60)
-        log('info', f"Enviando anuncio a '{config.SECONDARY_CHANNEL_NAME}'...")
-        publish_meshtastic_message(client, BROADCAST_NUM, config.BROADCAST_MESSAGE, config.SECONDARY_CHANNEL_NAME)
+def send_broadcast(client):
+    """Tarea periódica: envía BROADCAST_MESSAGE a los canales con la función de anuncios."""
+    for channel in CHANNELS.with_role(channels.ROLE_BROADCAST):
+        log('info', f"Enviando anuncio a '{channel.name}'...")
+        publish_meshtastic_message(client, BROADCAST_NUM, config.BROADCAST_MESSAGE, channel.name, priority=outbound.PRIORITY_BROADCAST)
 
-def presence_scheduler(client):
-    log('info', "Anuncios de presencia habilitados.")
+def publish_presence(client):
+    """Tarea periódica: anuncia el NodeInfo y la posición del bot."""
     publish_nodeinfo(client)
     publish_position(client)
-    while True:
-        time.sleep(config.PRESENCE_INTERVAL_MINUTES * 60)
-        publish_nodeinfo(client)
-        publish_position(client)
-
-def database_cleanup_scheduler():
-    """Tarea programada que se ejecuta una vez al día para limpiar la base de datos."""
-    log('info', "Limpieza de base de datos programada habilitada. Se ejecutará cada 24 horas.")
-    while True:
-        time.sleep(24 * 60 * 60)
-        log('info', "Iniciando limpieza periódica de la base de datos...")
-        try:
-            database.cleanup_old_messages()
-            database.cleanup_old_nodes(config.NODE_DB_CLEANUP_DAYS)
-            log('info', "Limpieza de la base de datos completada.")
-        except Exception as e:
-            log('error', f"Error durante la limpieza programada de la base de datos: {e}")
+
+def database_cleanup():
+    """Tarea periódica (una vez al día): limpia la base de datos."""
+    log('info', "Iniciando limpieza periódica de la base de datos...")
+    database.cleanup_old_messages()
+    database.cleanup_old_nodes(config.NODE_DB_CLEANUP_DAYS)
+    database.cleanup_telemetry_history()
+    database.cleanup_old_conversations(getattr(config, 'CONVERSATION_RETENTION_DAYS', 30))
+    log('info', "Limpieza de la base de datos completada.")
+
+def register_jobs(client):
+    """Registra las tareas periódicas que no dependen de la conexión con el bróker."""
+    if CLUSTER.is_leader:
+        SCHEDULER.add_job('database_cleanup', database_cleanup, 24 * 60 * 60)
+        log('info', "Limpieza de base de datos programada habilitada. Se ejecutará cada 24 horas.")
+    # Olvida los nodos y enlaces de la topología que llevan tiempo sin verse.
+    SCHEDULER.add_job('topology_prune', lambda: TOPOLOGY.prune(getattr(config, 'TOPOLOGY_MAX_AGE_HOURS', 24) * 60 * 60), 60 * 60)
+    # Reenvía las partes de mensajes directos que no han recibido confirmación a tiempo.
+    SCHEDULER.add_job('delivery_check', DELIVERY.check, getattr(config, 'DELIVERY_CHECK_SECONDS', 5))
+    if CLUSTER.enabled:
+        # Con varios procesos, incorpora los nodos que han guardado los demás.
+        SCHEDULER.add_job('index_refresh', database.refresh_indexes, getattr(config, 'CLUSTER_INDEX_REFRESH_SECONDS', 10))
+    broadcast_channels = CHANNELS.with_role(channels.ROLE_BROADCAST)
+    if config.BROADCAST_ENABLED and CLUSTER.is_leader and broadcast_channels:
+        SCHEDULER.add_job('broadcast', lambda: send_broadcast(client), config.BROADCAST_INTERVAL_MINUTES * 60,
+                          jitter_seconds=getattr(config, 'SCHEDULER_JITTER_SECONDS', 30))
+        log('info', f"Anuncios automáticos habilitados para: {', '.join(channel.name for channel in broadcast_channels)}.")
 
 # --- FUNCIÓN PRINCIPAL ---
 def main():
     log('info', f"Iniciando 🤖 {config.OUR_LONG_NAME} v0.0.1...")
     database.init_db()
+    if getattr(config, 'METRICS_ENABLED', False):
+        try:
+            metrics.start_http_server(getattr(config, 'METRICS_HOST', '127.0.0.1'), METRICS_PORT)
+        except OSError as e:
+            log('error', f"No se pudo iniciar el servidor de métricas en el puerto {METRICS_PORT}: {e}")
+    PACKET_DEDUP.load(database.load_processed_packets(getattr(config, 'DEDUP_WINDOW_MINUTES', 60)))
+    PACKET_DISPATCHER.start()
+    OUTBOUND.start()
+    if CAPTURE is not None:
+        CAPTURE.start()
     
-    threading.Thread(target=database_cleanup_scheduler, args=(), daemon=True).start()
-
-    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+    if CLUSTER.enabled:
+        # Las suscripciones compartidas ($share/...) requieren MQTT v5.
+        client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id=f"meshbot-{CLUSTER.group}-{CLUSTER.worker_index}", protocol=mqtt.MQTTv5)
+    else:
+        client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
     client.on_connect, client.on_message, client.on_disconnect = on_connect, on_message, on_disconnect
     if config.MQTT_USERNAME: client.username_pw_set(config.MQTT_USERNAME, config.MQTT_PASSWORD)
     if config.MQTT_PORT == 8883: client.tls_set()
+    register_jobs(client)
+    SCHEDULER.start()
     try:
         log('info', f"Conectando a {config.MQTT_BROKER}:{config.MQTT_PORT}...")
         client.connect(config.MQTT_BROKER, config.MQTT_PORT, 60)
-        if config.BROADCAST_ENABLED: 
-            threading.Thread(target=broadcast_scheduler, args=(client,), daemon=True).start()
         client.loop_forever()
     except KeyboardInterrupt: 
         log('info', "Proceso interrumpido.")
     except Exception as e: 
         log('error', f"Error en bucle principal: {e}")
     finally: 
-        client.disconnect(); log('info', "Bot detenido.")
+        SCHEDULER.stop()
+        PACKET_DISPATCHER.stop()
+        AI_TOOL_RUNNER.shutdown()
+        CONVERSATION_MEMORY.shutdown()
+        OUTBOUND.stop()
+        if CAPTURE is not None:
+            CAPTURE.stop()
+            log('info', f"Estadísticas de captura: {CAPTURE.stats()}")
+        client.disconnect()
+        database.close_db()
+        log('info', f"Estadísticas del despachador: {PACKET_DISPATCHER.stats()}")
+        log('info', f"Estadísticas de transmisión: {OUTBOUND.stats()}")
+        log('info', "Bot detenido.")
+
+# --- REPRODUCCIÓN DE CAPTURAS ---
+class ReplayClient:
+    """Cliente MQTT falso para las reproducciones: las respuestas del bot no salen a la red."""
+
+    def __init__(self):
+        self.published = 0
+
+    def publish(self, topic, payload, *args, **kwargs):
+        self.published += 1
+        log('debug', f"[replay] Publicación descartada en '{topic}' ({len(payload)} bytes).")
+
+def replay_main(paths, fast=False, speed=1.0, db_path=None, ai=True):
+    """
+    Pasa una o varias capturas por process_incoming_meshtastic_packet, sin bróker. Sin db_path
+    se usa una base de datos temporal que se borra al terminar, nunca la configurada; con
+    ai=False no se consulta a la IA.
+    """
+    global AI_ENABLED
+    temp_dir = None
+    if db_path is None:
+        temp_dir = tempfile.mkdtemp(prefix='meshbot-replay-')
+        db_path = os.path.join(temp_dir, 'replay.db')
+    config.DATABASE_FILE = db_path
+    AI_ENABLED = ai
+    log('info', f"Reproduciendo {', '.join(paths)} ({'lo más rápido posible' if fast else f'a velocidad x{speed:g}'}) "
+                f"con la base de datos '{db_path}'{'' if ai else ', sin IA'}...")
+    database.init_db()
+    client = ReplayClient()
+    OUTBOUND.start()
+    started = time.monotonic()
+    try:
+        count = capture.replay(
+            paths,
+            lambda topic, payload: process_incoming_meshtastic_packet(client, payload, topic),
+            realtime=not fast,
+            speed=speed
+        )
+    except KeyboardInterrupt:
+        log('info', "Reproducción interrumpida.")
+        return
+    finally:
+        discarded = OUTBOUND.backlog()
+        OUTBOUND.stop()
+        database.close_db()
+        if temp_dir is not None:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+    elapsed = time.monotonic() - started
+    log('info', f"Reproducidos {count} mensajes en {elapsed:.2f} s ({count / elapsed if elapsed else 0:.0f} mensajes/s). "
+                f"Duplicados: {PACKET_DEDUP.duplicates}. Respuestas descartadas: {client.published + discarded}.")
+
+def publish_capture_main(paths, fast=False, speed=1.0):
+    """
+    Publica las capturas en el bróker configurado con sus topics originales, para probar
+    de extremo a extremo uno o varios workers conectados a un bróker local.
+    """
+    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+    if config.MQTT_USERNAME: client.username_pw_set(config.MQTT_USERNAME, config.MQTT_PASSWORD)
+    if config.MQTT_PORT == 8883: client.tls_set()
+    log('info', f"Publicando {', '.join(paths)} en {config.MQTT_BROKER}:{config.MQTT_PORT}...")
+    client.connect(config.MQTT_BROKER, config.MQTT_PORT, 60)
+    client.loop_start()
+    try:
+        count = capture.replay(paths, lambda topic, payload: client.publish(topic, payload), realtime=not fast, speed=speed)
+        log('info', f"Publicados {count} mensajes.")
+    except KeyboardInterrupt:
+        log('info', "Publicación interrumpida.")
+    finally:
+        client.disconnect()
+        client.loop_stop()
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="MeshBot: un bot de servidor para Meshtastic.")
+    parser.add_argument('--replay', nargs='+', metavar='CAPTURA',
+                        help="Reproduce ficheros (o directorios) de captura en vez de conectarse al bróker.")
+    parser.add_argument('--fast', action='store_true', help="Con --replay, reproduce lo más rápido posible.")
+    parser.add_argument('--speed', type=float, default=1.0, help="Con --replay, factor de velocidad respecto al tráfico original.")
+    parser.add_argument('--publish', action='store_true', help="Con --replay, publica las capturas en el bróker en vez de procesarlas.")
+    parser.add_argument('--db', metavar='FICHERO',
+                        help="Con --replay, base de datos a usar (por defecto, una temporal que se borra al terminar).")
+    parser.add_argument('--no-ai', action='store_true', help="Con --replay, no consulta a la IA: responde con un texto fijo.")
+    return parser.parse_args()
 
 if __name__ == "__main__":
-    main()
+    args = parse_args()
+    if args.replay and args.publish:
+        publish_capture_main(args.replay, fast=args.fast, speed=args.speed)
+    elif args.replay:
+        replay_main(args.replay, fast=args.fast, speed=args.speed, db_path=args.db, ai=not args.no_ai)
+    else:
+        main()
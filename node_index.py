@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+"""
+Módulo de Índice de Nombres de Nodos para MeshBot.
+
+Mantiene en memoria los nombres (largo y corto) de todos los nodos conocidos para
+buscarlos sin recorrer la tabla: coincidencia exacta y por prefijo sin distinguir
+mayúsculas ni acentos, y búsqueda aproximada (trigramas + distancia de edición)
+para poder sugerir "¿Quisiste decir...?" cuando el nombre tiene erratas.
+"""
+
+import bisect
+import threading
+import unicodedata
+
+# Tipos de coincidencia, de mejor a peor.
+MATCH_EXACT = 0
+MATCH_PREFIX = 1
+MATCH_SUBSTRING = 2
+MATCH_FUZZY = 3
+
+# Número de candidatos por trigramas que se comparan con la distancia de edición.
+FUZZY_CANDIDATES = 64
+
+def fold_name(name):
+    """Normaliza un nombre: sin acentos ni selectores de variante, en minúsculas y sin espacios sobrantes."""
+    if not name:
+        return ''
+    decomposed = unicodedata.normalize('NFKD', str(name))
+    stripped = ''.join(char for char in decomposed if not unicodedata.combining(char) and char != '\ufe0f')
+    return ' '.join(stripped.casefold().split())
+
+def trigrams(folded):
+    padded = f"  {folded} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+def edit_distance(a, b, max_distance):
+    """Distancia de Levenshtein; devuelve max_distance + 1 en cuanto se sabe que la supera."""
+    if abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char_a != char_b)))
+        if min(current) > max_distance:
+            return max_distance + 1
+        previous = current
+    return previous[-1]
+
+class NameMatch:
+    __slots__ = ('node_id', 'name', 'kind', 'distance')
+
+    def __init__(self, node_id, name, kind, distance=0):
+        self.node_id = node_id
+        self.name = name
+        self.kind = kind
+        self.distance = distance
+
+    def __repr__(self):
+        return f"NameMatch(!{self.node_id:08x}, {self.name!r}, kind={self.kind}, distance={self.distance})"
+
+class NameIndex:
+    """
+    Índice de nombres de nodos, seguro para usarse desde varios hilos.
+
+    - _exact: nombre normalizado -> node_ids con ese nombre.
+    - _sorted: lista ordenada de (nombre normalizado, node_id) para buscar prefijos con bisect.
+    - _trigrams: trigrama -> node_ids, para encontrar candidatos parecidos sin recorrerlo todo.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._names = {}
+        self._exact = {}
+        self._sorted = []
+        self._trigrams = {}
+        self.loaded = False
+
+    def load(self, rows):
+        """Carga el índice completo a partir de filas (node_id, long_name, short_name)."""
+        with self._lock:
+            self._names.clear()
+            self._exact.clear()
+            self._sorted = []
+            self._trigrams.clear()
+            for node_id, long_name, short_name in rows:
+                self._add(node_id, long_name, short_name, keep_sorted=False)
+            self._sorted.sort()
+            self.loaded = True
+
+    def update(self, node_id, long_name, short_name):
+        with self._lock:
+            if self._names.get(node_id, (None, None))[:2] == (long_name, short_name):
+                return
+            self._remove(node_id)
+            self._add(node_id, long_name, short_name)
+
+    def remove(self, node_id):
+        with self._lock:
+            self._remove(node_id)
+
+    def _add(self, node_id, long_name, short_name, keep_sorted=True):
+        folded = {fold_name(name) for name in (long_name, short_name)} - {''}
+        self._names[node_id] = (long_name, short_name, folded)
+        for name in folded:
+            self._exact.setdefault(name, set()).add(node_id)
+            if keep_sorted:
+                bisect.insort(self._sorted, (name, node_id))
+            else:
+                self._sorted.append((name, node_id))
+            for gram in trigrams(name):
+                self._trigrams.setdefault(gram, set()).add(node_id)
+
+    def _remove(self, node_id):
+        entry = self._names.pop(node_id, None)
+        if entry is None:
+            return
+        for name in entry[2]:
+            self._discard(self._exact, name, node_id)
+            position = bisect.bisect_left(self._sorted, (name, node_id))
+            if position < len(self._sorted) and self._sorted[position] == (name, node_id):
+                del self._sorted[position]
+            for gram in trigrams(name):
+                self._discard(self._trigrams, gram, node_id)
+
+    @staticmethod
+    def _discard(mapping, key, node_id):
+        ids = mapping.get(key)
+        if ids is not None:
+            ids.discard(node_id)
+            if not ids:
+                del mapping[key]
+
+    def _display_name(self, node_id, folded_match):
+        long_name, short_name, _ = self._names[node_id]
+        if short_name and fold_name(short_name) == folded_match:
+            return short_name
+        return long_name or short_name
+
+    def find_exact(self, name):
+        """node_ids cuyo nombre largo o corto coincide exactamente (sin mayúsculas ni acentos)."""
+        with self._lock:
+            return sorted(self._exact.get(fold_name(name), ()))
+
+    def search(self, query, limit=5):
+        """
+        Devuelve hasta `limit` NameMatch ordenados de mejor a peor: primero coincidencias
+        exactas, luego por prefijo, luego nombres que contienen la búsqueda y por último
+        los más parecidos por distancia de edición.
+        """
+        folded = fold_name(query)
+        if not folded:
+            return []
+        best = {}
+
+        def consider(node_id, name, kind, distance=0):
+            rank = (kind, distance, len(name))
+            if node_id not in best or rank < best[node_id][0]:
+                best[node_id] = (rank, name)
+
+        with self._lock:
+            for node_id in self._exact.get(folded, ()):
+                consider(node_id, folded, MATCH_EXACT)
+
+            position = bisect.bisect_left(self._sorted, (folded,))
+            while position < len(self._sorted) and len(best) < limit * 4:
+                name, node_id = self._sorted[position]
+                if not name.startswith(folded):
+                    break
+                consider(node_id, name, MATCH_PREFIX)
+                position += 1
+
+            if len(best) < limit:
+                # Candidatos que comparten más trigramas con la búsqueda.
+                shared = {}
+                for gram in trigrams(folded):
+                    for node_id in self._trigrams.get(gram, ()):
+                        shared[node_id] = shared.get(node_id, 0) + 1
+                candidates = sorted(shared, key=shared.get, reverse=True)[:FUZZY_CANDIDATES]
+                max_distance = max(1, len(folded) // 3)
+                for node_id in candidates:
+                    for name in self._names[node_id][2]:
+                        if folded in name:
+                            consider(node_id, name, MATCH_SUBSTRING, len(name) - len(folded))
+                            continue
+                        distance = edit_distance(folded, name, max_distance)
+                        if distance <= max_distance:
+                            consider(node_id, name, MATCH_FUZZY, distance)
+
+            ranked = sorted(best.items(), key=lambda item: (item[1][0], item[0]))[:limit]
+            return [
+                NameMatch(node_id, self._display_name(node_id, name), rank[0], rank[1])
+                for node_id, (rank, name) in ranked
+            ]
+
+    def __len__(self):
+        with self._lock:
+            return len(self._names)
@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+"""
+Módulo de Transmisión para MeshBot.
+
+Todas las publicaciones de paquetes hacia la malla pasan por un único planificador.
+Quien envía solo encola el paquete y sigue con su trabajo; un hilo dedicado los publica
+respetando una prioridad por tipo de mensaje y un presupuesto de tiempo en el aire
+(airtime) por canal, estimado con la fórmula de LoRa.
+"""
+
+import heapq
+import itertools
+import math
+import threading
+import time
+import metrics
+from logutil import log
+
+# --- Clases de prioridad (menor número = más prioritario) ---
+PRIORITY_DM = 0
+PRIORITY_PUBLIC = 1
+PRIORITY_PRESENCE = 2
+PRIORITY_BROADCAST = 3
+
+PRIORITY_NAMES = {
+    PRIORITY_DM: 'dm',
+    PRIORITY_PUBLIC: 'public',
+    PRIORITY_PRESENCE: 'presence',
+    PRIORITY_BROADCAST: 'broadcast',
+}
+
+# Bytes de cabecera que Meshtastic añade a cada paquete en el aire.
+MESH_HEADER_LEN = 16
+
+QUEUE_DELAY = metrics.histogram('meshbot_outbound_queue_delay_seconds', "Tiempo que pasa cada paquete en la cola de transmisión, por prioridad.", ('priority',),
+                                buckets=(0.01, 0.1, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300))
+PACKETS_SENT = metrics.counter('meshbot_packets_sent_total', "Paquetes publicados en la malla, por canal.", ('channel',))
+AIRTIME_USED = metrics.counter('meshbot_airtime_seconds_total', "Tiempo en el aire estimado de los paquetes enviados, por canal.", ('channel',))
+
+def estimate_airtime(payload_len, spreading_factor, bandwidth_hz, coding_rate, preamble_symbols=16):
+    """
+    Tiempo en el aire (en segundos) de un paquete LoRa con cabecera explícita y CRC,
+    según la fórmula de Semtech. coding_rate es el denominador de 4/x (5 a 8).
+    """
+    symbol_time = (2 ** spreading_factor) / bandwidth_hz
+    low_data_rate = 1 if symbol_time > 0.016 else 0
+    payload_symbols = 8 + max(
+        math.ceil((8 * payload_len - 4 * spreading_factor + 28 + 16) / (4 * (spreading_factor - 2 * low_data_rate))) * coding_rate,
+        0
+    )
+    return (preamble_symbols + 4.25) * symbol_time + payload_symbols * symbol_time
+
+class OutboundPacket:
+    __slots__ = ('client', 'topic', 'payload', 'channel_name', 'priority', 'description', 'airtime', 'enqueued_at', 'on_sent')
+
+    def __init__(self, client, topic, payload, channel_name, priority, description, airtime, on_sent):
+        self.client = client
+        self.topic = topic
+        self.payload = payload
+        self.channel_name = channel_name
+        self.priority = priority
+        self.description = description
+        self.airtime = airtime
+        self.enqueued_at = time.monotonic()
+        self.on_sent = on_sent
+
+class _ChannelState:
+    """Cola y presupuesto de airtime (cubo de fichas) de un canal."""
+
+    def __init__(self, capacity, refill_rate):
+        self.queue = []
+        self.capacity = capacity
+        self.refill_rate = refill_rate
+        self.tokens = capacity
+        self.last_refill = time.monotonic()
+        self.next_allowed = 0.0
+        self.airtime_used = 0.0
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.refill_rate)
+        self.last_refill = now
+
+    def wait_time(self, airtime, now):
+        """Segundos que faltan para poder transmitir un paquete con ese airtime (0 si ya se puede)."""
+        needed = min(airtime, self.capacity)
+        token_wait = 0.0 if self.tokens >= needed else (needed - self.tokens) / self.refill_rate
+        return max(self.next_allowed - now, token_wait, 0.0)
+
+class OutboundScheduler:
+    """
+    Planificador de transmisión con prioridades y ritmo por canal.
+
+    Cada canal tiene un cubo de fichas medido en segundos de airtime: se rellena al
+    porcentaje de ciclo de trabajo configurado y admite ráfagas de hasta
+    duty_cycle * window_seconds. Además se respeta un intervalo mínimo entre paquetes
+    del mismo canal. Entre los canales que pueden transmitir, sale primero el paquete
+    de mayor prioridad; dentro de una misma prioridad se respeta el orden de llegada.
+    """
+
+    def __init__(self, duty_cycle_percent, window_seconds, min_interval_seconds, max_backlog,
+                 spreading_factor, bandwidth_hz, coding_rate):
+        self.duty_cycle = duty_cycle_percent / 100.0
+        self.window_seconds = window_seconds
+        self.min_interval = min_interval_seconds
+        self.max_backlog = max_backlog
+        self.spreading_factor = spreading_factor
+        self.bandwidth_hz = bandwidth_hz
+        self.coding_rate = coding_rate
+        self._condition = threading.Condition()
+        self._channels = {}
+        self._sequence = itertools.count()
+        self._backlog = 0
+        self._thread = None
+        self._running = False
+        self.sent = 0
+        self.dropped = 0
+        self.errors = 0
+        self._delay_sum = {priority: 0.0 for priority in PRIORITY_NAMES}
+        self._delay_count = {priority: 0 for priority in PRIORITY_NAMES}
+        self._delay_max = {priority: 0.0 for priority in PRIORITY_NAMES}
+        self.last_delay = 0.0
+
+    def airtime_for(self, payload_len):
+        return estimate_airtime(payload_len + MESH_HEADER_LEN, self.spreading_factor, self.bandwidth_hz, self.coding_rate)
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="outbound", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=5):
+        with self._condition:
+            self._running = False
+            self._condition.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        if self._backlog:
+            log('advertencia', f"Se descartan {self._backlog} paquetes pendientes de envío.")
+
+    def enqueue(self, client, topic, payload, channel_name, priority, description=None, airtime_bytes=None, on_sent=None):
+        """
+        Encola un paquete para publicarlo y vuelve de inmediato. Devuelve False si se descarta
+        porque la cola está llena. airtime_bytes es el tamaño a usar en la estimación de airtime
+        (por defecto, el del payload MQTT).
+        """
+        airtime = self.airtime_for(airtime_bytes if airtime_bytes is not None else len(payload))
+        packet = OutboundPacket(client, topic, payload, channel_name, priority, description, airtime, on_sent)
+        with self._condition:
+            if self._backlog >= self.max_backlog:
+                self.dropped += 1
+                return False
+            state = self._channels.get(channel_name)
+            if state is None:
+                capacity = max(self.duty_cycle * self.window_seconds, 0.001)
+                state = self._channels[channel_name] = _ChannelState(capacity, max(self.duty_cycle, 0.0001))
+            heapq.heappush(state.queue, (priority, next(self._sequence), packet))
+            self._backlog += 1
+            self._condition.notify()
+        return True
+
+    def _next_ready(self, now):
+        """Devuelve (canal, paquete) listo para enviar, o (None, segundos a esperar)."""
+        best = None
+        best_key = None
+        min_wait = None
+        for state in self._channels.values():
+            if not state.queue:
+                continue
+            state.refill(now)
+            priority, sequence, packet = state.queue[0]
+            wait = state.wait_time(packet.airtime, now)
+            if wait > 0:
+                min_wait = wait if min_wait is None else min(min_wait, wait)
+                continue
+            if best_key is None or (priority, sequence) < best_key:
+                best, best_key = state, (priority, sequence)
+        if best is None:
+            return None, min_wait
+        return best, None
+
+    def _run(self):
+        while True:
+            with self._condition:
+                if not self._running:
+                    return
+                state, wait = self._next_ready(time.monotonic())
+                if state is None:
+                    self._condition.wait(wait)
+                    continue
+                _, _, packet = heapq.heappop(state.queue)
+                self._backlog -= 1
+                now = time.monotonic()
+                state.tokens -= min(packet.airtime, state.capacity)
+                state.next_allowed = now + self.min_interval
+                state.airtime_used += packet.airtime
+                self._record_delay(packet.priority, now - packet.enqueued_at)
+            self._publish(packet)
+
+    def _record_delay(self, priority, delay):
+        self.last_delay = delay
+        self._delay_sum[priority] = self._delay_sum.get(priority, 0.0) + delay
+        self._delay_count[priority] = self._delay_count.get(priority, 0) + 1
+        self._delay_max[priority] = max(self._delay_max.get(priority, 0.0), delay)
+        QUEUE_DELAY.observe(delay, priority=PRIORITY_NAMES.get(priority, priority))
+
+    def _publish(self, packet):
+        try:
+            packet.client.publish(packet.topic, packet.payload)
+            self.sent += 1
+            PACKETS_SENT.inc(channel=packet.channel_name)
+            AIRTIME_USED.inc(packet.airtime, channel=packet.channel_name)
+            if packet.description:
+                log('info', packet.description)
+            if packet.on_sent:
+                packet.on_sent()
+        except Exception as e:
+            self.errors += 1
+            log('error', f"Error publicando paquete en '{packet.channel_name}': {e}")
+
+    def backlog(self):
+        with self._condition:
+            return self._backlog
+
+    def stats(self):
+        with self._condition:
+            backlog_by_priority = {name: 0 for name in PRIORITY_NAMES.values()}
+            backlog_by_channel = {}
+            airtime_by_channel = {}
+            for channel_name, state in self._channels.items():
+                backlog_by_channel[channel_name] = len(state.queue)
+                airtime_by_channel[channel_name] = round(state.airtime_used, 3)
+                for priority, _, _ in state.queue:
+                    backlog_by_priority[PRIORITY_NAMES.get(priority, str(priority))] += 1
+            delays = {}
+            for priority, name in PRIORITY_NAMES.items():
+                count = self._delay_count.get(priority, 0)
+                delays[name] = {
+                    'count': count,
+                    'avg': self._delay_sum.get(priority, 0.0) / count if count else 0.0,
+                    'max': self._delay_max.get(priority, 0.0),
+                }
+            return {
+                'backlog': self._backlog,
+                'backlog_by_priority': backlog_by_priority,
+                'backlog_by_channel': backlog_by_channel,
+                'airtime_by_channel': airtime_by_channel,
+                'queue_delay': delays,
+                'last_queue_delay': self.last_delay,
+                'sent': self.sent,
+                'dropped': self.dropped,
+                'errors': self.errors,
+            }
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""
+Módulo de Caché de Respuestas Públicas para MeshBot.
+
+En el canal público se repiten mucho las mismas preguntas a @meshbot ("tiempo en
+Madrid", "qué hora es", "quién eres"), y cada una cuesta una consulta a la IA y
+varios paquetes de difusión. Este módulo guarda la respuesta de cada pregunta
+normalizada, con una caducidad que depende de su tipo (la hora caduca enseguida,
+la identidad del bot casi nunca), une las preguntas idénticas que llegan mientras
+la primera aún se está respondiendo y recuerda cuándo se difundió cada respuesta
+para no repetirla en el canal al poco tiempo.
+
+Las preguntas sobre el propio usuario ("mi nodo", "dónde estoy") dependen de quién
+pregunta y nunca se guardan.
+"""
+
+import re
+import threading
+import time
+
+from cache import TTLCache
+from logutil import log
+from node_index import fold_name
+
+# Tipos de pregunta, en orden de prioridad: el primero cuyo patrón aparece decide la caducidad.
+INTENT_PATTERNS = (
+    ('time', re.compile(r"\b(hora|fecha|que dia|dia es|dia de hoy)\b")),
+    ('weather', re.compile(r"\b(tiempo|clima|temperatura|lluvia|llueve|llovera|viento|pronostico|calor|frio)\b")),
+    ('nodes', re.compile(r"[@!]\w|\b(nodo|nodos|bateria|voltaje|humedad|presion|cerca|cercanos)\b")),
+    ('identity', re.compile(r"\b(quien eres|que eres|como te llamas|tu nombre|donde estas|tu ubicacion|tu id)\b")),
+)
+DEFAULT_INTENT = 'general'
+
+# Caducidad por defecto de cada tipo de pregunta, en segundos (ver RESPONSE_CACHE_TTL_SECONDS).
+DEFAULT_TTL_SECONDS = {'time': 30, 'weather': 600, 'nodes': 120, 'identity': 86400, 'general': 1800}
+
+# Palabras en primera persona: la respuesta depende de quién pregunta.
+PERSONAL_PATTERN = re.compile(r"\b(mi|mis|me|yo|estoy|conmigo|mio|mia|mios|mias|aqui)\b")
+
+# Los "@" y "!" que preceden a un nombre o ID de nodo se conservan.
+_PUNCTUATION = re.compile(r"[^\w\s@!]|(?<=\w)!|!(?!\w)|_")
+
+def normalize_query(text):
+    """Pregunta normalizada: sin acentos, mayúsculas, signos de puntuación ni espacios sobrantes."""
+    return " ".join(_PUNCTUATION.sub(" ", fold_name(text)).split())
+
+def classify(normalized):
+    """Tipo de pregunta (ver INTENT_PATTERNS), o None si depende de quién pregunta."""
+    if PERSONAL_PATTERN.search(normalized):
+        return None
+    for intent, pattern in INTENT_PATTERNS:
+        if pattern.search(normalized):
+            return intent
+    return DEFAULT_INTENT
+
+class _Entry:
+    __slots__ = ('text', 'sent_at')
+
+    def __init__(self, text):
+        self.text = text
+        self.sent_at = None
+
+class ResponseCache:
+    """
+    Caché de respuestas públicas, segura para usarse desde varios hilos.
+
+    get_or_compute(clave, tipo, compute, on_ready) pasa a on_ready la respuesta guardada o
+    llama a compute() una sola vez aunque lleguen varias preguntas iguales a la vez. Las que
+    llegan mientras se calcula no esperan: su on_ready se apunta en la entrada en curso y lo
+    llama el hilo que la calcula al terminar, así que el worker que recibió la pregunta sigue
+    atendiendo a los demás remitentes. compute() es quien difunde la respuesta, así que una
+    entrada nueva cuenta como recién enviada.
+    """
+
+    def __init__(self, max_entries, ttl_seconds, repeat_window_seconds):
+        self.ttl_seconds = dict(ttl_seconds)
+        self.repeat_window_seconds = repeat_window_seconds
+        self._cache = TTLCache(max_entries, self.ttl_seconds.get(DEFAULT_INTENT, 300))
+        self._lock = threading.Lock()
+        # Preguntas que se están respondiendo: {clave: [on_ready de las que esperan]}.
+        self._in_flight = {}
+        self.merged = 0
+
+    def get_or_compute(self, key, intent, compute, on_ready):
+        """
+        Llama a on_ready(entrada, calculada), donde calculada indica si la ha obtenido (y enviado)
+        esta llamada a compute(). compute() devuelve el texto de la respuesta, o None si no debe
+        guardarse (p. ej. un error); en ese caso la entrada es None. Si la misma pregunta ya se está
+        respondiendo, on_ready se llamará más tarde desde el hilo que la responde.
+        """
+        entry = self._cache.get(key)
+        if entry is not None:
+            on_ready(entry, False)
+            return
+        with self._lock:
+            waiters = self._in_flight.get(key)
+            if waiters is not None:
+                waiters.append(on_ready)
+                self.merged += 1
+                return
+            # Puede haberse guardado justo mientras se tomaba el lock.
+            entry = self._cache.get(key) if key in self._cache else None
+            if entry is None:
+                self._in_flight[key] = []
+        if entry is not None:
+            on_ready(entry, False)
+            return
+        try:
+            text = compute()
+            if text:
+                entry = _Entry(text)
+                entry.sent_at = time.monotonic()
+                self._cache.set(key, entry, self.ttl_seconds.get(intent, self._cache.ttl_seconds))
+        finally:
+            with self._lock:
+                waiters = self._in_flight.pop(key)
+            for waiter in waiters:
+                try:
+                    waiter(entry, False)
+                except Exception as e:
+                    log('error', f"Error respondiendo a una consulta pública en espera: {e}")
+        on_ready(entry, True)
+
+    def recently_sent(self, entry):
+        """Segundos desde que se difundió la respuesta, si fue dentro de la ventana de repetición."""
+        if entry.sent_at is None:
+            return None
+        elapsed = time.monotonic() - entry.sent_at
+        return elapsed if elapsed < self.repeat_window_seconds else None
+
+    def mark_sent(self, entry):
+        entry.sent_at = time.monotonic()
+
+    def __len__(self):
+        return len(self._cache)
+
+    def stats(self):
+        stats = self._cache.stats()
+        stats['merged'] = self.merged
+        return stats
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+"""
+Módulo de Tareas Periódicas para MeshBot.
+
+Un único hilo ejecuta todas las tareas periódicas del bot (presencia, anuncios,
+limpieza de la base de datos...). Las tareas se guardan en un montículo ordenado
+por su próxima ejecución, así que añadir una tarea más no cuesta un hilo más.
+
+Las tareas se identifican por nombre: registrar dos veces la misma (por ejemplo, al
+reconectar con el bróker) no la duplica. Si una tarea se retrasa más de un intervalo
+(el equipo estuvo suspendido, otra tarea tardó mucho...), por defecto se salta las
+ejecuciones perdidas; con catch_up=True las recupera una tras otra.
+"""
+
+import heapq
+import random
+import threading
+import time
+from datetime import datetime
+
+from logutil import log
+
+class Job:
+    """Una tarea periódica y su estado (última duración, próxima ejecución, errores...)."""
+
+    def __init__(self, name, func, interval_seconds, jitter_seconds=0, catch_up=False):
+        if interval_seconds <= 0:
+            raise ValueError(f"El intervalo de la tarea '{name}' debe ser positivo.")
+        self.name = name
+        self.func = func
+        self.interval = interval_seconds
+        self.jitter = jitter_seconds
+        self.catch_up = catch_up
+        self.scheduled = None  # Momento teórico de la próxima ejecución (monotonic), sin jitter.
+        self.due = None        # Momento real de la próxima ejecución, con jitter.
+        self.entry = None      # Entrada vigente de la tarea en el montículo del planificador.
+        self.running = False
+        self.run_again = False # Se pidió run_now() mientras se ejecutaba: repetirla al terminar.
+        self.last_run = None
+        self.last_duration = None
+        self.runs = 0
+        self.skipped = 0
+        self.errors = 0
+
+    def _set_next(self, scheduled):
+        self.scheduled = scheduled
+        self.due = scheduled + (random.uniform(0, self.jitter) if self.jitter else 0)
+
+    def next_run(self):
+        """Fecha de la próxima ejecución, o None si la tarea ya no está programada."""
+        if self.due is None:
+            return None
+        return datetime.fromtimestamp(time.time() + self.due - time.monotonic())
+
+    def stats(self):
+        return {
+            'interval': self.interval,
+            'runs': self.runs,
+            'skipped': self.skipped,
+            'errors': self.errors,
+            'last_run': self.last_run,
+            'last_duration': self.last_duration,
+            'next_run': self.next_run(),
+        }
+
+class Scheduler:
+    """Planificador de tareas periódicas con un solo hilo."""
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._jobs = {}
+        self._heap = []
+        self._sequence = 0
+        self._thread = None
+        self._running = False
+
+    def add_job(self, name, func, interval_seconds, first_delay=None, jitter_seconds=0, catch_up=False):
+        """
+        Programa func() cada interval_seconds. La primera ejecución es tras first_delay
+        segundos (por defecto, un intervalo completo). Si ya hay una tarea con ese nombre,
+        se deja como está y se devuelve la existente.
+        """
+        with self._condition:
+            job = self._jobs.get(name)
+            if job is not None:
+                return job
+            job = Job(name, func, interval_seconds, jitter_seconds, catch_up)
+            job._set_next(time.monotonic() + (interval_seconds if first_delay is None else first_delay))
+            self._jobs[name] = job
+            self._push(job)
+            return job
+
+    def remove_job(self, name):
+        with self._condition:
+            job = self._jobs.pop(name, None)
+            if job is not None:
+                job.due = job.entry = None
+                self._condition.notify()
+            return job is not None
+
+    def run_now(self, name):
+        """
+        Adelanta la próxima ejecución de una tarea a este mismo momento. Si la tarea se está
+        ejecutando, se vuelve a ejecutar en cuanto termine.
+        """
+        with self._condition:
+            job = self._jobs.get(name)
+            if job is None:
+                return False
+            if job.running:
+                job.run_again = True
+                return True
+            job.scheduled = job.due = time.monotonic()
+            self._push(job)
+            return True
+
+    def _push(self, job):
+        # Las entradas antiguas de una tarea reprogramada se quedan en el montículo
+        # y se descartan al salir: solo vale la última que se añadió de cada tarea.
+        self._sequence += 1
+        job.entry = self._sequence
+        heapq.heappush(self._heap, (job.due, self._sequence, job))
+        self._condition.notify()
+
+    def start(self):
+        with self._condition:
+            if self._thread is not None:
+                return
+            self._running = True
+            self._thread = threading.Thread(target=self._run, name="scheduler", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=5):
+        """Detiene el planificador; una tarea en curso termina antes de salir."""
+        with self._condition:
+            if self._thread is None:
+                return
+            self._running = False
+            self._condition.notify()
+            thread = self._thread
+            self._thread = None
+        thread.join(timeout)
+
+    def _next_job(self):
+        """Espera a que toque la siguiente tarea y la devuelve, o None si se detiene el planificador."""
+        with self._condition:
+            while self._running:
+                if not self._heap:
+                    self._condition.wait()
+                    continue
+                due, entry, job = self._heap[0]
+                if job.entry != entry or self._jobs.get(job.name) is not job:
+                    heapq.heappop(self._heap)
+                    continue
+                delay = due - time.monotonic()
+                if delay > 0:
+                    self._condition.wait(delay)
+                    continue
+                heapq.heappop(self._heap)
+                job.running = True
+                return job
+            return None
+
+    def _run(self):
+        while True:
+            job = self._next_job()
+            if job is None:
+                break
+            started = time.monotonic()
+            try:
+                job.func()
+            except Exception as e:
+                job.errors += 1
+                log('error', f"Error en la tarea periódica '{job.name}': {e}")
+            finished = time.monotonic()
+            with self._condition:
+                job.last_run = datetime.now()
+                job.last_duration = finished - started
+                job.runs += 1
+                job.running = False
+                if self._jobs.get(job.name) is not job:
+                    continue
+                if job.run_again:
+                    job.run_again = False
+                    job.scheduled = job.due = finished
+                    self._push(job)
+                    continue
+                scheduled = job.scheduled + job.interval
+                if scheduled <= finished and not job.catch_up:
+                    missed = int((finished - scheduled) // job.interval) + 1
+                    job.skipped += missed
+                    scheduled += missed * job.interval
+                job._set_next(scheduled)
+                self._push(job)
+
+    def jobs(self):
+        with self._condition:
+            return list(self._jobs.values())
+
+    def stats(self):
+        return {job.name: job.stats() for job in self.jobs()}
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""
+Módulo de Segmentación de Mensajes para MeshBot.
+
+Parte un texto en trozos que caben en un paquete de Meshtastic, siempre por
+límites de palabra. El texto puede llegar de golpe o poco a poco (por ejemplo,
+en streaming desde la IA): cada trozo se entrega en cuanto se sabe que está
+completo, sin esperar al resto del texto.
+
+Como al entregar un trozo todavía no se sabe cuántos habrá, la numeración de los
+mensajes en streaming es "1+: ", "2+: "... y el último lleva el total, "3/3: ".
+"""
+
+class Segmenter:
+    """
+    Acumula texto y llama a emit(índice, trozo, es_el_último) con cada trozo completo.
+
+    Un trozo se da por completo cuando la siguiente palabra ya no cabe en él; la
+    última palabra de cada fragmento recibido se guarda hasta saber si continúa.
+    Una palabra que por sí sola no cabe en un paquete se envía sola, sin cortarla.
+    """
+
+    def __init__(self, max_bytes, emit):
+        self.max_bytes = max_bytes
+        self.emit = emit
+        self.count = 0
+        self.received = False
+        self._current = ""
+        self._current_bytes = 0
+        self._tail = ""
+
+    def feed(self, text):
+        if not text:
+            return
+        self.received = True
+        words = (self._tail + text).split()
+        # Si el fragmento no acaba en un espacio, su última palabra puede seguir en el siguiente.
+        self._tail = words.pop() if words and not text[-1].isspace() else ""
+        for word in words:
+            self._add(word)
+
+    def _add(self, word):
+        word_bytes = len(word.encode('utf-8'))
+        if not self._current:
+            self._current, self._current_bytes = word, word_bytes
+        elif self._current_bytes + 1 + word_bytes > self.max_bytes:
+            self._emit(last=False)
+            self._current, self._current_bytes = word, word_bytes
+        else:
+            self._current += " " + word
+            self._current_bytes += 1 + word_bytes
+
+    def _emit(self, last):
+        self.count += 1
+        self.emit(self.count, self._current, last)
+
+    def finish(self):
+        """Entrega el último trozo. Devuelve el número total de trozos."""
+        if self._tail:
+            self._add(self._tail)
+            self._tail = ""
+        if self._current:
+            self._emit(last=True)
+            self._current, self._current_bytes = "", 0
+        return self.count
+
+def streaming_prefix(index, last):
+    """Prefijo de numeración de un trozo cuando no se conoce el total de antemano."""
+    if last:
+        return f"{index}/{index}: " if index > 1 else ""
+    return f"{index}+: "
+
+def split_text(text, max_bytes):
+    """Parte un texto completo en trozos de como mucho max_bytes (salvo palabras más largas)."""
+    parts = []
+    segmenter = Segmenter(max_bytes, lambda index, part, last: parts.append(part))
+    segmenter.feed(text)
+    segmenter.finish()
+    return parts
@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+"""
+Módulo de Índice Espacial para MeshBot.
+
+Mantiene en memoria la posición de todos los nodos para responder preguntas como
+"qué nodos hay a menos de 10 km" o "cuál es el nodo más cercano con sensor de
+temperatura" sin leer la tabla entera. Los nodos se reparten en una rejilla de
+celdas de latitud/longitud; una consulta solo mira las celdas que toca y calcula
+las distancias de todos sus candidatos de una vez con NumPy.
+"""
+
+import math
+import threading
+import numpy as np
+
+EARTH_RADIUS_KM = 6371
+
+# Sensores que se pueden usar como filtro; cada uno es un bit de la máscara del nodo.
+SENSOR_FLAGS = {
+    'battery_level': 1,
+    'voltage': 2,
+    'air_temp': 4,
+    'humidity': 8,
+    'barometric_pressure': 16,
+}
+
+def haversine_vector(lat, lon, lats_rad, lons_rad):
+    """Distancias en km (misma fórmula que bot_commands.haversine) desde un punto a un array de puntos en radianes."""
+    lat_rad, lon_rad = math.radians(lat), math.radians(lon)
+    a = (np.sin((lats_rad - lat_rad) / 2) ** 2
+         + math.cos(lat_rad) * np.cos(lats_rad) * np.sin((lons_rad - lon_rad) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+
+class SpatialIndex:
+    """
+    Índice de posiciones de nodos en una rejilla, seguro para usarse desde varios hilos.
+
+    Las posiciones se guardan en arrays de NumPy (una posición por hueco) y cada celda
+    de la rejilla guarda los huecos de los nodos que caen dentro. Los huecos liberados
+    se reutilizan y los arrays crecen al doble cuando se llenan.
+    """
+
+    def __init__(self, cell_degrees, initial_capacity=1024):
+        self.cell_degrees = cell_degrees
+        self._lock = threading.Lock()
+        self._slots = {}
+        self._free = []
+        self._size = 0
+        self._cells = {}
+        self._sensors = {}
+        self._allocate(initial_capacity)
+        self.loaded = False
+
+    def _allocate(self, capacity):
+        self._lats = np.zeros(capacity)
+        self._lons = np.zeros(capacity)
+        self._node_ids = np.full(capacity, -1, dtype=np.int64)
+        self._flags = np.zeros(capacity, dtype=np.uint8)
+        self._cell_of = [None] * capacity
+
+    def _grow(self):
+        old = (self._lats, self._lons, self._node_ids, self._flags, self._cell_of)
+        self._allocate(len(old[0]) * 2)
+        count = len(old[0])
+        self._lats[:count], self._lons[:count], self._node_ids[:count], self._flags[:count] = old[:4]
+        self._cell_of[:count] = old[4]
+
+    def _cell(self, lat, lon):
+        return (math.floor(lat / self.cell_degrees), math.floor(lon / self.cell_degrees))
+
+    def load(self, rows):
+        """Carga el índice a partir de filas (node_id, latitud, longitud, máscara de sensores)."""
+        with self._lock:
+            self._slots.clear()
+            self._free = []
+            self._size = 0
+            self._cells.clear()
+            self._sensors.clear()
+            self._allocate(max(1024, len(rows)))
+            for node_id, lat, lon, flags in rows:
+                if flags:
+                    self._sensors[node_id] = flags
+                if lat is not None and lon is not None:
+                    self._update(node_id, lat, lon)
+            self.loaded = True
+
+    def update(self, node_id, lat, lon):
+        with self._lock:
+            self._update(node_id, lat, lon)
+
+    def _update(self, node_id, lat, lon):
+        # Meshtastic envía 0,0 cuando el nodo no tiene posición.
+        if lat == 0 and lon == 0:
+            return
+        slot = self._slots.get(node_id)
+        if slot is None:
+            if self._free:
+                slot = self._free.pop()
+            else:
+                if self._size == len(self._lats):
+                    self._grow()
+                slot = self._size
+                self._size += 1
+            self._slots[node_id] = slot
+            self._node_ids[slot] = node_id
+        cell = self._cell(lat, lon)
+        if self._cell_of[slot] != cell:
+            if self._cell_of[slot] is not None:
+                self._discard_from_cell(self._cell_of[slot], slot)
+            self._cells.setdefault(cell, set()).add(slot)
+            self._cell_of[slot] = cell
+        self._lats[slot] = math.radians(lat)
+        self._lons[slot] = math.radians(lon)
+        self._flags[slot] = self._sensors.get(node_id, 0)
+
+    def add_sensors(self, node_id, metrics):
+        """Marca las métricas de telemetría que ha enviado un nodo."""
+        flags = 0
+        for metric in metrics:
+            flags |= SENSOR_FLAGS.get(metric, 0)
+        with self._lock:
+            flags |= self._sensors.get(node_id, 0)
+            self._sensors[node_id] = flags
+            slot = self._slots.get(node_id)
+            if slot is not None:
+                self._flags[slot] = flags
+
+    def remove(self, node_id):
+        with self._lock:
+            self._sensors.pop(node_id, None)
+            slot = self._slots.pop(node_id, None)
+            if slot is None:
+                return
+            self._discard_from_cell(self._cell_of[slot], slot)
+            self._cell_of[slot] = None
+            self._node_ids[slot] = -1
+            self._flags[slot] = 0
+            self._free.append(slot)
+
+    def _discard_from_cell(self, cell, slot):
+        slots = self._cells.get(cell)
+        if slots is not None:
+            slots.discard(slot)
+            if not slots:
+                del self._cells[cell]
+
+    def _candidate_slots(self, lat, lon, radius_km):
+        """Huecos de las celdas que cubren el círculo, o None si conviene mirar todos los nodos."""
+        lat_span = math.degrees(radius_km / EARTH_RADIUS_KM)
+        max_lat = min(abs(lat) + lat_span, 90.0)
+        if max_lat >= 89.0:
+            return None
+        lon_span = lat_span / math.cos(math.radians(max_lat))
+        if lon_span >= 180.0 or abs(lon) + lon_span > 180.0:
+            return None
+        min_cell, max_cell = self._cell(lat - lat_span, lon - lon_span), self._cell(lat + lat_span, lon + lon_span)
+        cell_count = (max_cell[0] - min_cell[0] + 1) * (max_cell[1] - min_cell[1] + 1)
+        if cell_count > len(self._cells):
+            # Hay menos celdas ocupadas que celdas en el recuadro: se filtran las ocupadas.
+            cells = [cell for cell in self._cells
+                     if min_cell[0] <= cell[0] <= max_cell[0] and min_cell[1] <= cell[1] <= max_cell[1]]
+        else:
+            cells = [(cell_lat, cell_lon)
+                     for cell_lat in range(min_cell[0], max_cell[0] + 1)
+                     for cell_lon in range(min_cell[1], max_cell[1] + 1)]
+        slots = []
+        for cell in cells:
+            slots.extend(self._cells.get(cell, ()))
+        return np.fromiter(slots, dtype=np.int64, count=len(slots))
+
+    def _distances(self, lat, lon, radius_km, sensor_mask, exclude):
+        """(node_ids, distancias) de los nodos a menos de radius_km que cumplen el filtro."""
+        slots = self._candidate_slots(lat, lon, radius_km) if radius_km is not None else None
+        if slots is None:
+            slots = np.flatnonzero(self._node_ids[:self._size] >= 0)
+        if sensor_mask:
+            slots = slots[(self._flags[slots] & sensor_mask) == sensor_mask]
+        if exclude is not None and exclude in self._slots:
+            slots = slots[slots != self._slots[exclude]]
+        distances = haversine_vector(lat, lon, self._lats[slots], self._lons[slots])
+        if radius_km is not None:
+            inside = distances <= radius_km
+            slots, distances = slots[inside], distances[inside]
+        return self._node_ids[slots], distances
+
+    def within(self, lat, lon, radius_km, sensor_mask=0, exclude=None):
+        """Todos los nodos a menos de radius_km, del más cercano al más lejano, como [(node_id, km)]."""
+        with self._lock:
+            node_ids, distances = self._distances(lat, lon, radius_km, sensor_mask, exclude)
+        order = np.argsort(distances, kind='stable')
+        return [(int(node_ids[i]), float(distances[i])) for i in order]
+
+    def nearest(self, lat, lon, k, sensor_mask=0, exclude=None, max_radius_km=None):
+        """
+        Los k nodos más cercanos como [(node_id, km)]. Se busca en un radio que se dobla
+        hasta reunir k candidatos: todo nodo más cercano que el k-ésimo está dentro del radio.
+        """
+        k = max(1, k)
+        radius = self.cell_degrees * 111.0
+        with self._lock:
+            while True:
+                if max_radius_km is not None and radius >= max_radius_km:
+                    radius = max_radius_km
+                full_scan = radius >= math.pi * EARTH_RADIUS_KM
+                node_ids, distances = self._distances(lat, lon, None if full_scan else radius, sensor_mask, exclude)
+                if len(node_ids) >= k or full_scan or radius == max_radius_km:
+                    break
+                radius *= 2
+        if len(node_ids) > k:
+            top = np.argpartition(distances, k - 1)[:k]
+            node_ids, distances = node_ids[top], distances[top]
+        order = np.argsort(distances, kind='stable')
+        return [(int(node_ids[i]), float(distances[i])) for i in order]
+
+    def __len__(self):
+        with self._lock:
+            return len(self._slots)
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""
+Módulo de Codificación de Texto para MeshBot.
+
+Meshtastic admite mensajes de texto comprimidos con Unishox2 en el puerto
+TEXT_MESSAGE_COMPRESSED_APP. Un texto en español ocupa comprimido bastante menos,
+así que una respuesta larga cabe en menos paquetes y gasta menos tiempo de aire.
+No todos los clientes los muestran, de modo que solo se envían comprimidos los
+mensajes directos a nodos que se sabe que los entienden: los que nos han enviado
+alguno o los que se indican en la configuración. A los demás, y en los mensajes
+al canal, se les envía texto normal.
+
+La compresión usa el paquete unishox2-py3 (incluido en requirements.txt); si no
+está instalado, los mensajes se envían siempre sin comprimir y los comprimidos que
+llegan no se pueden leer.
+"""
+
+import threading
+
+from meshtastic import portnums_pb2
+
+import segmenter
+from logutil import log
+
+try:
+    import unishox2
+except ImportError:
+    unishox2 = None
+
+# Bytes que se reservan para el texto descomprimido de un paquete (un paquete nunca da para más).
+MAX_DECOMPRESSED_LEN = 2048
+# Veces que se vuelve a partir el texto con un tamaño menor si alguna parte comprimida no cabe.
+MAX_SPLIT_ATTEMPTS = 4
+
+def available():
+    return unishox2 is not None
+
+def compress(text):
+    compressed, _ = unishox2.compress(text)
+    return compressed
+
+def decompress(payload):
+    """
+    unishox2-py3 (1.x) tiene la firma decompress(datos, longitud): la longitud es el tamaño
+    del buffer que reserva para el resultado, no la del texto original, que en un paquete
+    recibido no se conoce. Devuelve solo los bytes que escribe el descompresor, pero se
+    quitan los nulos del final por si alguna versión devolviera el buffer entero.
+    """
+    return unishox2.decompress(payload, MAX_DECOMPRESSED_LEN).rstrip('\x00')
+
+def decode_text(port_num, payload):
+    """Texto de un paquete de texto, comprimido o no. None si no se puede descomprimir."""
+    if port_num == portnums_pb2.TEXT_MESSAGE_COMPRESSED_APP:
+        if unishox2 is None:
+            return None
+        return decompress(payload)
+    return payload.decode('utf-8', 'ignore')
+
+def numbered(parts):
+    total_parts = len(parts)
+    return [(f"{i+1}/{total_parts}: " if total_parts > 1 else "") + part for i, part in enumerate(parts)]
+
+class TextEncoder:
+    """
+    Prepara los paquetes de texto de cada mensaje: decide si van comprimidos y, para
+    los mensajes largos, en cuántas partes se divide el texto.
+
+    max_bytes es lo que puede ocupar el texto de una parte sin comprimir (dejando
+    sitio para la numeración "1/3: ") y max_payload la carga útil de un paquete.
+    """
+
+    def __init__(self, max_bytes, max_payload, enabled=True, capable_nodes=()):
+        self.max_bytes = max_bytes
+        self.max_payload = max_payload
+        self.enabled = enabled and available()
+        self._capable = set(capable_nodes)
+        self._lock = threading.Lock()
+        self.compressed_packets = 0
+        self.plain_packets = 0
+        self.saved_bytes = 0
+
+    def mark_capable(self, node_id):
+        """Anota que un nodo entiende texto comprimido (p. ej. porque nos ha enviado uno)."""
+        with self._lock:
+            if node_id in self._capable:
+                return
+            self._capable.add(node_id)
+        log('info', f"!{node_id:08x} admite texto comprimido.")
+
+    def supports(self, destination_id):
+        with self._lock:
+            return self.enabled and destination_id in self._capable
+
+    def encode(self, text, destination_id):
+        """(puerto, carga útil) de un paquete: comprimido solo si el destino lo admite y ocupa menos."""
+        plain = text.encode('utf-8')
+        if self.supports(destination_id):
+            try:
+                compressed = compress(text)
+            except Exception as e:
+                log('error', f"No se pudo comprimir el mensaje: {e}")
+            else:
+                if len(compressed) < len(plain) and len(compressed) <= self.max_payload:
+                    with self._lock:
+                        self.compressed_packets += 1
+                        self.saved_bytes += len(plain) - len(compressed)
+                    return portnums_pb2.TEXT_MESSAGE_COMPRESSED_APP, compressed
+        with self._lock:
+            self.plain_packets += 1
+        return portnums_pb2.TEXT_MESSAGE_APP, plain
+
+    def split(self, text, destination_id):
+        """
+        Divide un mensaje largo en partes ya numeradas. Si el destino admite texto comprimido,
+        cada parte se hace tan grande como permita su tamaño comprimido, así que salen menos partes.
+        """
+        plain_parts = numbered(segmenter.split_text(text, self.max_bytes))
+        if len(plain_parts) < 2 or not self.supports(destination_id):
+            return plain_parts
+        try:
+            # Se empieza suponiendo que el texto se comprime a la mitad y se corrige con lo que se mide.
+            budget = self.max_bytes * 2
+            for _ in range(MAX_SPLIT_ATTEMPTS):
+                parts = numbered(segmenter.split_text(text, budget))
+                largest = max(len(compress(part)) for part in parts)
+                if largest <= self.max_payload:
+                    return parts if len(parts) < len(plain_parts) else plain_parts
+                budget = budget * self.max_payload * 9 // (largest * 10)
+                if budget <= self.max_bytes:
+                    break
+        except Exception as e:
+            log('error', f"No se pudo comprimir el mensaje: {e}")
+        return plain_parts
+
+    def stats(self):
+        with self._lock:
+            return {
+                'enabled': self.enabled,
+                'capable_nodes': len(self._capable),
+                'compressed_packets': self.compressed_packets,
+                'plain_packets': self.plain_packets,
+                'saved_bytes': self.saved_bytes,
+            }
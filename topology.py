@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+"""
+Módulo de Topología de la Malla para MeshBot.
+
+Cada copia de un paquete que llega por MQTT dice qué pasarela (gateway) lo oyó,
+cuántos saltos dio hasta ella (hop_start - hop_limit) y con qué señal (RSSI/SNR).
+Con eso, y con los paquetes NEIGHBORINFO y TRACEROUTE, se mantiene un modelo de
+la red que se actualiza con cada paquete: a cuántos saltos está cada nodo, qué
+pasarelas lo oyen y qué vecinos tiene.
+
+La distancia en saltos sirve para enviar los mensajes directos con el hop_limit
+justo para llegar al destinatario, en lugar de siempre el máximo: cada salto de
+más son retransmisiones que ocupan el canal de todos.
+"""
+
+import threading
+import time
+from collections import deque
+
+# Paquetes recientes de cada nodo con los que se estima su distancia en saltos.
+HOP_SAMPLES = 16
+# Peso de cada medida nueva en la media móvil de RSSI/SNR.
+SIGNAL_SMOOTHING = 0.3
+
+def ewma(previous, value):
+    return value if previous is None else previous + SIGNAL_SMOOTHING * (value - previous)
+
+def parse_node_id(node_id_str):
+    """ID numérico de un nodo a partir de '!a1b2c3d4', o None si no es válido."""
+    if not node_id_str or not node_id_str.startswith('!'):
+        return None
+    try:
+        return int(node_id_str[1:], 16)
+    except ValueError:
+        return None
+
+class GatewayLink:
+    """Cómo oye una pasarela a un nodo: saltos de la última vez y señal media del último salto."""
+
+    __slots__ = ('hops', 'rssi', 'snr', 'packets', 'last_seen')
+
+    def __init__(self):
+        self.hops = None
+        self.rssi = None
+        self.snr = None
+        self.packets = 0
+        self.last_seen = 0.0
+
+class NodeTopology:
+    __slots__ = ('node_id', 'gateways', 'neighbors', 'hop_samples', 'last_packet_id', 'last_seen')
+
+    def __init__(self, node_id):
+        self.node_id = node_id
+        self.gateways = {}
+        # Vecinos por radio: {node_id: (snr, momento)}, de NEIGHBORINFO y TRACEROUTE.
+        self.neighbors = {}
+        # Saltos de cada paquete reciente hasta la pasarela más cercana que lo oyó.
+        self.hop_samples = deque(maxlen=HOP_SAMPLES)
+        self.last_packet_id = None
+        self.last_seen = 0.0
+
+    def hops(self):
+        """Distancia en saltos que cubre todos los paquetes recientes (la más desfavorable), o None."""
+        return max(self.hop_samples) if self.hop_samples else None
+
+class TopologyModel:
+    """
+    Modelo de la topología de la malla, seguro para usarse desde varios hilos.
+
+    observe() se llama con cada copia de cada paquete (también las duplicadas, que son
+    precisamente las que llegan por otras pasarelas); add_neighbors() y add_route() con
+    el contenido de los paquetes NEIGHBORINFO y TRACEROUTE.
+    """
+
+    def __init__(self, default_hop_limit, max_hop_limit, hop_margin, min_samples):
+        self.default_hop_limit = default_hop_limit
+        self.max_hop_limit = max_hop_limit
+        self.hop_margin = hop_margin
+        self.min_samples = min_samples
+        self._lock = threading.Lock()
+        self._nodes = {}
+        self.observations = 0
+
+    def _node(self, node_id):
+        node = self._nodes.get(node_id)
+        if node is None:
+            node = self._nodes[node_id] = NodeTopology(node_id)
+        return node
+
+    def observe(self, node_id, packet_id, gateway_id, hop_start, hop_limit, rx_rssi=0, rx_snr=0.0):
+        """Registra una copia de un paquete de node_id oída por la pasarela gateway_id."""
+        # Los nodos con firmware antiguo no rellenan hop_start: no se sabe cuántos saltos dio.
+        hops = hop_start - hop_limit if hop_start and hop_start >= hop_limit else None
+        now = time.monotonic()
+        with self._lock:
+            self.observations += 1
+            node = self._node(node_id)
+            node.last_seen = now
+            if hops is not None:
+                if packet_id == node.last_packet_id and node.hop_samples:
+                    # Otra copia del mismo paquete: cuenta la pasarela más cercana.
+                    node.hop_samples[-1] = min(node.hop_samples[-1], hops)
+                else:
+                    node.hop_samples.append(hops)
+                    node.last_packet_id = packet_id
+            if gateway_id is None or gateway_id == node_id:
+                return
+            link = node.gateways.get(gateway_id)
+            if link is None:
+                link = node.gateways[gateway_id] = GatewayLink()
+            link.packets += 1
+            link.last_seen = now
+            if hops is not None:
+                link.hops = hops
+            if rx_rssi:
+                link.rssi = ewma(link.rssi, rx_rssi)
+            if rx_snr:
+                link.snr = ewma(link.snr, rx_snr)
+
+    def add_neighbors(self, node_id, neighbors):
+        """Vecinos que anuncia un nodo en NEIGHBORINFO: lista de (node_id, snr). Sustituye a los anteriores."""
+        now = time.monotonic()
+        with self._lock:
+            node = self._node(node_id)
+            node.neighbors = {neighbor_id: (snr, now) for neighbor_id, snr in neighbors if neighbor_id != node_id}
+            for neighbor_id, snr in neighbors:
+                if neighbor_id != node_id:
+                    self._node(neighbor_id).neighbors[node_id] = (snr, now)
+
+    def add_route(self, path, snrs=()):
+        """Ruta de un TRACEROUTE: lista de nodos en orden y, si se conoce, el SNR de cada salto (en dB)."""
+        now = time.monotonic()
+        with self._lock:
+            for i in range(len(path) - 1):
+                a, b = path[i], path[i + 1]
+                if a == b:
+                    continue
+                snr = snrs[i] if i < len(snrs) else None
+                self._node(a).neighbors[b] = (snr, now)
+                self._node(b).neighbors[a] = (snr, now)
+
+    def hops_to(self, node_id):
+        with self._lock:
+            node = self._nodes.get(node_id)
+            return node.hops() if node is not None else None
+
+    def hop_limit_for(self, node_id):
+        """
+        hop_limit para un mensaje directo a node_id: los saltos que han necesitado sus paquetes
+        recientes más hop_margin, sin pasar de max_hop_limit. Si aún no hay suficientes
+        medidas, default_hop_limit.
+        """
+        with self._lock:
+            node = self._nodes.get(node_id)
+            if node is None or len(node.hop_samples) < self.min_samples:
+                return self.default_hop_limit
+            return max(1, min(node.hops() + self.hop_margin, self.max_hop_limit))
+
+    def describe(self, node_id):
+        """Datos de un nodo para mostrarlos, o None si no se sabe nada de él."""
+        with self._lock:
+            node = self._nodes.get(node_id)
+            if node is None:
+                return None
+            now = time.monotonic()
+            gateways = sorted(
+                ((gateway_id, link.hops, link.rssi, link.snr, now - link.last_seen) for gateway_id, link in node.gateways.items()),
+                key=lambda item: (item[1] if item[1] is not None else 99, -(item[3] or -99))
+            )
+            neighbors = sorted(
+                ((neighbor_id, snr) for neighbor_id, (snr, _) in node.neighbors.items()),
+                key=lambda item: -(item[1] if item[1] is not None else -99)
+            )
+            return {
+                'hops': node.hops(),
+                'samples': len(node.hop_samples),
+                'gateways': gateways,
+                'neighbors': neighbors,
+                'last_seen_seconds': now - node.last_seen,
+            }
+
+    def summary(self):
+        """Resumen de la red: nodos, pasarelas y cuántos nodos hay a cada distancia."""
+        with self._lock:
+            by_hops = {}
+            gateways = set()
+            for node in self._nodes.values():
+                hops = node.hops()
+                if hops is not None:
+                    by_hops[hops] = by_hops.get(hops, 0) + 1
+                gateways.update(node.gateways)
+            return {
+                'nodes': len(self._nodes),
+                'gateways': len(gateways),
+                'by_hops': dict(sorted(by_hops.items())),
+                'links': sum(len(node.neighbors) for node in self._nodes.values()) // 2,
+            }
+
+    def prune(self, max_age_seconds):
+        """Olvida los nodos, pasarelas y vecinos que no se han visto en max_age_seconds."""
+        limit = time.monotonic() - max_age_seconds
+        with self._lock:
+            for node_id in [node_id for node_id, node in self._nodes.items() if node.last_seen < limit and not node.neighbors]:
+                del self._nodes[node_id]
+            for node in self._nodes.values():
+                node.gateways = {gateway_id: link for gateway_id, link in node.gateways.items() if link.last_seen >= limit}
+                node.neighbors = {neighbor_id: entry for neighbor_id, entry in node.neighbors.items() if entry[1] >= limit}
+            # Los que solo seguían por sus vecinos se borran en la siguiente pasada.
+
+    def __len__(self):
+        with self._lock:
+            return len(self._nodes)